@@ -0,0 +1,97 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# Benchmark the compressed frame archive (senxor.archive): compression
+# ratio, and encode and decode throughput, per codec and sensor size.
+# Frames are synthetic scenes of the emulator, with fresh pixel noise
+# per frame, or the frames of a recording (see senxor.recording).
+# Run it on the target, e.g. a Raspberry Pi, to size storage and CPU.
+#
+import os
+import time
+import argparse
+import logging
+import tempfile
+
+import numpy as np
+
+from senxor.archive import ArchiveWriter, ArchiveReader
+from senxor.recording import RecordingReader, HEADER_DTYPE_LE
+from senxor.emulator import make_scenes
+from senxor.mi48 import FPA_SHAPE
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--nframes', default=500, type=int,
+                        help='Number of synthetic frames per sensor')
+    parser.add_argument('-c', '--chunk-frames', default=64, type=int,
+                        dest='chunk_frames', help='Frames per chunk')
+    parser.add_argument('--codecs', default='zlib:1,zlib:6,lzma:0,lzma:6',
+                        help='Comma-separated codec:level list')
+    parser.add_argument('-r', '--recording', default=None,
+                        help='Benchmark the frames of this recording instead')
+    args = parser.parse_args()
+    return args
+
+
+def bench(name, data, headers, host_times, codec, level, chunk_frames):
+    """Archive the frames and read them back; log the figures"""
+    n, data_size = data.shape
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'bench.sxa')
+        t0 = time.perf_counter()
+        with ArchiveWriter(path, (data_size,), chunk_frames=chunk_frames,
+                           codec=codec, level=level) as writer:
+            writer.extend(data, headers, host_times)
+        t_enc = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        with ArchiveReader(path) as reader:
+            decoded, _, _ = reader.frames()
+        t_dec = time.perf_counter() - t0
+        # random access: open, and decode one frame in the middle
+        t0 = time.perf_counter()
+        with ArchiveReader(path) as reader:
+            reader.frame(n // 2, raw=True)
+        t_seek = time.perf_counter() - t0
+    if not (decoded == data).all():
+        raise RuntimeError('{} {}: decoded frames differ'.format(name, codec))
+    # archive size per hour of streaming at 25 FPS
+    mb_per_hour = 1.e-6 * data.nbytes / writer.ratio / n * 25 * 3600
+    logger.info('{:8s} {:>4s}:{:<2}  ratio {:5.2f}  {:7.1f} MB/h at 25 FPS  '
+                'encode {:6.0f} FPS  decode {:6.0f} FPS  seek {:5.1f} ms'.
+                format(name, codec, '' if level is None else level,
+                       writer.ratio, mb_per_hour, n / t_enc, n / t_dec,
+                       1.e3 * t_seek))
+
+
+args = parse_args()
+
+codecs = []
+for item in args.codecs.split(','):
+    codec, _, level = item.partition(':')
+    codecs.append((codec, int(level) if level else None))
+
+if args.recording is not None:
+    rec = RecordingReader(args.recording)
+    datasets = [('x'.join(str(n) for n in rec.fpa_shape),
+                 rec.data, rec.headers, rec.host_times)]
+else:
+    datasets = []
+    for camera_type in [1, 8]:
+        fpa_shape = FPA_SHAPE[camera_type]
+        data = make_scenes(fpa_shape, n=args.nframes)
+        headers = np.zeros(args.nframes, dtype=HEADER_DTYPE_LE)
+        headers['frame_counter'] = np.arange(args.nframes)
+        headers['timestamp'] = 40 * np.arange(args.nframes)
+        datasets.append(('{}x{}'.format(*fpa_shape), data, headers,
+                         time.time() + 0.04 * np.arange(args.nframes)))
+
+for name, data, headers, host_times in datasets:
+    logger.info('{}: {} frames, {:.1f} MB/h raw at 25 FPS'.
+                format(name, len(data),
+                       1.e-6 * data[0].nbytes * 25 * 3600))
+    for codec, level in codecs:
+        bench(name, data, headers, host_times, codec, level,
+              args.chunk_frames)
@@ -0,0 +1,52 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# Convert legacy text recordings -- .dat files of write_frame() and
+# SenXorViewer CSV files -- to binary recordings (see senxor.recording),
+# and report the throughput in frames per second.
+#
+import os
+import time
+import argparse
+import logging
+
+from senxor.legacy import convert_files
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+', help='.dat or .csv files')
+    parser.add_argument('-o', '--outdir', default=None,
+                        help='Directory of the recordings; default: next '
+                        'to the files')
+    parser.add_argument('-j', '--processes', default=None, type=int,
+                        help='Number of processes; default: one per CPU')
+    parser.add_argument('-s', '--fpa-shape', default='80x62', dest='fpa_shape',
+                        help='Columns x rows of the frames')
+    parser.add_argument('-fps', '--framerate', default=None, type=float,
+                        dest='fps', help='Frame rate of .dat files, '
+                        'for frame timestamps')
+    parser.add_argument('-b', '--block-lines', default=256, type=int,
+                        dest='block_lines', help='Lines parsed at once')
+    args = parser.parse_args()
+    return args
+
+
+args = parse_args()
+fpa_shape = tuple(int(n) for n in args.fpa_shape.split('x'))
+if args.outdir is not None:
+    os.makedirs(args.outdir, exist_ok=True)
+
+t0 = time.perf_counter()
+results = convert_files(args.files, outdir=args.outdir,
+                        processes=args.processes, fpa_shape=fpa_shape,
+                        fps=args.fps, block_lines=args.block_lines)
+elapsed = time.perf_counter() - t0
+
+for dst, nframes, seconds in results:
+    logger.info('{}: {} frames, {:.0f} FPS'.
+                format(dst, nframes, nframes / seconds if seconds else 0))
+total = sum(nframes for _, nframes, _ in results)
+logger.info('{} files, {} frames in {:.2f} s: {:.0f} FPS'.
+            format(len(results), total, elapsed, total / elapsed))
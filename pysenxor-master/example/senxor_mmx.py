@@ -14,6 +14,8 @@ from senxor.utils import connect_senxor, data_to_frame, remap,\
                          cv_filter, cv_render,\
                          RollingAverageFilter, Display
 from senxor.utils import CVSegment
+from senxor.mi48 import MI48
+from senxor.replay import ReplayInterface, PACING
 from senxor.plots import Histogram, LinePlot
 
 from imutils.video import VideoStream
@@ -97,7 +99,10 @@ def parse_args():
     parser.add_argument('-c', '--colormap', default='rainbow2', type=str,
                         help='Colormap for the thermogram')
     parser.add_argument('--data_file', default=None, type=str,
-                        help='file instead of camera stream')
+                        help='recording or archive to replay instead of '
+                        'camera stream')
+    parser.add_argument('--pacing', default='realtime', choices=PACING,
+                        help='pacing of frames replayed from --data_file')
     parser.add_argument('-v', '--video-record', default=False, dest='record_video',
                         action = 'store_true', help='Record a video of what is shown')
     parser.add_argument('-e', '--emissivity', type=float, default=0.95,
@@ -277,7 +282,12 @@ def main():
 
     # Connect and setup thermal camera
     # --------------------------------
-    mi48, connected_port, port_names = connect_senxor(src=args.tis_id)
+    if args.data_file is not None:
+        replay = ReplayInterface(args.data_file, pacing=args.pacing)
+        mi48 = MI48([replay, replay], name='replay')
+        connected_port, port_names = args.data_file, [args.data_file]
+    else:
+        mi48, connected_port, port_names = connect_senxor(src=args.tis_id)
     if mi48 is None:
         logging.critical('Cannot connect to SenXor')
         logging.info(f'The following ports have SenXor attached {port_names}')
@@ -361,6 +371,14 @@ def main():
         # grab a frame from thermal camera
         # -------------------------------------------------------------
         raw_data, header = mi48.read()
+        if raw_data is None:
+            # end of the replayed recording
+            logger.info('No more frames')
+            mi48.stop()
+            cv.destroyAllWindows()
+            if vs is not None:
+                vs.stop()
+            break
         frame = data_to_frame(raw_data, (mi48.cols, mi48.rows), hflip=True)
         # update min/max Rolling Average values and clip data
         Tmin, Tmax = RA_Tmin(frame.min()), RA_Tmax(frame.max())
@@ -0,0 +1,78 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# Stream frames from the in-process MI48 emulator through the unmodified
+# MI48, I2C_Interface and SPI_Interface, and report throughput figures.
+# No hardware is needed; use it to benchmark the host-side code.
+#
+import os
+import time
+import argparse
+import logging
+import numpy as np
+
+from senxor.mi48 import MI48, format_header, format_framestats
+from senxor.interfaces import SPI_Interface, I2C_Interface
+from senxor.emulator import MI48Emulator, EmulatedSMBus, EmulatedSpiDev,\
+                            EmulatedDataReady
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-fps', '--framerate', default=25, type=float,
+                        help='Frame rate', dest='fps')
+    parser.add_argument('-n', '--nframes', default=100, type=int,
+                        help='Number of frames to stream')
+    parser.add_argument('-t', '--camera-type', default=1, type=int,
+                        dest='camera_type',
+                        help='SENXOR_TYPE: 1 for 80x62, 8 for 160x120')
+    parser.add_argument('-x', '--xfer-size', default=160, type=int,
+                        dest='xfer_size',
+                        help='SPI transfer size in bytes; 0 for entire frame')
+    parser.add_argument('--i2c-latency', default=0.0002, type=float,
+                        dest='i2c_latency', help='Seconds per I2C transaction')
+    parser.add_argument('--spi-hz', default=31200000, type=int,
+                        dest='spi_hz', help='SPI clock frequency')
+    args = parser.parse_args()
+    return args
+
+
+args = parse_args()
+
+emulator = MI48Emulator(camera_type=args.camera_type,
+                        i2c_latency=args.i2c_latency, spi_hz=args.spi_hz)
+i2c = I2C_Interface(EmulatedSMBus(emulator), 0x40)
+spi = SPI_Interface(EmulatedSpiDev(emulator),
+                    xfer_size=args.xfer_size or None)
+
+t0 = time.monotonic()
+mi48 = MI48([i2c, spi], data_ready=EmulatedDataReady(emulator),
+            reset_handler=emulator.reset)
+t_init = time.monotonic() - t0
+logger.info(mi48.camera_info)
+logger.info('Initialisation: {:.1f} ms, {} I2C transactions'.
+            format(1.e3 * t_init, emulator.i2c_transactions))
+
+mi48.set_fps(args.fps)
+mi48.start(stream=True, with_header=True)
+
+bus_time = np.zeros(args.nframes)
+# temperature frame, reused by every read
+data = np.empty(int(np.prod(mi48.fpa_shape)), dtype=np.float32)
+t0 = time.monotonic()
+for i in range(args.nframes):
+    mi48.data_ready.wait_for_active()
+    data, header = mi48.read(out=data)
+    bus_time[i] = spi.bus_time
+    logger.debug('  '.join([format_header(header), format_framestats(data)]))
+elapsed = time.monotonic() - t0
+mi48.stop()
+
+logger.info('{} frames in {:.2f} s: {:.2f} FPS'.
+            format(args.nframes, elapsed, args.nframes / elapsed))
+logger.info('SPI bus time per frame: {:.2f} ms mean, {:.2f} ms max; {:.1f} MB/s'.
+            format(1.e3 * bus_time.mean(), 1.e3 * bus_time.max(),
+                   1.e-6 * spi.bytes_per_second))
+logger.info('Frames produced by emulator: {}, read: {}'.
+            format(emulator.frame_counter, emulator.frames_read))
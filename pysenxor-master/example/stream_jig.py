@@ -10,25 +10,23 @@ import cv2 as cv
 
 from senxor.mi48 import MI48, format_header, format_framestats
 from senxor.utils import data_to_frame, remap, cv_filter, cv_render
-from senxor.interfaces import MI_VID, MI_PIDs, USB_Interface
-import serial
-from serial.tools import list_ports
+from senxor.fleet import CameraFleet
 
 # This will enable mi48 logging debug messages
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "DEBUG"))
 
 
-# Make the a global variable and use it as an instance of the mi48.
+# Make the a global variable and use it as an instance of the fleet.
 # This allows it to be used directly in a signal_handler.
-global mi48
+global fleet
 
 # define a signal handler to ensure clean closure upon CTRL+C
 # or kill from terminal
 def signal_handler(sig, frame):
     """Ensure clean exit in case of SIGINT or SIGTERM"""
     logger.info("Exiting due to SIGINT or SIGTERM")
-    mi48.stop()
+    fleet.stop()
     cv.destroyAllWindows()
     logger.info("Done.")
     sys.exit(0)
@@ -38,53 +36,20 @@ signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
 # ==============================
-# create an USB interface object
+# connect to all cameras on the jig
 # ==============================
-def connect_senxor(socket_id=13, raw=False):
-    """
-    Attempt to connect to senxor, return an instance of the MI48.
-
-    `socket_id` is the jig socket, enumerated from 1 - top left, to 25 - bottom right.
-
-    If `raw`, then the stream will contain uint16 deci-Kelvin,
-    else the stream will be float temperature in Celsius.
-    """
-    dev_list = []
-    vcom_list = []
-    for p in list_ports.comports():
-        if p.vid == MI_VID and p.pid in MI_PIDs:
-            dev_list.append(p.device)
-            vcom_list.append(p.description.split()[-1][1:-1])
-
-    if not dev_list:
-        raise RuntimeError('No SenXor connected')
-
-    for dev, com in zip(dev_list, vcom_list):
-        try:
-            ser = serial.Serial(dev)
-            ser.baudrate = 115200
-            ser.rtscts = True
-            ser.dsrdtr = True
-            ser.timeout = 0.5
-            ser.write_timeout = 0.5
-            usb = USB_Interface(ser)
-            mi48 = MI48([usb,usb], name=com, read_raw=raw)
-            mi48.powerup()
-            time.sleep(0.5)
-            sid = mi48.get_evk_socket_id()
-            logger.info(f'socket_id {sid}, port {com}')
-            if sid  == socket_id: break
-            else: continue
-        except serial.SerialException:
-            logger.critical(f'Failed opening {dev}')
-            raise
-    # here we already have gotten a serial device; set it up
-    logging.debug(f'{mi48.sn} in socket {socket_id} connected to {com}')
-    mi48.get_camera_info()
-    return mi48
-
-
-mi48 = connect_senxor(socket_id=18)
+# all ports are opened concurrently, and each camera is identified by
+# its jig socket, enumerated from 1 - top left, to 25 - bottom right.
+SOCKET_ID = 18
+fleet = CameraFleet(raw=False)
+fleet.discover(powerup=True)
+if SOCKET_ID not in fleet.cameras:
+    logger.critical(f'No SenXor in socket {SOCKET_ID}')
+    fleet.stop()
+    sys.exit(1)
+mi48 = fleet.cameras[SOCKET_ID]
+logging.debug(f'{mi48.sn} in socket {SOCKET_ID} connected to '
+              f'{fleet.ports[SOCKET_ID]}')
 
 #sys.exit(0)
 
@@ -94,16 +59,17 @@ if len(sys.argv) == 2:
     STREAM_FPS = int(sys.argv[1])
 else:
     STREAM_FPS = 9
-mi48.set_fps(STREAM_FPS)
 
-# see if filtering is available in MI48 and set it up
-mi48.disable_filter(f1=True, f2=True, f3=True)
-mi48.enable_filter(f1=True, f2=False, f3=False, f3_ks_5=False)
-mi48.set_offset_corr(0.0)
+def configure(mi48):
+    """Set up filtering of every camera"""
+    mi48.disable_filter(f1=True, f2=True, f3=True)
+    mi48.enable_filter(f1=True, f2=False, f3=False, f3_ks_5=False)
+    mi48.set_offset_corr(0.0)
 
-# initiate continuous frame acquisition
+# initiate continuous frame acquisition on all cameras, each read
+# into its own frame ring by its own thread
 with_header = True
-mi48.start(stream=True, with_header=with_header)
+fleet.start(fps=STREAM_FPS, with_header=with_header, configure=configure)
 
 # change this to false if not interested in the image
 GUI = True
@@ -111,12 +77,16 @@ GUI = True
 # set cv_filter parameters
 par = {'blur_ks':5, 'd':5, 'sigmaColor': 27, 'sigmaSpace': 27}
 
+t_stats = time.monotonic()
 while True:
-    data, header = mi48.read()
+    data, header = fleet.read(SOCKET_ID, timeout=1.0)
     if data is None:
         logger.critical('NONE data received instead of GFRA')
-        mi48.stop()
+        fleet.stop()
         sys.exit(1)
+    if time.monotonic() - t_stats > 5:
+        logger.info(fleet.stats()['total'])
+        t_stats = time.monotonic()
 
     frame = data_to_frame(data, (80,62), hflip=True);
     filt_uint8 = cv_filter(remap(frame), par, use_median=True,
@@ -136,5 +106,5 @@ while True:
 #    time.sleep(1)
 
 # stop capture and quit
-mi48.stop()
+fleet.stop()
 cv.destroyAllWindows()
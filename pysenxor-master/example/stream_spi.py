@@ -23,9 +23,13 @@ import numpy as np
 
 import cv2 as cv
 
-from senxor.mi48 import MI48, DATA_READY, format_header, format_framestats
+from senxor.mi48 import MI48, format_header, format_framestats
 from senxor.utils import data_to_frame, cv_filter
 from senxor.interfaces import SPI_Interface, I2C_Interface
+from senxor.grabber import FrameGrabber
+from senxor.recording import RecordingWriter, camera_metadata
+from senxor.gpio import DataReadyEdge
+from senxor.poller import StatusPoller
 
 # This will enable mi48 logging debug messages
 logger = logging.getLogger(__name__)
@@ -34,11 +38,15 @@ logging.basicConfig(level=os.environ.get("LOGLEVEL", "DEBUG"))
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', '--record', default=False, dest='record',
-                        action='store_true', help='Record data'),
+                        action='store_true',
+                        help='Record raw frames to a binary recording'),
     parser.add_argument('-fps', '--framerate', default=7,
                         type=float, help='Bobcat framerate', dest='fps')
     parser.add_argument('-c', '--colormap', default='rainbow2', type=str,
                         help='Colormap')
+    parser.add_argument('-t', '--threaded', default=False, dest='threaded',
+                        action='store_true',
+                        help='Acquire frames in a background thread')
     args = parser.parse_args()
     return args
 
@@ -51,37 +59,6 @@ def get_filename(tag, ext=None):
         filename += '.{}'.format(ext)
     return filename
 
-def write_frame(outfile, arr):
-    """Write a numpy array as a row in a file, using C ordering.
-
-    Assume that filename is already created and available.
-    """
-    #
-    if arr.dtype == np.uint16:
-        outstr = ('{:n} '*arr.size).format(*arr.ravel(order='C')) + '\n'
-    else:
-        outstr = ('{:.2f} '*arr.size).format(*arr.ravel(order='C')) + '\n'
-    try:
-        # assume outfile is a handle to a file open for write
-        outfile.write(outstr)
-        # we have a relatively large outstr (~5K * 7ASCII chars per pixel)
-        # since the OS has by default ~8KB buffer, it will be good to
-        # flush so as to not output incomplete frame to the file
-        # (which may happen if we early terminate for some reason)
-        # or else it may lead to partially output frame and problems
-        # upon read.
-        outfile.flush()
-        return None
-    except AttributeError:
-        # assume outfile is a name to a file
-        # this should automatically flush the buffer
-        with open(outfile, 'a') as fh:
-            fh.write(outstr)
-        return None
-    except IOError:
-        logger.critical('Cannot write to {} (IOError)'.format(outfile))
-        sys.exit(106)
-
 def cv_display(img, title='', resize=(320, 248),
                colormap=cv.COLORMAP_JET, interpolation=cv.INTER_CUBIC):
 #               colormap=cv.COLORMAP_JET, interpolation=cv.INTER_LINEAR):
@@ -148,11 +125,20 @@ def close_all_interfaces():
     except NameError:
         pass
 
+# background frame grabber, if requested by --threaded
+grabber = None
+# binary recording, if requested by --record
+recorder = None
+
 # define a signal handler to ensure clean closure upon CTRL+C
 # or kill from terminal
 def signal_handler(sig, frame):
     """Ensure clean exit in case of SIGINT or SIGTERM"""
     logger.info("Exiting due to SIGINT or SIGTERM")
+    if grabber is not None:
+        grabber.stop()
+    if recorder is not None:
+        recorder.close()
     mi48.stop(poll_timeout=0.25, stop_timeout=1.2)
     time.sleep(0.5)
     cv.destroyAllWindows()
@@ -213,7 +199,14 @@ mi48_spi_cs_n = DigitalOutputDevice("BCM7", active_high=False,
 # Change this to False to test DATA_READY flag, instead of pin
 use_data_ready_pin = True
 if use_data_ready_pin:
-    mi48_data_ready = DigitalInputDevice("BCM24", pull_up=False)
+    try:
+        # wake up on the rising edge, timestamped by the kernel
+        mi48_data_ready = DataReadyEdge(24)
+    except RuntimeError as e:
+        logger.warning('{}; using gpiozero'.format(e))
+        mi48_data_ready = DigitalInputDevice("BCM24", pull_up=False)
+else:
+    mi48_data_ready = None
 
 # connect the reset line to allow to drive it by SW (GPIO23, J8:16)
 mi48_reset_n = DigitalOutputDevice("BCM23", active_high=False,
@@ -268,40 +261,73 @@ if int(mi48.fw_version[0]) >= 2:
 # initiate continuous frame acquisition
 with_header = True
 
-# enable saving to a file
+# enable saving to a file; see senxor.recording.RecordingReader
 if args.record:
     filename = get_filename(mi48.camera_id_hex)
-    fd_data = open(os.path.join('.', filename+'.dat'), 'w')
+    recorder = RecordingWriter(os.path.join('.', filename+'.sxr'),
+                               mi48.fpa_shape,
+                               metadata=camera_metadata(mi48))
 
 mi48.start(stream=True, with_header=with_header)
 
+# without the pin, poll STATUS.DATA_READY (fw 2.1.X+) around the
+# expected frame times
+poller = None
+if not hasattr(mi48, 'data_ready') and not args.threaded:
+    poller = StatusPoller(mi48)
+
+# optionally, hand over waiting for DATA_READY and reading the frames
+# to a background thread, so that a slow display does not delay readout
+if args.threaded:
+    grabber = FrameGrabber(mi48, nslots=4, policy='drop-oldest',
+                           chip_select=mi48_spi_cs_n,
+                           cs_delay=MI48_SPI_CS_DELAY,
+                           recorder=recorder)
+    grabber.start()
+
 # change this to false if not interested in the image
 GUI = True
 
 while True:
-    # wait for data_ready pin (or poll for STATUS.DATA_READY /fw 2.1.X+)
-    if hasattr(mi48, 'data_ready'):
-        mi48.data_ready.wait_for_active()
+    if grabber is not None:
+        data, header = grabber.read(timeout=1.0)
     else:
-        data_ready = False
-        while not data_ready:
-            time.sleep(0.01)
-            data_ready = mi48.get_status() & DATA_READY
-    # read the frame
-    # assert the spi_cs, delay a bit then read
-    mi48_spi_cs_n.on()
-    time.sleep(MI48_SPI_CS_DELAY)
-    data, header = mi48.read()
+        # wait for data_ready pin (or poll for STATUS.DATA_READY /fw 2.1.X+)
+        timestamp = None
+        if hasattr(mi48, 'data_ready'):
+            mi48.data_ready.wait_for_active()
+            timestamp = getattr(mi48.data_ready, 'timestamp', None)
+        else:
+            poller.wait_for_active()
+            timestamp = poller.timestamp
+        # read the frame
+        # assert the spi_cs, delay a bit then read
+        mi48_spi_cs_n.on()
+        time.sleep(MI48_SPI_CS_DELAY)
+        raw = mi48.read_words()
+        # delay a bit, then deassert spi_cs
+        time.sleep(MI48_SPI_CS_DELAY)
+        mi48_spi_cs_n.off()
+        if raw is None:
+            data = None
+        else:
+            # record the raw frame, before conversion to degrees C
+            data, header = mi48.parse_frame(raw)
+            if poller is not None:
+                poller.update(header)
+            if recorder is not None:
+                recorder.append(data, header, timestamp)
+            data = mi48.convert_data(data)
+    if grabber is not None:
+        timestamp = grabber.timestamp
     if data is None:
         logger.critical('NONE data received instead of GFRA')
+        if grabber is not None:
+            grabber.stop()
+        if recorder is not None:
+            recorder.close()
         mi48.stop(stop_timeout=1.0)
         sys.exit(1)
-    # delay a bit, then deassert spi_cs
-    time.sleep(MI48_SPI_CS_DELAY)
-    mi48_spi_cs_n.off()
-
-    if args.record:
-        write_frame(fd_data, data)
 
     img = data_to_frame(data, mi48.fpa_shape)
     #
@@ -310,6 +336,10 @@ while True:
                                 format_framestats(data)]))
     else:
         logger.debug(format_framestats(data))
+    if timestamp is not None:
+        # from DATA_READY to the frame in hand
+        logger.debug('latency {:.2f} ms'.
+                     format(1.e3 * (time.time() - timestamp)))
 
     img8u = cv.normalize(img.astype('uint8'), None, 255, 0,
                          norm_type=cv.NORM_MINMAX,
@@ -323,10 +353,14 @@ while True:
 #    time.sleep(1)
 
 # stop capture and quit
+if grabber is not None:
+    logger.info(grabber.stats())
+    grabber.stop()
+if recorder is not None:
+    recorder.close()
+if hasattr(mi48_data_ready, 'stats'):
+    logger.info(mi48_data_ready.stats())
+if poller is not None:
+    logger.info(poller.stats())
 mi48.stop(stop_timeout=0.5)
-try:
-    fd_data.close()
-except NameError:
-    # file descriptor was closed or never created
-    pass
 cv.destroyAllWindows()
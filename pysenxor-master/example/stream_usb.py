@@ -58,15 +58,18 @@ if len(sys.argv) == 2:
     STREAM_FPS = int(sys.argv[1])
 else:
     STREAM_FPS = 15
-mi48.set_fps(STREAM_FPS)
 
-# see if filtering is available in MI48 and set it up
-mi48.disable_filter(f1=True, f2=True, f3=True)
-mi48.set_filter_1(85)
-mi48.enable_filter(f1=True, f2=False, f3=False, f3_ks_5=False)
-mi48.set_offset_corr(0.0)
+# send the configuration in one batch of pipelined register writes
+with mi48.batch():
+    mi48.set_fps(STREAM_FPS)
 
-mi48.set_sens_factor(100)
+    # see if filtering is available in MI48 and set it up
+    mi48.disable_filter(f1=True, f2=True, f3=True)
+    mi48.set_filter_1(85)
+    mi48.enable_filter(f1=True, f2=False, f3=False, f3_ks_5=False)
+    mi48.set_offset_corr(0.0)
+
+    mi48.set_sens_factor(100)
 mi48.get_sens_factor()
 
 # initiate continuous frame acquisition
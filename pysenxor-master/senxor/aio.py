@@ -0,0 +1,481 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# asyncio API for MI48 over USB serial.
+#
+# The serial port of each camera is registered with the event loop
+# (loop.add_reader), so that one loop serves any number of cameras
+# without a thread per device. Acks are parsed incrementally by a
+# USBAckFramer, as bytes arrive, and routed as by USBDemux: frames to a
+# queue, register acks to the futures of the commands waiting for them.
+#
+import os
+import time
+import asyncio
+import logging
+import functools
+from collections import deque
+import numpy as np
+
+from senxor.mi48 import MI48, regmap, logger_wrapper, CAMERA_INFO_REGS,\
+                        MI48_SENXOR_ID_LEN, POLL_MIN_INTERVAL,\
+                        POLL_MAX_INTERVAL, BOOTING_UP, GET_SINGLE_FRAME,\
+                        CONTINUOUS_STREAM, NO_HEADER
+from senxor.crc import CRCVerifier
+from senxor.interfaces import USBAckFramer, usb_parse_ack, usb_rreg_cmd,\
+                              usb_wreg_cmd, fmt_usb_cmd, open_serial,\
+                              is_verifiable_write, unconfirmed_writes
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncUSBInterface:
+    """
+    Control and data interface of an MI48 over USB, for asyncio.
+
+    The port must be a non-blocking serial port with a file descriptor,
+    e.g. of open_serial(). Bytes are read by a reader callback of the
+    event loop, as soon as they arrive, and acks are routed:
+
+    * 'GFRA' -- the frame is queued; if `nframes` are queued already,
+      the oldest one is dropped
+    * 'RREG', 'WREG' -- to the oldest pending command of the same type
+    * 'SERR' -- to the oldest pending command, which is then resent
+
+    A command with no ack within `ack_timeout` seconds is resent, up to
+    `retries` times, see USBDemux. Commands are short, and are written
+    to the port directly.
+    """
+    def __init__(self, port, loop=None, nframes=8, ack_timeout=0.25,
+                 retries=10, read_size=1 << 16):
+        self.port = port
+        self.loop = loop if loop is not None else \
+            asyncio.get_running_loop()
+        self.log = logger
+        self.framer = USBAckFramer()
+        self.nframes = nframes
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.read_size = read_size
+        self._fd = port.fileno()
+        self._pending = deque()     # (cmd, future)
+        self._frames = deque()
+        self._frame_waiter = None
+        self.error = None
+        # counters
+        self.frames_in = 0
+        self.frames_dropped = 0
+        self.resends = 0
+        self.batch_failures = 0
+        self.unmatched = 0
+        self.loop.add_reader(self._fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, self.read_size)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._fail(e)
+            return
+        if not data:
+            self._fail(ConnectionError('Port closed by the device'))
+            return
+        self.framer.feed(data)
+        ack = self.framer.next_ack()
+        while ack is not None:
+            self._route(ack)
+            ack = self.framer.next_ack()
+
+    def _route(self, ack):
+        cmd, data = ack
+        if cmd == b'GFRA':
+            if len(self._frames) >= self.nframes:
+                self._frames.popleft()
+                self.frames_dropped += 1
+            # copy out of the framer buffer, which is reused
+            self._frames.append(np.frombuffer(data, dtype='u2').copy())
+            self.frames_in += 1
+            self._wake_reader()
+            return
+        cmd, data = usb_parse_ack(cmd, data)
+        for pending in self._pending:
+            _cmd, future = pending
+            if future.done():
+                # timed out, see command()
+                continue
+            if _cmd == cmd or cmd == 'SERR':
+                future.set_result((cmd, data))
+                self._pending.remove(pending)
+                return
+        # e.g. the late ack to a command that was resent
+        self.log.debug('Unexpected {} ACK: {}'.format(cmd, data))
+        self.unmatched += 1
+
+    def _wake_reader(self):
+        if self._frame_waiter is not None and not self._frame_waiter.done():
+            self._frame_waiter.set_result(None)
+
+    def _fail(self, exc):
+        """Stop reading the port, and fail all waiting commands"""
+        self.log.error('Port read failed: {}'.format(exc))
+        self.error = exc
+        self.loop.remove_reader(self._fd)
+        while self._pending:
+            _, future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(exc)
+        self._wake_reader()
+
+    def _post(self, cmds):
+        """Send host commands; return the futures of their acks"""
+        if self.error is not None:
+            raise self.error
+        futures = []
+        for cmd in cmds:
+            future = self.loop.create_future()
+            self._pending.append((cmd[8:12], future))
+            futures.append(future)
+        self.port.write(''.join(cmds).encode())
+        return futures
+
+    def _drop_pending(self, futures):
+        for future in futures:
+            future.cancel()
+        self._pending = deque(p for p in self._pending if not p[1].done())
+
+    async def command(self, cmd: str):
+        """Send a host command and return the (cmd, data) of its ack"""
+        for _ in range(self.retries + 1):
+            future, = self._post([cmd])
+            try:
+                result = await asyncio.wait_for(future, self.ack_timeout)
+            except asyncio.TimeoutError:
+                self._drop_pending([future])
+                result = None
+            if result is not None and result[0] != 'SERR':
+                return result
+            self.log.debug('No ACK to {}: {}; resending'.
+                           format(cmd[8:12], result))
+            self.resends += 1
+        raise TimeoutError('No ACK to {} after {} attempts'.
+                           format(cmd[8:12], self.retries + 1))
+
+    async def command_batch(self, cmds):
+        """Send host commands back to back, then wait for all their acks.
+
+        Return a list of (cmd, data) acks in the order of `cmds`, or None
+        if any ack is missing or SERR; see USBDemux.command_batch().
+        """
+        futures = self._post(cmds)
+        done, _ = await asyncio.wait(futures, timeout=self.ack_timeout)
+        if len(done) == len(futures):
+            results = [future.result() for future in futures]
+            if all(cmd != 'SERR' for cmd, _ in results):
+                return results
+        self._drop_pending(futures)
+        self.log.debug('{} of {} ACKs to batch received'.
+                       format(len(done), len(futures)))
+        self.batch_failures += 1
+        return None
+
+    async def regread(self, reg, regname=""):
+        """Read a control/status register"""
+        cmd = usb_rreg_cmd(reg)
+        _, result = await self.command(cmd)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('{}'.format(fmt_usb_cmd(cmd, result)))
+        return result
+
+    async def regwrite(self, reg, value, regname=""):
+        """Write to a control register"""
+        cmd = usb_wreg_cmd(reg, value)
+        await self.command(cmd)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('{}'.format(fmt_usb_cmd(cmd, None)))
+        return None
+
+    async def regread_batch(self, regs):
+        """Read a list of registers with pipelined RREG commands.
+
+        Return a list of values. Fall back to one command at a time if
+        not all acks arrive.
+        """
+        cmds = [usb_rreg_cmd(reg) for reg in regs]
+        acks = await self.command_batch(cmds)
+        if acks is None:
+            return [await self.regread(reg) for reg in regs]
+        return [value for _, value in acks]
+
+    async def regwrite_batch(self, regs_values):
+        """Write a list of (reg, value) with pipelined WREG commands.
+
+        If acks are missing, the writes are verified and sent again as
+        in USB_Interface.regwrite_batch().
+        """
+        pending = list(regs_values)
+        for _ in range(self.retries + 1):
+            cmds = [usb_wreg_cmd(reg, value) for reg, value in pending]
+            if await self.command_batch(cmds) is not None:
+                return None
+            regs = sorted(set(reg for reg, _ in pending
+                              if is_verifiable_write(reg)))
+            readback = dict(zip(regs, await self.regread_batch(regs)))\
+                       if regs else {}
+            pending = unconfirmed_writes(pending, readback)
+            if not pending:
+                return None
+        raise TimeoutError('Batched register writes failed: {}'.
+                           format(pending))
+
+    async def read(self, size_in_words, out=None):
+        """Return the oldest queued frame, without the USB header.
+
+        The frame is a 1-D array of uint16, copied into `out` if given.
+        Return None if the port failed.
+        """
+        while not self._frames:
+            if self.error is not None:
+                return None
+            self._frame_waiter = self.loop.create_future()
+            try:
+                await self._frame_waiter
+            finally:
+                self._frame_waiter = None
+        frame = self._frames.popleft()
+        if out is None:
+            return frame[-size_in_words:]
+        np.copyto(out, frame[-size_in_words:])
+        return out
+
+    def reset(self):
+        """Discard buffered bytes and queued frames"""
+        self.framer.reset()
+        self._frames.clear()
+
+    def close(self):
+        """Stop reading the port, and close it"""
+        if self.error is None:
+            self.loop.remove_reader(self._fd)
+            self.error = ConnectionError('Port closed')
+            self._wake_reader()
+        while self._pending:
+            _, future = self._pending.popleft()
+            future.cancel()
+        self.port.close()
+
+
+class AsyncMI48:
+    """
+    MI48 over USB, with awaitable register access and frame reading.
+
+    Usage:
+
+        async def main(devices):
+            cameras = await asyncio.gather(
+                *[AsyncMI48.connect(device) for device in devices])
+            for mi48 in cameras:
+                await mi48.set_fps(9)
+                await mi48.start(stream=True, with_header=True)
+            async for data, header in cameras[0].stream():
+                ...
+
+    Frames are parsed, CRC-checked and converted as by MI48 (the
+    methods are shared), with `read_raw`, `dtype` and `crc` as of MI48.
+    Registers are not shadowed; each access is a USB round trip, while
+    other cameras keep streaming on the same loop.
+    """
+    def __init__(self, interface, name="MI48", read_raw=False,
+                 dtype=np.float16, crc='every'):
+        self.interface = interface
+        self.name = name
+        self.log = functools.partial(logger_wrapper, self.name, logger=None)
+        self.read_raw = read_raw
+        self.dtype = np.dtype(dtype)
+        if isinstance(crc, str):
+            crc = CRCVerifier(crc)
+        self.crc_verifier = crc
+        self.crc_error = False
+        self.parse_header = True
+        self.capture_no_header = False
+        self.fpa_shape = None
+        self.settle_times = {}
+
+    # frame handling is that of MI48
+    get_frame_size = MI48.get_frame_size
+    parse_frame = MI48.parse_frame
+    parse_frame_header = MI48.parse_frame_header
+    convert_data = MI48.convert_data
+    get_max_fps = MI48.get_max_fps
+    _set_camera_info = MI48._set_camera_info
+
+    @classmethod
+    async def connect(cls, device, name=None, powerup=False, **kwargs):
+        """Open the serial `device` and return an initialised AsyncMI48.
+
+        Other arguments are as of AsyncMI48() and initialise().
+        """
+        port = open_serial(device)
+        try:
+            mi48 = cls(AsyncUSBInterface(port), name=name or str(device),
+                       **kwargs)
+            await mi48.initialise(powerup=powerup)
+        except BaseException:
+            port.close()
+            raise
+        return mi48
+
+    async def initialise(self, powerup=False, boot_timeout=2.0):
+        """Stop any capture, read the camera info and wait for boot-up"""
+        t0 = time.monotonic()
+        # do not parse frame header if MI48 is not on the core dev board
+        self.parse_header = await self.regread('EVK_TEST') == 0xFF
+        if powerup or not self.parse_header:
+            await self.regwrite('SENXOR_POWERUP', 0x13)
+        mode = await self.regread('FRAME_MODE')
+        if mode & (GET_SINGLE_FRAME | CONTINUOUS_STREAM):
+            mode = await self.stop_capture()
+        self.camera_info = await self.get_camera_info()
+        status, booted = await self._poll(
+            'bootup', lambda: self.regread('STATUS'),
+            lambda st: not st & BOOTING_UP, boot_timeout)
+        if not booted:
+            self.log(logging.ERROR, 'Bootup not complete in {:.0f} ms'.
+                     format(1.e3 * boot_timeout))
+        # residual frames of an earlier capture
+        self.interface.reset()
+        self.capture_no_header = bool(mode & NO_HEADER)
+        self.log(logging.DEBUG, 'Initialised in {:.1f} ms'.
+                 format(1.e3 * (time.monotonic() - t0)))
+
+    async def _poll(self, phase, read, done, timeout,
+                    max_interval=POLL_MAX_INTERVAL):
+        """Await `read()` until `done(value)` or `timeout`; see MI48._poll()"""
+        t0 = time.monotonic()
+        deadline = t0 + timeout
+        interval = POLL_MIN_INTERVAL
+        value = await read()
+        while not done(value):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(2 * interval, max_interval)
+            value = await read()
+        self.settle_times[phase] = time.monotonic() - t0
+        return value, bool(done(value))
+
+    async def regread(self, reg):
+        """Read a control/status register, given by name or address"""
+        if isinstance(reg, str):
+            return await self.interface.regread(regmap[reg], reg)
+        return await self.interface.regread(reg)
+
+    async def regwrite(self, reg, value):
+        """Write to a control register, given by name or address"""
+        if isinstance(reg, str):
+            reg = regmap[reg]
+        return await self.interface.regwrite(reg, value)
+
+    async def regread_many(self, regs):
+        """Read a list of registers, pipelined; return a list of values"""
+        return await self.interface.regread_batch(
+            [regmap[reg] if isinstance(reg, str) else reg for reg in regs])
+
+    async def regwrite_many(self, regs_values):
+        """Write a list of (reg, value), pipelined"""
+        return await self.interface.regwrite_batch(
+            [(regmap[reg] if isinstance(reg, str) else reg, value)
+             for reg, value in regs_values])
+
+    async def get_camera_info(self):
+        """Get camera info: senxor type/ID, maxFPS, FW version"""
+        values = dict(zip(CAMERA_INFO_REGS,
+                          await self.regread_many(CAMERA_INFO_REGS)))
+        uid = [values['SENXOR_ID_{}'.format(i)]
+               for i in range(MI48_SENXOR_ID_LEN)]
+        uid_hex = bytearray(uid).hex()
+        fwv = values['FW_VERSION_1']
+        res = {
+            'NAME': self.name,
+            'CAMERA_TYPE': values['SENXOR_TYPE'],
+            'MODULE_TYPE': values['MODULE_TYPE'],
+            'EVK_ID': values['EVK_ID'],
+            'CAMERA_ID': uid_hex,
+            'CAMERA_MFG': '{}.{}.{}.{}'.format(2000 + uid[0], uid[1], uid[2],
+                                                bytearray(uid[3:]).hex()),
+            'SN': 'SN' + uid_hex,
+            'FW_VERSION': '{}.{}.{}'.format((fwv >> 4) & 0xF, fwv & 0xF,
+                                            values['FW_VERSION_2']),
+        }
+        self._set_camera_info(res)
+        res['Current FPS'] = self.maxfps / (values['FRAME_RATE'] or 1)
+        return res
+
+    async def get_fps(self):
+        """Get current FPS [1/s]"""
+        divisor = await self.regread('FRAME_RATE')
+        return float(self.maxfps) / (divisor or 1)
+
+    async def set_fps(self, fps):
+        """Set the desired FPS [1/s] or the closest possible"""
+        try:
+            fps_divisor = int(round(float(self.maxfps) / fps))
+        except ZeroDivisionError:
+            fps_divisor = 32
+        await self.regwrite('FRAME_RATE', fps_divisor)
+
+    async def start(self, stream=True, with_header=True):
+        """Start capture"""
+        mode = CONTINUOUS_STREAM if stream else GET_SINGLE_FRAME
+        if not with_header:
+            mode |= NO_HEADER
+        self.capture_no_header = not with_header
+        await self.regwrite('FRAME_MODE', mode)
+
+    async def stop_capture(self, poll_timeout=0.1, stop_timeout=0.3):
+        """Stop capture, and wait until the MI48 has stopped"""
+        mode = await self.regread('FRAME_MODE')
+        await self.regwrite('FRAME_MODE', mode &
+                            (~(GET_SINGLE_FRAME | CONTINUOUS_STREAM) & 0xFF))
+        mode, stopped = await self._poll(
+            'stop_capture', lambda: self.regread('FRAME_MODE'),
+            lambda m: not m & (GET_SINGLE_FRAME | CONTINUOUS_STREAM),
+            stop_timeout, max_interval=poll_timeout)
+        if not stopped:
+            self.log(logging.DEBUG, 'Camera module failed to stop in '
+                     '{:.0f} ms'.format(1.e3 * stop_timeout))
+        return mode
+
+    async def stop(self):
+        """Stop capture and close the port"""
+        try:
+            if self.interface.error is None:
+                await self.stop_capture()
+        finally:
+            self.interface.close()
+            self.crc_verifier.close()
+
+    async def read(self, out=None):
+        """Read a data frame; return (data, header), see MI48.read()
+
+        Return (None, None) if the port failed or was closed.
+        """
+        response = await self.interface.read(self.get_frame_size())
+        if response is None:
+            return None, None
+        data, header = self.parse_frame(response)
+        return self.convert_data(data, out=out), header
+
+    async def stream(self):
+        """Yield (data, header) of every frame, until the port closes"""
+        while True:
+            data, header = await self.read()
+            if data is None:
+                return
+            yield data, header
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
@@ -0,0 +1,430 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# Compressed archive of MI48 frames, for long-term storage.
+#
+# File layout:
+#   preamble (see senxor.recording) | chunk | chunk | ... | index | trailer
+#
+# A chunk holds up to `chunk_frames` consecutive frames:
+#   chunk header (CHUNK_HEADER) | compressed payload
+# and the payload, before compression, is
+#   headers (HEADER_DTYPE_LE) | host times (float64) | encoded frames
+#
+# Frames are encoded as the first frame of the chunk followed by the
+# differences between consecutive frames, zigzag encoded so that small
+# negative differences are small numbers too, and byte-shuffled: all
+# low bytes first, then all high bytes, which are mostly zero.
+#
+# The index of chunks is written by ArchiveWriter.close(), followed by
+# the trailer. If it is missing, e.g. the writer did not terminate,
+# the reader rebuilds it by scanning the chunks.
+#
+import lzma
+import zlib
+import time
+import struct
+import logging
+import functools
+import numpy as np
+
+from senxor.mi48 import dK_to_C_table
+from senxor.recording import HEADER_DTYPE_LE, RecordingReader,\
+                             write_preamble, read_preamble
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_MAGIC = b'SXARCv1\x00'
+ARCHIVE_VERSION = 1
+
+# magic, number of frames, payload size, CRC-32 of payload
+CHUNK_HEADER = struct.Struct('<4sIII')
+CHUNK_MAGIC = b'SXCK'
+# magic, number of chunks; followed by the index array
+INDEX_HEADER = struct.Struct('<4sI')
+INDEX_MAGIC = b'SXIX'
+# offset of the index header, magic
+TRAILER = struct.Struct('<Q4s')
+TRAILER_MAGIC = b'SXIE'
+
+INDEX_DTYPE = np.dtype([
+    ('offset', '<u8'),          # of the chunk header in the file
+    ('first', '<u8'),           # number of the first frame of the chunk
+    ('nframes', '<u4'),
+    ('frame_counter', '<u2'),   # of the first frame
+    ('timestamp', '<u4'),       # of the first frame [ms]
+    ('host_time', '<f8'),       # of the first frame
+])
+
+# name: (compress(data, level), decompress(data))
+CODECS = {
+    'zlib': (lambda data, level: zlib.compress(data, 6 if level is None
+                                               else level),
+             zlib.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level),
+             lzma.decompress),
+    'none': (lambda data, level: bytes(data), bytes),
+}
+
+
+def encode_frames(frames):
+    """Return the delta-encoded and byte-shuffled bytes of uint16 `frames`"""
+    frames = np.asarray(frames, dtype='<u2')
+    delta = np.empty_like(frames)
+    delta[:1] = frames[:1]
+    np.subtract(frames[1:], frames[:-1], out=delta[1:])
+    d = delta[1:].view(np.int16)
+    delta[1:] = ((d << 1) ^ (d >> 15)).view('<u2')
+    return delta.view(np.uint8).reshape(-1, 2).T.tobytes()
+
+def decode_frames(buf, nframes, data_size):
+    """Return the (nframes, data_size) uint16 frames of encode_frames()"""
+    planes = np.frombuffer(buf, dtype=np.uint8).reshape(2, -1)
+    delta = np.empty((nframes * data_size, 2), dtype=np.uint8)
+    delta.T[...] = planes
+    delta = delta.view('<u2').reshape(nframes, data_size)
+    z = delta[1:]
+    z[...] = (z >> 1) ^ (np.uint16(0) - (z & 1))
+    return np.cumsum(delta, axis=0, dtype=np.uint16)
+
+def _unwrap_counters(counters, first=None):
+    """Return uint16 frame `counters` unwrapped, as int64"""
+    counters = np.asarray(counters, dtype=np.int64)
+    out = np.empty_like(counters)
+    if len(counters):
+        out[0] = counters[0] if first is None else first
+        np.cumsum(np.diff(counters) % 65536, out=out[1:])
+        out[1:] += out[0]
+    return out
+
+
+class ArchiveWriter:
+    """
+    Write MI48 frames to a compressed, chunked archive.
+
+    Frames are collected in chunks of `chunk_frames`, which are
+    compressed by `codec` ('zlib', 'lzma' or 'none') at `level`
+    (codec default if None) and written when full. Compressing is
+    done in append() of the frame that completes a chunk; to archive
+    without slowing down acquisition, record with RecordingWriter and
+    archive the recording afterwards, see archive_recording().
+
+    Usage:
+
+        with ArchiveWriter('frames.sxa', mi48.fpa_shape) as arc:
+            arc.append(data, header)
+    """
+    def __init__(self, path, fpa_shape, metadata=None, chunk_frames=64,
+                 codec='zlib', level=None):
+        if codec not in CODECS:
+            raise ValueError('Codec must be one of {}'.format(list(CODECS)))
+        self.path = path
+        self.fpa_shape = tuple(int(n) for n in fpa_shape)
+        self.data_size = int(np.prod(self.fpa_shape))
+        self.chunk_frames = chunk_frames
+        self.codec = codec
+        self._compress = functools.partial(CODECS[codec][0], level=level)
+        self._data = np.zeros((chunk_frames, self.data_size), dtype=np.uint16)
+        self._headers = np.zeros(chunk_frames, dtype=HEADER_DTYPE_LE)
+        self._times = np.zeros(chunk_frames, dtype='<f8')
+        self._n = 0
+        self._index = []
+        self.nframes = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        meta = dict(metadata or {})
+        meta.update({
+            'version': ARCHIVE_VERSION,
+            'fpa_shape': list(self.fpa_shape),
+            'chunk_frames': chunk_frames,
+            'codec': codec,
+            'created': time.time(),
+        })
+        self._file = open(path, 'wb')
+        self._offset = write_preamble(self._file, ARCHIVE_MAGIC, meta)
+
+    def append(self, data, header=None, host_time=None):
+        """Archive a raw uint16 frame, its header and reception time.
+
+        Arguments are the same as of RecordingWriter.append().
+        """
+        if data.dtype != np.uint16:
+            raise TypeError('Only raw uint16 frames can be archived, not {}'.
+                            format(data.dtype))
+        n = self._n
+        self._data[n] = data.reshape(-1)
+        if header is None:
+            self._headers[n] = 0
+        else:
+            self._headers[n] = header
+        self._times[n] = time.time() if host_time is None else host_time
+        self._n = n + 1
+        if self._n == self.chunk_frames:
+            self._write_chunk()
+
+    def extend(self, data, headers, host_times):
+        """Archive a block of frames, e.g. of a RecordingReader"""
+        i = 0
+        while i < len(data):
+            n = self._n
+            m = min(self.chunk_frames - n, len(data) - i)
+            self._data[n: n + m] = data[i: i + m]
+            self._headers[n: n + m] = headers[i: i + m]
+            self._times[n: n + m] = host_times[i: i + m]
+            self._n = n + m
+            i += m
+            if self._n == self.chunk_frames:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        n = self._n
+        if not n:
+            return
+        payload = b''.join([self._headers[:n].tobytes(),
+                            self._times[:n].tobytes(),
+                            encode_frames(self._data[:n])])
+        compressed = self._compress(payload)
+        self._file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, n, len(compressed),
+                                           zlib.crc32(compressed)))
+        self._file.write(compressed)
+        header = self._headers[0]
+        self._index.append((self._offset, self.nframes, n,
+                            header['frame_counter'], header['timestamp'],
+                            self._times[0]))
+        self._offset += CHUNK_HEADER.size + len(compressed)
+        self.nframes += n
+        self.bytes_in += self._data[:n].nbytes
+        self.bytes_out += CHUNK_HEADER.size + len(compressed)
+        self._n = 0
+
+    def flush(self):
+        """Write the frames collected so far as a (short) chunk"""
+        self._write_chunk()
+        self._file.flush()
+
+    @property
+    def ratio(self):
+        """Compression ratio of the frames written so far"""
+        return self.bytes_in / self.bytes_out if self.bytes_out else 0.
+
+    def close(self):
+        """Write pending frames and the index, and close the file"""
+        if self._file.closed:
+            return
+        self._write_chunk()
+        index = np.array(self._index, dtype=INDEX_DTYPE)
+        self._file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(index)))
+        self._file.write(index.tobytes())
+        self._file.write(TRAILER.pack(self._offset, TRAILER_MAGIC))
+        self._file.close()
+        logger.debug('{}: {} frames archived, ratio {:.2f}'.
+                     format(self.path, self.nframes, self.ratio))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArchiveReader:
+    """
+    Random access to the frames of an archive of ArchiveWriter.
+
+    Only the chunk holding a requested frame is read and decompressed;
+    the last decoded chunk is kept, so that reading frames in order
+    decodes each chunk once.
+
+    Frames are found by (unwrapped) frame counter, device timestamp
+    or host time, see RecordingReader, by a binary search in the chunk
+    index, then in the chunk.
+
+    Usage:
+
+        arc = ArchiveReader('frames.sxa')
+        data, header = arc.frame(arc.find_time(t0, host=True))
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.metadata, self._data_offset = read_preamble(self._file,
+                                                         ARCHIVE_MAGIC)
+        if self.metadata.get('version') != ARCHIVE_VERSION:
+            raise ValueError('{}: unsupported archive version {}'.
+                             format(path, self.metadata.get('version')))
+        self.fpa_shape = tuple(self.metadata['fpa_shape'])
+        self.data_size = int(np.prod(self.fpa_shape))
+        self._decompress = CODECS[self.metadata['codec']][1]
+        self.index = self._read_index()
+        if self.index is None:
+            logger.warning('{}: no chunk index; rebuilding it'.format(path))
+            self.index = self._scan_index()
+        self._counters = _unwrap_counters(self.index['frame_counter'])
+        self._cached = None
+
+    def _read_index(self):
+        f = self._file
+        f.seek(0, 2)
+        size = f.tell()
+        if size < self._data_offset + TRAILER.size:
+            return None
+        f.seek(size - TRAILER.size)
+        offset, magic = TRAILER.unpack(f.read(TRAILER.size))
+        if magic != TRAILER_MAGIC:
+            return None
+        f.seek(offset)
+        magic, n = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+        if magic != INDEX_MAGIC:
+            return None
+        return np.frombuffer(f.read(n * INDEX_DTYPE.itemsize),
+                             dtype=INDEX_DTYPE)
+
+    def _scan_index(self):
+        """Rebuild the index from the chunks, up to the last complete one"""
+        index = []
+        offset = self._data_offset
+        first = 0
+        while True:
+            try:
+                n, payload = self._read_chunk(offset)
+            except ValueError:
+                break
+            headers, times, _ = self._split(payload, n)
+            index.append((offset, first, n, headers[0]['frame_counter'],
+                          headers[0]['timestamp'], times[0]))
+            offset += CHUNK_HEADER.size + len(payload)
+            first += n
+        return np.array(index, dtype=INDEX_DTYPE)
+
+    def _read_chunk(self, offset):
+        """Return (nframes, compressed payload) of the chunk at `offset`"""
+        f = self._file
+        f.seek(offset)
+        buf = f.read(CHUNK_HEADER.size)
+        if len(buf) < CHUNK_HEADER.size:
+            raise ValueError('Truncated chunk header')
+        magic, n, size, crc = CHUNK_HEADER.unpack(buf)
+        if magic != CHUNK_MAGIC:
+            raise ValueError('Bad chunk magic')
+        payload = f.read(size)
+        if len(payload) < size or zlib.crc32(payload) != crc:
+            raise ValueError('Corrupted chunk')
+        return n, payload
+
+    def _split(self, payload, n):
+        """Return (headers, host times, encoded frames) of a payload"""
+        payload = self._decompress(payload)
+        hsize = n * HEADER_DTYPE_LE.itemsize
+        headers = np.frombuffer(payload, dtype=HEADER_DTYPE_LE, count=n)
+        times = np.frombuffer(payload, dtype='<f8', count=n, offset=hsize)
+        return headers, times, payload[hsize + 8 * n:]
+
+    def __len__(self):
+        if not len(self.index):
+            return 0
+        return int(self.index['first'][-1] + self.index['nframes'][-1])
+
+    def __getitem__(self, i):
+        return self.frame(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.frame(i)
+
+    def chunk(self, k):
+        """Return (data, headers, host times) of chunk `k`"""
+        if self._cached is not None and self._cached[0] == k:
+            return self._cached[1]
+        n, payload = self._read_chunk(int(self.index['offset'][k]))
+        headers, times, frames = self._split(payload, n)
+        result = (decode_frames(frames, n, self.data_size), headers, times)
+        self._cached = (k, result)
+        return result
+
+    def _locate(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Frame {} out of range'.format(i))
+        k = int(np.searchsorted(self.index['first'], i, side='right')) - 1
+        return k, i - int(self.index['first'][k])
+
+    def frame(self, i, raw=False, dtype=np.float32):
+        """Return (data, header) of frame `i`, see RecordingReader.frame()"""
+        k, j = self._locate(i)
+        data, headers, _ = self.chunk(k)
+        data = data[j]
+        if not raw:
+            data = np.take(dK_to_C_table(dtype), data, mode='clip')
+        return data, headers[j]
+
+    def host_time(self, i):
+        """Return the time.time() of reception of frame `i`"""
+        k, j = self._locate(i)
+        return float(self.chunk(k)[2][j])
+
+    def frames(self, start=0, stop=None):
+        """Return (data, headers, host times) of frames start to stop"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        parts = ([], [], [])
+        i = start
+        while i < stop:
+            k, j = self._locate(i)
+            chunk = self.chunk(k)
+            m = min(len(chunk[0]), j + stop - i)
+            for part, arr in zip(parts, chunk):
+                part.append(arr[j:m])
+            i += m - j
+        if not parts[0]:
+            return (np.zeros((0, self.data_size), dtype=np.uint16),
+                    np.zeros(0, dtype=HEADER_DTYPE_LE), np.zeros(0))
+        return tuple(np.concatenate(part) for part in parts)
+
+    def find_frame(self, frame_counter):
+        """Return the frame of the (unwrapped) `frame_counter`, or None"""
+        k = int(np.searchsorted(self._counters, frame_counter,
+                                side='right')) - 1
+        if k < 0:
+            return None
+        _, headers, _ = self.chunk(k)
+        counters = _unwrap_counters(headers['frame_counter'],
+                                    first=self._counters[k])
+        j = np.flatnonzero(counters == frame_counter)
+        if not len(j):
+            return None
+        return int(self.index['first'][k]) + int(j[0])
+
+    def find_time(self, t, host=False):
+        """Return the first frame at or after time `t`; see RecordingReader"""
+        key = 'host_time' if host else 'timestamp'
+        k = int(np.searchsorted(self.index[key], t, side='right')) - 1
+        if k < 0:
+            return 0
+        _, headers, times = self.chunk(k)
+        times = times if host else headers['timestamp']
+        return int(self.index['first'][k]) + int(np.searchsorted(times, t))
+
+    def close(self):
+        self._file.close()
+        self._cached = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def archive_recording(src, dst, chunk_frames=64, codec='zlib', level=None):
+    """Archive the recording at path `src` (see senxor.recording) to `dst`
+
+    Return the compression ratio.
+    """
+    rec = RecordingReader(src)
+    metadata = dict(rec.metadata)
+    metadata.pop('record_size', None)
+    with ArchiveWriter(dst, rec.fpa_shape, metadata=metadata,
+                       chunk_frames=chunk_frames, codec=codec,
+                       level=level) as arc:
+        arc.extend(rec.data, rec.headers, rec.host_times)
+    rec.close()
+    return arc.ratio
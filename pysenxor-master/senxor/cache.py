@@ -0,0 +1,122 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    # not on Windows; only threads are locked out there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache',
+                                  'senxor', 'cameras.json')
+
+# one lock per cache file, shared by all CameraCache objects on it
+_LOCKS = {}
+_LOCKS_LOCK = threading.Lock()
+
+
+class CameraCache:
+    """
+    On-disk cache of camera info and control registers, for warm starts.
+
+    Entries are JSON-serialisable dictionaries, kept per control port
+    (e.g. a USB comport) and per camera found on it (SENXOR_ID in hex):
+
+        {port: {camera_id: entry}}
+
+    The file is rewritten atomically on every `put()` and `remove()`,
+    under a lock held across threads and, where fcntl is available,
+    across processes, by flock() on `path` + '.lock'.
+
+    Usage:
+
+        cache = CameraCache()
+        mi48 = MI48([usb, usb], cache=cache)
+        ...
+        mi48.stop()  # stores the last applied control registers
+    """
+    def __init__(self, path=DEFAULT_CACHE_FILE):
+        self.path = path
+        with _LOCKS_LOCK:
+            self._lock = _LOCKS.setdefault(os.path.abspath(path),
+                                           threading.Lock())
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the lock of the cache file, for read-modify-write"""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            with open(self.path + '.lock', 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self):
+        """Return the content of the cache file, {} if none or invalid"""
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring camera cache {}: {}'.format(self.path, e))
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def get(self, port, camera_id):
+        """Return the entry of `camera_id` on `port`, or None"""
+        return self.load().get(port, {}).get(camera_id)
+
+    def put(self, port, camera_id, entry):
+        """Store the entry of `camera_id` on `port`"""
+        entry = dict(entry, saved=time.time())
+        with self._locked():
+            entries = self.load()
+            entries.setdefault(port, {})[camera_id] = entry
+            self._save(entries)
+
+    def remove(self, port, camera_id=None):
+        """Drop the entry of `camera_id` on `port`, or all on `port`"""
+        with self._locked():
+            entries = self.load()
+            if camera_id is None:
+                entries.pop(port, None)
+            else:
+                entries.get(port, {}).pop(camera_id, None)
+            self._save(entries)
+
+    def _save(self, entries):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # a temp file of its own per call, in the same file system
+        fd, tmp = tempfile.mkstemp(dir=dirname or '.',
+                                   prefix=os.path.basename(self.path) + '.',
+                                   suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, indent=1)
+            os.replace(tmp, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
@@ -0,0 +1,331 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# CRC-16/CCITT-FALSE of MI48 frames:
+# polynomial = 0x11021, init=0xFFFF, reversed=False, xor-out=0x0000,
+# check=0x29B1 (for input of b'123456789)
+# The CRC covers the bytes of the temperature data as stored in host
+# memory, i.e. the same as crcmod computes over the frame array.
+#
+import time
+import queue
+import logging
+import threading
+from collections import deque
+import numpy as np
+
+try:
+    # the C extension of crcmod is the fastest for a single frame
+    import crcmod.predefined
+    _crcmod_crc16 = crcmod.predefined.mkCrcFun('crc-ccitt-false')
+except ImportError:
+    _crcmod_crc16 = None
+
+logger = logging.getLogger(__name__)
+
+CRC16_POLY = 0x1021
+CRC16_INIT = 0xFFFF
+
+# Verification policies of CRCVerifier
+VERIFY_EVERY = 'every'          # verify every frame on reception
+VERIFY_EVERY_N = 'every-n'      # verify one frame in n
+VERIFY_DEFERRED = 'deferred'    # verify in a worker thread, flag afterwards
+VERIFY_NONE = 'none'
+CRC_POLICIES = [VERIFY_EVERY, VERIFY_EVERY_N, VERIFY_DEFERRED, VERIFY_NONE]
+
+
+def _make_word_table():
+    """Return the table advancing the CRC register by 16 message bits"""
+    table = np.arange(65536, dtype=np.uint32)
+    for _ in range(16):
+        table = np.where(table & 0x8000, (table << 1) ^ CRC16_POLY, table << 1)
+        table &= 0xFFFF
+    return table.astype(np.uint16)
+
+# crc = CRC16_WORD_TABLE[crc ^ word], word being two message bytes, MSB first
+CRC16_WORD_TABLE = _make_word_table()
+CRC16_WORD_TABLE.flags.writeable = False
+
+
+class _Plan:
+    """
+    Precomputed tables to compute the CRC of `nwords`-long messages.
+
+    The message is split into `nseg` segments of equal length, zero
+    padded at the front, whose CRCs (with zero init) are computed in
+    parallel, one word of every segment per numpy operation. Since the
+    CRC is linear, the CRC of the message is the XOR of the segment
+    CRCs, each advanced over the words that follow it, and of the
+    init value advanced over the whole message. Advancing a 16-bit
+    register over a fixed number of zero words is tabulated per
+    segment, for the high and the low byte.
+    """
+    def __init__(self, nwords, nseg):
+        nseg = max(1, min(nseg, nwords))
+        self.nwords = nwords
+        self.nseg = nseg
+        self.seglen = -(-nwords // nseg)
+        self.pad = nseg * self.seglen - nwords
+        table = CRC16_WORD_TABLE
+        basis = np.concatenate([np.arange(256, dtype=np.uint16) << 8,
+                                np.arange(256, dtype=np.uint16)])
+        shift = np.empty((nseg, 512), dtype=np.uint16)
+        shift[-1] = basis
+        for k in range(nseg - 2, -1, -1):
+            for _ in range(self.seglen):
+                basis = table[basis]
+            shift[k] = basis
+        self.shift_hi = shift[:, :256].reshape(-1).copy()
+        self.shift_lo = shift[:, 256:].reshape(-1).copy()
+        self.offsets = np.arange(nseg, dtype=np.intp) * 256
+        init = CRC16_INIT
+        table = table.tolist()
+        for _ in range(nwords):
+            init = table[init]
+        self.init_term = init
+
+    def segment_crcs(self, words, nmsg):
+        """Return the combined CRCs of `nmsg` messages in `words`.
+
+        `words` is a 2-D array of (nmsg, nwords) message-order words.
+        """
+        nseg, seglen = self.nseg, self.seglen
+        padded = np.zeros((nmsg, nseg * seglen), dtype=np.uint16)
+        padded[:, self.pad:] = words
+        # one row per word position, one column per segment
+        columns = padded.reshape(nmsg * nseg, seglen).T.copy()
+        crc = columns[0].copy()
+        tmp = np.empty_like(crc)
+        for j in range(1, seglen):
+            np.take(CRC16_WORD_TABLE, crc, out=tmp, mode='clip')
+            np.bitwise_xor(tmp, columns[j], out=crc)
+        np.take(CRC16_WORD_TABLE, crc, out=crc, mode='clip')
+        crc = crc.reshape(nmsg, nseg)
+        ix_hi = self.offsets + (crc >> 8)
+        ix_lo = self.offsets + (crc & 0xFF)
+        crc = np.take(self.shift_hi, ix_hi) ^ np.take(self.shift_lo, ix_lo)
+        return np.bitwise_xor.reduce(crc, axis=1) ^ np.uint16(self.init_term)
+
+_PLANS = {}
+
+def _get_plan(nwords, nseg):
+    try:
+        return _PLANS[(nwords, nseg)]
+    except KeyError:
+        plan = _PLANS[(nwords, nseg)] = _Plan(nwords, nseg)
+        return plan
+
+def _message_words(frames):
+    """View the memory bytes of uint16 `frames` as MSB-first words"""
+    frames = np.ascontiguousarray(frames, dtype=np.uint16)
+    return frames.view(np.uint8).view('>u2').reshape(frames.shape)
+
+
+def crc16_words(words, nseg=1024):
+    """
+    Return the CRC-16/CCITT-FALSE of a 1-D uint16 array.
+
+    The array is processed directly, as `nseg` segments in parallel;
+    the byte order is that of host memory, same as crcmod over the
+    array buffer.
+    """
+    words = _message_words(words)
+    if len(words) == 0:
+        return CRC16_INIT
+    plan = _get_plan(len(words), nseg)
+    return int(plan.segment_crcs(words[np.newaxis], 1)[0])
+
+
+def crc16(data):
+    """
+    Return the CRC-16/CCITT-FALSE of a uint16 frame or bytes-like `data`.
+
+    Use the crcmod C extension if available, since it is the fastest
+    for a single frame, and the table-driven numpy engine otherwise.
+    """
+    if _crcmod_crc16 is not None:
+        return _crcmod_crc16(data)
+    if isinstance(data, np.ndarray) and data.dtype == np.uint16:
+        return crc16_words(data)
+    data = np.frombuffer(data, dtype=np.uint8)
+    crc = crc16_words(data[:len(data) & ~1].view(np.uint16))
+    if len(data) & 1:
+        # advance the register by the odd last byte
+        crc ^= int(data[-1]) << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ CRC16_POLY) if crc & 0x8000 else (crc << 1)
+            crc &= 0xFFFF
+    return crc
+
+
+def crc16_frames(frames, nseg=128, chunk_words=1 << 19):
+    """
+    Return the CRCs of a stack of frames, an (N, nwords) uint16 array.
+
+    Frames are processed in chunks of about `chunk_words` words, all
+    segments of all frames of a chunk in parallel, which is several
+    times faster per frame than computing CRCs one by one.
+    """
+    frames = np.asarray(frames)
+    if frames.ndim == 1:
+        frames = frames[np.newaxis]
+    nframes, nwords = frames.shape
+    result = np.empty(nframes, dtype=np.uint16)
+    if nframes == 0 or nwords == 0:
+        result[:] = CRC16_INIT
+        return result
+    plan = _get_plan(nwords, nseg)
+    chunk = max(1, chunk_words // nwords)
+    for i in range(0, nframes, chunk):
+        words = _message_words(frames[i: i + chunk])
+        result[i: i + chunk] = plan.segment_crcs(words, len(words))
+    return result
+
+
+def verify_frames(frames, crcs):
+    """
+    Return a boolean array, True where the CRC of a frame is wrong.
+
+    `frames` is an (N, nwords) array of temperature data, e.g. of a
+    recording, and `crcs` the N CRCs from the frame headers,
+    e.g. `headers['crc']` of decoded header records.
+    """
+    return crc16_frames(frames) != np.asarray(crcs, dtype=np.uint16)
+
+
+class CRCVerifier:
+    """
+    Verify frame CRCs as per a policy.
+
+    * 'every' -- verify every frame, when it is read
+    * 'every-n' -- verify every `n`th frame only
+    * 'deferred' -- copy the frame into a queue, and verify it in a
+      worker thread, off the acquisition path; errors are counted,
+      logged, and reported to `callback(tag, crc_error)`, if given.
+      If the queue is full, the frame is not verified.
+    * 'none' -- do not verify
+
+    check() returns True for a CRC error, False for a good CRC, and
+    None if the frame was not verified there and then. The worker
+    thread of 'deferred' is started by check(), also after close().
+    """
+    def __init__(self, policy=VERIFY_EVERY, n=10, maxqueue=64,
+                 callback=None):
+        if policy not in CRC_POLICIES:
+            raise ValueError('CRC policy must be one of {}'.
+                             format(CRC_POLICIES))
+        self.policy = policy
+        self.n = n
+        self.callback = callback
+        self.maxqueue = maxqueue
+        self._count = 0
+        self._queue = None
+        self._thread = None
+        # counters
+        self.checked = 0
+        self.errors = 0
+        self.skipped = 0
+        # tags of the frames last found in error
+        self.error_tags = deque(maxlen=100)
+
+    def check(self, data, crc, tag=None):
+        """Verify the CRC of `data` against `crc`, as per policy"""
+        self._count += 1
+        if self.policy == VERIFY_EVERY:
+            return self._verify(data, crc, tag)
+        if self.policy == VERIFY_EVERY_N:
+            if self._count % self.n:
+                self.skipped += 1
+                return None
+            return self._verify(data, crc, tag)
+        if self.policy == VERIFY_DEFERRED:
+            if self._thread is None:
+                self._start()
+            try:
+                self._queue.put_nowait((tag, data.copy(), int(crc)))
+            except queue.Full:
+                self.skipped += 1
+            return None
+        self.skipped += 1
+        return None
+
+    def _verify(self, data, crc, tag):
+        error = bool(crc16(data) != crc)
+        self.checked += 1
+        if error:
+            self.errors += 1
+            self.error_tags.append(tag)
+        return error
+
+    def _start(self):
+        """Start a worker thread, with a queue of its own"""
+        self._queue = queue.Queue(self.maxqueue)
+        self._thread = threading.Thread(target=self._run, args=(self._queue,),
+                                        daemon=True, name='crc-verifier')
+        self._thread.start()
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+            # verify whatever has accumulated in one go
+            items = [item]
+            stop = False
+            while not stop:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    q.task_done()
+                    stop = True
+                else:
+                    items.append(item)
+            if len(items) > 1 and len(set(len(d) for _, d, _ in items)) == 1:
+                frames = np.stack([d for _, d, _ in items])
+                errors = verify_frames(frames, [c for _, _, c in items])
+            else:
+                errors = [crc16(d) != c for _, d, c in items]
+            for (tag, _, crc), error in zip(items, errors):
+                self.checked += 1
+                if error:
+                    self.errors += 1
+                    self.error_tags.append(tag)
+                    logger.error('Frame {} CRC error (deferred check)'.
+                                 format(tag))
+                if self.callback is not None:
+                    self.callback(tag, bool(error))
+                q.task_done()
+            if stop:
+                return
+
+    def flush(self, timeout=1.0):
+        """Wait until queued frames are verified; return False on timeout"""
+        if self._queue is None:
+            return True
+        t0 = time.monotonic()
+        while self._queue.unfinished_tasks and \
+                time.monotonic() - t0 < timeout:
+            time.sleep(0.001)
+        return not self._queue.unfinished_tasks
+
+    def close(self, timeout=1.0):
+        """Stop the worker thread, if any, waiting up to `timeout` seconds
+
+        Frames still queued are verified first; a worker that does not
+        finish in time is left to do so, as a daemon thread.
+        """
+        if self._thread is None:
+            return
+        thread, self._thread = self._thread, None
+        t0 = time.monotonic()
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(max(timeout - (time.monotonic() - t0), 0))
+        if thread.is_alive():
+            logger.warning('CRC verifier did not stop within {} s; {} '
+                           'frames unverified'.format(timeout,
+                                                      self._queue.qsize()))
@@ -0,0 +1,622 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+import os
+import pty
+import tty
+import time
+import random
+import select
+import logging
+import threading
+import numpy as np
+
+from senxor.mi48 import regmap, DEFAULT_CTRL_STAT, FPA_SHAPE, KELVIN_0,\
+                        crc16, READOUT_TOO_SLOW, SXIF_ERROR, CAPTURE_ERROR,\
+                        DATA_READY, BOOTING_UP, GET_SINGLE_FRAME,\
+                        CONTINUOUS_STREAM, NO_HEADER, MI48_SENXOR_ID_LEN
+from senxor.interfaces import USB_HDR_LEN
+
+logger = logging.getLogger(__name__)
+
+# Addresses below this one are mapped to the user flash,
+# if enabled via FLASH_CTRL; else they read 0xFF
+USER_FLASH_SIZE = 0xA0
+
+# STATUS flags that are cleared upon read of the STATUS register
+STATUS_CLEAR_ON_READ = READOUT_TOO_SLOW | SXIF_ERROR | CAPTURE_ERROR
+
+# number of distinct synthetic scenes cycled through by the emulator
+N_SCENES = 16
+
+
+def max_fps(camera_type):
+    """Return the maximum frame rate of the camera type; see MI48.get_max_fps"""
+    if camera_type in [0, 1]:
+        return 25.5
+    if camera_type in [2]:
+        return 28.57
+    return 30.0
+
+
+def make_scenes(fpa_shape, n=N_SCENES, seed=0):
+    """
+    Return `n` synthetic frames of uint16 deci-Kelvin, as (n, rows*cols) array.
+
+    The scene is a room-temperature background with a vertical gradient,
+    and a hot spot moving on a circle, plus some pixel noise.
+    """
+    cols, rows = fpa_shape
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:rows, 0:cols]
+    background = 24. + 2. * y / rows
+    scenes = np.empty((n, rows * cols), dtype=np.uint16)
+    for i in range(n):
+        phi = 2 * np.pi * i / n
+        xc = cols / 2 + cols / 4 * np.cos(phi)
+        yc = rows / 2 + rows / 4 * np.sin(phi)
+        r2 = ((x - xc)**2 + (y - yc)**2) / (0.05 * cols)**2
+        temp = background + 12. * np.exp(-r2)
+        temp += rng.normal(0, 0.15, size=temp.shape)
+        scenes[i] = np.rint((temp - KELVIN_0) * 10).ravel()
+    return scenes
+
+
+class MI48Emulator:
+    """
+    Model of an MI48 with attached camera module, at register level.
+
+    The emulator keeps the control and status registers of `regmap`,
+    the user flash, and produces frames at the rate set by FRAME_RATE,
+    while FRAME_MODE requests capture. Frames are produced lazily, upon
+    access, based on the elapsed time, so no thread is needed.
+
+    It is accessed through `EmulatedSMBus`, `EmulatedSpiDev` and
+    `EmulatedDataReady`, which stand in for SMBus, SpiDev and a gpiozero
+    DigitalInputDevice, so that I2C_Interface, SPI_Interface and MI48
+    work with it unmodified.
+
+    Timing parameters, in seconds:
+
+        * boot_time -- duration of BOOTING_UP after power-up or reset
+        * stop_time -- delay before a capture stop is reflected in FRAME_MODE
+        * flash_write_time -- delay before a flash write reads back
+        * i2c_latency -- added to every I2C transaction
+        * spi_hz -- if not None, SPI transfers take 8 / spi_hz per byte
+    """
+    def __init__(self, camera_type=1, module_type=0, fw_version=(2, 1, 14),
+                 senxor_id=(22, 40, 1, 0, 18, 52), evk_id=13,
+                 boot_time=0., stop_time=0., flash_write_time=0.,
+                 i2c_latency=0., spi_hz=None, seed=0):
+        self.camera_type = camera_type
+        self.fpa_shape = FPA_SHAPE[camera_type]
+        self.cols, self.rows = self.fpa_shape
+        self.maxfps = max_fps(camera_type)
+        self.evk_id = evk_id
+        self.boot_time = boot_time
+        self.stop_time = stop_time
+        self.flash_write_time = flash_write_time
+        self.i2c_latency = i2c_latency
+        self.spi_hz = spi_hz
+        self.lock = threading.RLock()
+        self.scenes = make_scenes(self.fpa_shape, seed=seed)
+        self.flash = np.full(USER_FLASH_SIZE, 0xFF, dtype=np.uint8)
+        self._flash_pending = {}
+        # read-only registers
+        self._ro_regs = {
+            regmap['FW_VERSION_1']: (fw_version[0] << 4) | fw_version[1],
+            regmap['FW_VERSION_2']: fw_version[2],
+            regmap['SENXOR_TYPE']: camera_type,
+            regmap['MODULE_TYPE']: module_type,
+            regmap['EVK_ID']: evk_id,
+        }
+        assert len(senxor_id) == MI48_SENXOR_ID_LEN
+        for i, byte in enumerate(senxor_id):
+            self._ro_regs[regmap['SENXOR_ID_0'] + i] = byte
+        # counters for benchmarks
+        self.i2c_transactions = 0
+        self.spi_bytes = 0
+        self.reset()
+
+    # ------------------------------------------------------------------
+    # state
+    # ------------------------------------------------------------------
+    def reset(self):
+        """Reset the MI48: restore default registers, stop capture, boot up"""
+        with self.lock:
+            self.regs = {}
+            for name, value in DEFAULT_CTRL_STAT.items():
+                self.regs[regmap[name]] = value
+            self.regs[regmap['FLASH_CTRL']] = 0x00
+            self.status = 0x00
+            self.frame_counter = 0
+            self.frames_produced = 0
+            self.frames_read = 0
+            self._t_capture = None
+            self._t_stop = None
+            self._t_boot = time.monotonic()
+            self._booted_at = self._t_boot + self.boot_time
+            self._frame = None
+            self._frame_pending = None
+            self._output = None
+            self._output_pos = 0
+            self._update()
+
+    def powerup(self):
+        """Re-initialise the camera module, as upon SENXOR_POWERUP"""
+        with self.lock:
+            self._booted_at = time.monotonic() + self.boot_time
+            self._update()
+
+    def frame_period(self):
+        """Return the current frame period in seconds"""
+        divisor = self.regs[regmap['FRAME_RATE']]
+        return max(divisor, 1) / self.maxfps
+
+    def capture_mode(self):
+        return self.regs[regmap['FRAME_MODE']] &\
+                (GET_SINGLE_FRAME | CONTINUOUS_STREAM)
+
+    def next_frame_time(self):
+        """Return the monotonic time of the next frame, or None if idle"""
+        with self.lock:
+            self._update()
+            if self._t_capture is None:
+                return None
+            return self._t_capture +\
+                    (self.frames_produced + 1) * self.frame_period()
+
+    def _update(self, now=None):
+        """Bring the model up to `now`: boot, stop, new frames, flash"""
+        if now is None:
+            now = time.monotonic()
+        if now < self._booted_at:
+            self.status |= BOOTING_UP
+        else:
+            self.status &= ~BOOTING_UP & 0xFF
+        if self._flash_pending:
+            for addr, (value, t) in list(self._flash_pending.items()):
+                if now >= t:
+                    self.flash[addr] = value
+                    del self._flash_pending[addr]
+        if self._t_stop is not None and now >= self._t_stop:
+            self.regs[regmap['FRAME_MODE']] &=\
+                    ~(GET_SINGLE_FRAME | CONTINUOUS_STREAM) & 0xFF
+            self._t_stop = None
+            self._t_capture = None
+        if self._t_capture is None:
+            return
+        n = int((now - self._t_capture) / self.frame_period())
+        if n <= self.frames_produced:
+            return
+        if self.status & DATA_READY:
+            # previous frame was not read out in time
+            self.status |= READOUT_TOO_SLOW
+        self.frame_counter = (self.frame_counter + n - self.frames_produced)\
+                & 0xFFFF
+        self.frames_produced = n
+        self._produce_frame(now)
+        self.status |= DATA_READY
+        if self.regs[regmap['FRAME_MODE']] & GET_SINGLE_FRAME:
+            self.regs[regmap['FRAME_MODE']] &= ~GET_SINGLE_FRAME & 0xFF
+            self._t_capture = None
+
+    def make_frame(self, now=None):
+        """Return the current frame as uint16 words, incl. optional header"""
+        if now is None:
+            now = time.monotonic()
+        data = self.scenes[self.frame_counter % len(self.scenes)]
+        if self.regs[regmap['FRAME_MODE']] & NO_HEADER:
+            return data.copy()
+        header = np.zeros(self.cols, dtype=np.uint16)
+        timestamp = int(1.e3 * (now - self._t_boot)) & 0xFFFFFFFF
+        header[0] = self.frame_counter
+        header[1] = 33000                           # Vdd, 3.3 V x 1e4
+        header[2] = int(round((30. - KELVIN_0) * 100))  # T_SX, 30 C
+        header[3] = timestamp & 0xFFFF
+        header[4] = timestamp >> 16
+        header[5] = data.max()
+        header[6] = data.min()
+        header[7] = crc16(data)
+        return np.concatenate((header, data))
+
+    def _produce_frame(self, now):
+        frame = self.make_frame(now)
+        if self._output_pos:
+            # do not corrupt a frame that is being read out over SPI
+            self._frame_pending = frame
+        else:
+            self._frame = frame
+            self._output = None
+
+    def _frame_done(self):
+        """Clear DATA_READY once a frame is read; load any pending frame"""
+        self.status &= ~DATA_READY & 0xFF
+        self.frames_read += 1
+        if self._frame_pending is not None:
+            self._frame = self._frame_pending
+            self._frame_pending = None
+            self._output = None
+            self.status |= DATA_READY
+
+    # ------------------------------------------------------------------
+    # register access
+    # ------------------------------------------------------------------
+    def regread(self, addr):
+        with self.lock:
+            self._update()
+            if addr == regmap['STATUS']:
+                status = self.status
+                self.status &= ~STATUS_CLEAR_ON_READ & 0xFF
+                return status
+            if addr < USER_FLASH_SIZE:
+                if self.regs[regmap['FLASH_CTRL']] & 0x01:
+                    return int(self.flash[addr])
+                return 0xFF
+            if addr in self._ro_regs:
+                return self._ro_regs[addr]
+            return self.regs.get(addr, 0x00)
+
+    def regwrite(self, addr, value):
+        value = int(value) & 0xFF
+        with self.lock:
+            self._update()
+            now = time.monotonic()
+            if addr < USER_FLASH_SIZE:
+                if self.regs[regmap['FLASH_CTRL']] & 0x01:
+                    self._flash_pending[addr] =\
+                            (value, now + self.flash_write_time)
+                    self._update(now)
+                return
+            if addr == regmap['SENXOR_POWERUP']:
+                self._booted_at = now + self.boot_time
+                self._update(now)
+                return
+            if addr == regmap['FRAME_MODE']:
+                self._write_frame_mode(value, now)
+                return
+            if addr in self._ro_regs or addr == regmap['STATUS']:
+                # read-only registers ignore writes
+                return
+            self.regs[addr] = value
+
+    def _write_frame_mode(self, value, now):
+        capture = value & (GET_SINGLE_FRAME | CONTINUOUS_STREAM)
+        if capture:
+            self.regs[regmap['FRAME_MODE']] = value
+            self._t_capture = now
+            self._t_stop = None
+            self.frames_produced = 0
+            return
+        if self._t_capture is not None and self.stop_time > 0:
+            # keep the capture bits until the module actually stops
+            mode = self.regs[regmap['FRAME_MODE']]
+            self.regs[regmap['FRAME_MODE']] =\
+                    value | (mode & (GET_SINGLE_FRAME | CONTINUOUS_STREAM))
+            self._t_stop = now + self.stop_time
+            return
+        self.regs[regmap['FRAME_MODE']] = value
+        self._t_capture = None
+
+    # ------------------------------------------------------------------
+    # data access
+    # ------------------------------------------------------------------
+    def spi_transfer(self, nbytes):
+        """Return `nbytes` of the output buffer as a list, like SpiDev.xfer"""
+        with self.lock:
+            self._update()
+            self.spi_bytes += nbytes
+            if self._frame is None:
+                return [0] * nbytes
+            if self._output is None:
+                # the SPI output buffer holds big-endian words, MSB first
+                self._output = self._frame.astype('>u2').tobytes()
+            i0 = self._output_pos
+            i1 = i0 + nbytes
+            chunk = self._output[i0:i1]
+            if i1 >= len(self._output):
+                # frame fully read out
+                self._output_pos = 0
+                self._frame_done()
+            else:
+                self._output_pos = i1
+            response = list(chunk)
+        if len(response) < nbytes:
+            response.extend([0] * (nbytes - len(response)))
+        return response
+
+    def read_frame(self):
+        """Return the ready frame as uint16 words, or None if not ready"""
+        with self.lock:
+            self._update()
+            if not self.status & DATA_READY:
+                return None
+            frame = self._frame
+            self._output_pos = 0
+            self._frame_done()
+            return frame
+
+    def data_ready(self):
+        with self.lock:
+            self._update()
+            return bool(self.status & DATA_READY)
+
+    def wait_data_ready(self, timeout=None):
+        """Block until a frame is ready; return False on timeout"""
+        t0 = time.monotonic()
+        while not self.data_ready():
+            now = time.monotonic()
+            if timeout is not None and now - t0 >= timeout:
+                return False
+            t_next = self.next_frame_time()
+            if t_next is None:
+                delay = 0.001
+            else:
+                delay = max(t_next - now, 0.)
+            if timeout is not None:
+                delay = min(delay, t0 + timeout - now)
+            time.sleep(delay)
+        return True
+
+
+class EmulatedSMBus:
+    """SMBus-like access to an MI48Emulator"""
+    def __init__(self, emulator, bus=1, address=0x40):
+        self.emulator = emulator
+        self.bus = bus
+        self.address = address
+
+    def open(self, bus=None):
+        if bus is not None:
+            self.bus = bus
+
+    def close(self):
+        pass
+
+    def _transaction(self, addr):
+        if addr != self.address:
+            raise OSError(121, 'Remote I/O error')
+        self.emulator.i2c_transactions += 1
+        if self.emulator.i2c_latency:
+            time.sleep(self.emulator.i2c_latency)
+
+    def read_byte_data(self, i2c_addr, register):
+        self._transaction(i2c_addr)
+        return self.emulator.regread(register)
+
+    def write_byte_data(self, i2c_addr, register, value):
+        self._transaction(i2c_addr)
+        self.emulator.regwrite(register, value)
+
+    def read_i2c_block_data(self, i2c_addr, register, length):
+        self._transaction(i2c_addr)
+        return [self.emulator.regread(register + i) for i in range(length)]
+
+    def write_i2c_block_data(self, i2c_addr, register, data):
+        self._transaction(i2c_addr)
+        for i, value in enumerate(data):
+            self.emulator.regwrite(register + i, value)
+
+
+class EmulatedSpiDev:
+    """SpiDev-like access to the output frame buffer of an MI48Emulator"""
+    def __init__(self, emulator, bus=0, device=0):
+        self.emulator = emulator
+        self.bus = bus
+        self.device = device
+        self.mode = 0
+        self.max_speed_hz = 31200000
+        self.bits_per_word = 8
+        self.lsbfirst = False
+        self.cshigh = False
+        self.no_cs = False
+        self.bufsiz = 4096
+
+    def open(self, bus=None, device=None):
+        if bus is not None:
+            self.bus = bus
+        if device is not None:
+            self.device = device
+
+    def close(self):
+        pass
+
+    def _transfer(self, values):
+        n = len(values)
+        if self.emulator.spi_hz:
+            time.sleep(8. * n / self.emulator.spi_hz)
+        return self.emulator.spi_transfer(n)
+
+    def xfer(self, values, *args):
+        if len(values) > self.bufsiz:
+            raise OverflowError('Argument list size exceeds {} bytes.'.
+                                format(self.bufsiz))
+        return self._transfer(values)
+
+    xfer2 = xfer
+
+    def xfer3(self, values, *args):
+        return self._transfer(values)
+
+    def readbytes(self, n):
+        return self._transfer([0] * n)
+
+
+class EmulatedDataReady:
+    """DigitalInputDevice-like DATA_READY pin of an MI48Emulator"""
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    @property
+    def value(self):
+        return int(self.emulator.data_ready())
+
+    @property
+    def is_active(self):
+        return self.emulator.data_ready()
+
+    def wait_for_active(self, timeout=None):
+        return self.emulator.wait_data_ready(timeout)
+
+    def close(self):
+        pass
+
+
+class USBEmulator:
+    """
+    Stand-in for an EVK/XPro USB CDC device, on a pseudo-terminal.
+
+    The host side of the pty, `self.port_name`, can be opened like the
+    virtual serial port of a real device, e.g. by `get_serial(device=...)`
+    or `connect_senxor(src=...)`.
+    A device thread answers RREG/WREG commands with the
+    '   #' + length + command + data + checksum acknowledge, and streams
+    GFRA acknowledges at the frame rate of the underlying MI48Emulator.
+
+    Protocol faults can be injected, with the given probability per ack:
+
+        * checksum_error_rate -- wrong check sum field
+        * truncate_rate -- ack cut short, remainder never sent
+        * interleave_rate -- if streaming, a RREG is answered only after
+          the next GFRA
+    """
+    def __init__(self, emulator=None, checksum_error_rate=0.,
+                 truncate_rate=0., interleave_rate=0., seed=0):
+        if emulator is None:
+            emulator = MI48Emulator()
+        self.emulator = emulator
+        self.checksum_error_rate = checksum_error_rate
+        self.truncate_rate = truncate_rate
+        self.interleave_rate = interleave_rate
+        self.random = random.Random(seed)
+        self.master_fd, self.slave_fd = pty.openpty()
+        # no echo or line editing on the host side
+        tty.setraw(self.slave_fd)
+        self.port_name = os.ttyname(self.slave_fd)
+        self._rxbuf = bytearray()
+        self._stop_event = threading.Event()
+        self._thread = None
+        # counters
+        self.commands = 0
+        self.frames_sent = 0
+        self.faults = 0
+
+    def start(self):
+        """Start the device thread; return self"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='usb-emulator')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the device thread and close the pty"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+        for fd in (self.master_fd, self.slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            t_next = self.emulator.next_frame_time()
+            if t_next is None:
+                timeout = 0.05
+            else:
+                timeout = min(max(t_next - time.monotonic(), 0.), 0.05)
+            try:
+                readable, _, _ = select.select([self.master_fd], [], [],
+                                               timeout)
+                if readable:
+                    self._rxbuf += os.read(self.master_fd, 4096)
+                    self._handle_commands()
+                self._send_frame()
+            except OSError:
+                # host side closed, or pty gone upon stop()
+                time.sleep(0.01)
+
+    def _handle_commands(self):
+        """Parse and answer every complete command in the receive buffer"""
+        while True:
+            i = self._rxbuf.find(b'   #')
+            if i < 0:
+                # keep a possible partial sync marker
+                del self._rxbuf[:-3]
+                return
+            if len(self._rxbuf) < i + 8:
+                return
+            try:
+                cmd_len = int(self._rxbuf[i + 4: i + 8], 16)
+            except ValueError:
+                del self._rxbuf[:i + 4]
+                continue
+            if len(self._rxbuf) < i + 8 + cmd_len:
+                return
+            cmd = bytes(self._rxbuf[i + 8: i + 8 + cmd_len]).decode()
+            del self._rxbuf[:i + 8 + cmd_len]
+            self.commands += 1
+            self._answer(cmd)
+
+    def _answer(self, cmd):
+        cmd_type = cmd[:4]
+        try:
+            if cmd_type == 'RREG':
+                value = self.emulator.regread(int(cmd[4:6], 16))
+                if self.emulator.capture_mode() and\
+                        self._fault(self.interleave_rate):
+                    # a frame comes back before the register value
+                    self.emulator.wait_data_ready(timeout=1.0)
+                    self._send_frame()
+                self._send_ack('RREG', '{:02X}'.format(value).encode())
+                return
+            if cmd_type == 'WREG':
+                self.emulator.regwrite(int(cmd[4:6], 16), int(cmd[6:8], 16))
+                self._send_ack('WREG', b'')
+                return
+        except ValueError:
+            pass
+        self._send_ack('SERR', cmd.encode())
+
+    def _fault(self, rate):
+        if rate and self.random.random() < rate:
+            self.faults += 1
+            return True
+        return False
+
+    def _send_frame(self):
+        frame = self.emulator.read_frame()
+        if frame is None:
+            return
+        # the USB header precedes the frame; data is little-endian uint16
+        payload = bytes(USB_HDR_LEN) + frame.astype('<u2').tobytes()
+        self._send_ack('GFRA', payload)
+        self.frames_sent += 1
+
+    def _send_ack(self, cmd, data):
+        """| '   #' | 4B length | 4B command | data | 4B check sum |"""
+        length = '{:04X}'.format(len(cmd) + len(data) + 4).encode()
+        body = length + cmd.encode() + data
+        cks = int(np.frombuffer(body, dtype=np.uint8).sum()) & 0xFFFF
+        if self._fault(self.checksum_error_rate):
+            cks ^= 0x5A5A
+        ack = b'   #' + body + '{:04X}'.format(cks).encode()
+        if self._fault(self.truncate_rate):
+            ack = ack[:self.random.randrange(4, len(ack))]
+        self._write(ack)
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view and not self._stop_event.is_set():
+            _, writable, _ = select.select([], [self.master_fd], [], 0.1)
+            if writable:
+                n = os.write(self.master_fd, view)
+                view = view[n:]
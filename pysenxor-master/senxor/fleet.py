@@ -0,0 +1,249 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from serial import SerialException
+from serial.tools import list_ports
+
+from senxor.mi48 import MI48
+from senxor.interfaces import MI_VID, MI_PIDs, USB_Interface, open_serial
+from senxor.grabber import FrameGrabber, DROP_OLDEST
+
+logger = logging.getLogger(__name__)
+
+
+def list_senxor_ports():
+    """Return (device, comport name) of all attached SenXor USB devices"""
+    ports = []
+    for p in list_ports.comports():
+        if p.vid == MI_VID and p.pid in MI_PIDs:
+            ports.append((p.device, p.description.split()[-1][1:-1]))
+    return ports
+
+
+class CameraFleet:
+    """
+    Concurrent acquisition from many USB cameras, e.g. on the 25-socket jig.
+
+    discover() opens all SenXor ports at once, one thread per port,
+    initialises an MI48 on each, and maps the jig socket of every
+    camera (EVK_ID, 1 top left to 25 bottom right) to it.
+    start() starts streaming on all cameras, each read by its own
+    FrameGrabber into its own FrameRing.
+
+    Usage:
+
+        with CameraFleet() as fleet:
+            fleet.discover()
+            fleet.start(fps=9)
+            while True:
+                data, header = fleet.read(18, timeout=1.0)
+                ...
+                logger.info(fleet.stats())
+
+    `devices` is a list of serial devices or (device, name) to use
+    instead of the attached SenXor ports, e.g. emulator ptys.
+    `raw`, `cache`, `nslots` and `policy` are as of MI48 and FrameGrabber.
+    """
+    def __init__(self, devices=None, raw=False, cache=None, nslots=4,
+                 policy=DROP_OLDEST):
+        self.devices = devices
+        self.raw = raw
+        self.cache = cache
+        self.nslots = nslots
+        self.policy = policy
+        self.cameras = {}       # socket_id -> MI48
+        self.ports = {}         # socket_id -> comport name
+        self.grabbers = {}      # socket_id -> FrameGrabber
+        self.failed = {}        # comport name -> exception
+        self.discovery_time = None
+
+    def _connect(self, device, name, powerup):
+        """Return (socket_id, MI48) of the camera on `device`"""
+        ser = open_serial(device)
+        try:
+            usb = USB_Interface(ser)
+            mi48 = MI48([usb, usb], name=name, read_raw=self.raw,
+                        cache=self.cache)
+            if powerup:
+                mi48.powerup()
+                mi48.bootup()
+            return mi48.get_evk_socket_id(), mi48
+        except Exception:
+            ser.close()
+            raise
+
+    def discover(self, powerup=False):
+        """Connect to all cameras concurrently; return {socket_id: port}
+
+        The MI48 initialisation of every camera already waits for the
+        camera to boot; if `powerup`, the SenXor is re-initialised too.
+        """
+        devices = self.devices
+        if devices is None:
+            devices = list_senxor_ports()
+        devices = [d if isinstance(d, tuple) else (d, str(d))
+                   for d in devices]
+        if not devices:
+            raise RuntimeError('No SenXor connected')
+        t0 = time.monotonic()
+        futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=len(devices)) as pool:
+                futures = [(name, pool.submit(self._connect, dev, name,
+                                              powerup))
+                           for dev, name in devices]
+                for name, future in futures:
+                    self._add_camera(name, future)
+        except BaseException:
+            # e.g. KeyboardInterrupt; the pool has waited for all
+            # connections, so close every camera opened here
+            for name, future in futures:
+                if future.done() and not future.cancelled() and\
+                        future.exception() is None:
+                    sid, mi48 = future.result()
+                    if self.ports.get(sid) == name:
+                        del self.cameras[sid], self.ports[sid]
+                    try:
+                        mi48.close_interfaces()
+                    except Exception as e:
+                        logger.debug('{}: cannot close: {}'.format(name, e))
+            raise
+        self.discovery_time = time.monotonic() - t0
+        logger.info('{} cameras found in {:.2f} s'.
+                    format(len(self.cameras), self.discovery_time))
+        return dict(self.ports)
+
+    def _add_camera(self, name, future):
+        """Map the camera connected by `future` on port `name`"""
+        try:
+            sid, mi48 = future.result()
+        except Exception as e:
+            logger.error('{}: cannot connect: {!r}'.format(name, e),
+                         exc_info=not isinstance(
+                             e, (SerialException, OSError, TimeoutError)))
+            self.failed[name] = e
+            return
+        if sid in self.cameras:
+            logger.warning('Socket {} on both {} and {}; using {}'.
+                           format(sid, self.ports[sid], name,
+                                  self.ports[sid]))
+            mi48.close_interfaces()
+            return
+        logger.info('socket_id {}, port {}, {}'.format(sid, name, mi48.sn))
+        self.cameras[sid] = mi48
+        self.ports[sid] = name
+
+    def _parallel(self, func, sockets=None):
+        """Call func(socket_id, mi48) for all cameras concurrently
+
+        Return {socket_id: result} of the calls that returned, and
+        {socket_id: exception} of those that raised.
+        """
+        sockets = list(self.cameras) if sockets is None else sockets
+        results, errors = {}, {}
+        if not sockets:
+            return results, errors
+        with ThreadPoolExecutor(max_workers=len(sockets)) as pool:
+            futures = {sid: pool.submit(func, sid, self.cameras[sid])
+                       for sid in sockets}
+            for sid, future in futures.items():
+                try:
+                    results[sid] = future.result()
+                except Exception as e:
+                    errors[sid] = e
+        return results, errors
+
+    def start(self, fps=None, with_header=True, configure=None):
+        """Start streaming on all cameras, each into its own frame ring.
+
+        `configure(mi48)` is called on every camera before streaming
+        starts, e.g. to set up filters. If any camera fails to start,
+        the others keep streaming, until stop(), and RuntimeError is
+        raised; the failures are recorded in `failed`, by port.
+        """
+        def start_camera(sid, mi48):
+            if fps is not None:
+                mi48.set_fps(fps)
+            if configure is not None:
+                configure(mi48)
+            mi48.start(stream=True, with_header=with_header)
+            try:
+                grabber = FrameGrabber(mi48, nslots=self.nslots,
+                                       policy=self.policy)
+                grabber.start()
+            except Exception:
+                mi48.stop_capture()
+                raise
+            return grabber
+        grabbers, errors = self._parallel(start_camera)
+        self.grabbers.update(grabbers)
+        for sid, e in sorted(errors.items()):
+            logger.error('Socket {}: cannot start: {!r}'.format(sid, e))
+            self.failed[self.ports[sid]] = e
+        if errors:
+            raise RuntimeError('Cameras failed to start on sockets {}'.
+                               format(sorted(errors)))
+
+    def read(self, socket_id, timeout=None, out=None):
+        """Return (data, header) of the oldest unread frame of a camera
+
+        See FrameGrabber.read().
+        """
+        return self.grabbers[socket_id].read(timeout=timeout, out=out)
+
+    def read_all(self, timeout=0.):
+        """Return {socket_id: (data, header)} of the cameras with a frame"""
+        frames = {}
+        for sid, grabber in self.grabbers.items():
+            data, header = grabber.read(timeout=timeout)
+            if data is not None:
+                frames[sid] = (data, header)
+        return frames
+
+    @property
+    def fps(self):
+        """Aggregate acquisition rate of all cameras"""
+        return sum(grabber.fps for grabber in self.grabbers.values())
+
+    def stats(self):
+        """Return per-camera acquisition counters, and their totals"""
+        cameras = {sid: grabber.stats()
+                   for sid, grabber in sorted(self.grabbers.items())}
+        total = {
+            'cameras': len(cameras),
+            'frames': sum(s['frames'] for s in cameras.values()),
+            'drops': sum(s['drops'] for s in cameras.values()),
+            'read_errors': sum(s['read_errors'] for s in cameras.values()),
+            'fps': self.fps,
+        }
+        return {'cameras': cameras, 'total': total}
+
+    def stop(self):
+        """Stop acquisition on all cameras and close their ports"""
+        def stop_camera(sid, mi48):
+            try:
+                # also closes the port
+                mi48.stop()
+            except Exception as e:
+                logger.error('Socket {}: stop failed: {!r}'.format(sid, e))
+                try:
+                    mi48.close_interfaces()
+                except Exception as e_close:
+                    logger.debug('Socket {}: cannot close: {}'.
+                                 format(sid, e_close))
+        try:
+            for grabber in self.grabbers.values():
+                grabber.stop()
+            self.grabbers = {}
+            self._parallel(stop_camera)
+        finally:
+            self.cameras = {}
+            self.ports = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
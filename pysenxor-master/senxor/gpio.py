@@ -0,0 +1,172 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# Edge-triggered DATA_READY pin, on lgpio edge alerts.
+#
+# The kernel timestamps every rising edge of DATA_READY as it happens;
+# lgpio passes the edge, with its timestamp, to a callback, which wakes
+# up the reader at once. The timestamp tells when the frame became
+# ready, independently of the scheduling of the reader, so that the
+# latency of the readout and the jitter of the frame interval can be
+# measured precisely.
+#
+import os
+import glob
+import time
+import logging
+import threading
+from collections import deque
+import numpy as np
+
+try:
+    import lgpio
+except ImportError:
+    lgpio = None
+
+logger = logging.getLogger(__name__)
+
+# labels of the gpiochip of the 40-pin header, Raspberry Pi 5 first
+HEADER_GPIOCHIP_LABELS = ['pinctrl-rp1', 'pinctrl-bcm2711', 'pinctrl-bcm2835']
+
+
+def find_gpiochip():
+    """Return the number of the gpiochip of the 40-pin header, else 0"""
+    chips = {}
+    for path in glob.glob('/dev/gpiochip*'):
+        n = int(os.path.basename(path)[len('gpiochip'):])
+        try:
+            h = lgpio.gpiochip_open(n)
+        except lgpio.error:
+            continue
+        try:
+            chips[lgpio.gpio_get_chip_info(h)[3]] = n
+        finally:
+            lgpio.gpiochip_close(h)
+    for label in HEADER_GPIOCHIP_LABELS:
+        if label in chips:
+            return chips[label]
+    return 0
+
+
+class DataReadyEdge:
+    """
+    DATA_READY pin of the MI48, woken up by kernel-timestamped edges.
+
+    A drop-in for a gpiozero DigitalInputDevice, as `data_ready` of
+    MI48 and FrameGrabber:
+
+        data_ready = DataReadyEdge(24)
+        mi48 = MI48([i2c, spi], data_ready=data_ready)
+        ...
+        data_ready.wait_for_active(timeout=0.5)
+        t_ready = data_ready.timestamp
+
+    `gpio` is the BCM number of the pin, on gpiochip `chip`, by default
+    that of the 40-pin header. `timestamp` is the time of the last
+    rising edge, in seconds since the epoch, as time.time(); the edge
+    times of the last `history` frames are kept for stats().
+
+    Raise RuntimeError if lgpio is not installed, or the pin cannot be
+    claimed, e.g. if it is busy or not permitted.
+    """
+    def __init__(self, gpio=24, chip=None, pull=None, history=256):
+        if lgpio is None:
+            raise RuntimeError("Please install the 'lgpio' library for "
+                               "edge-triggered DATA_READY")
+        self.gpio = gpio
+        self._cond = threading.Condition()
+        # offset of the kernel clock of edge timestamps to time.time()
+        self._clock_offset = None
+        self.edges = 0
+        self.timestamp = None
+        self._edge_times = deque(maxlen=history)
+        self._wake_latencies = deque(maxlen=history)
+        self.chip = find_gpiochip() if chip is None else chip
+        flags = {None: lgpio.SET_PULL_NONE, 'up': lgpio.SET_PULL_UP,
+                 'down': lgpio.SET_PULL_DOWN}[pull]
+        try:
+            self._handle = lgpio.gpiochip_open(self.chip)
+        except lgpio.error as e:
+            raise RuntimeError('Cannot open gpiochip{}: {}'.
+                               format(self.chip, e)) from e
+        try:
+            lgpio.gpio_claim_alert(self._handle, gpio, lgpio.RISING_EDGE,
+                                   flags)
+            self._callback = lgpio.callback(self._handle, gpio,
+                                            lgpio.RISING_EDGE, self._on_edge)
+        except lgpio.error as e:
+            lgpio.gpiochip_close(self._handle)
+            raise RuntimeError('Cannot claim GPIO{} of gpiochip{}: {}'.
+                               format(gpio, self.chip, e)) from e
+
+    def _on_edge(self, chip, gpio, level, tick):
+        if self._clock_offset is None:
+            # edge timestamps are CLOCK_REALTIME or CLOCK_MONOTONIC,
+            # depending on the kernel and lgpio; take the nearer one
+            now_ns = time.time_ns()
+            if abs(tick - now_ns) < abs(tick - time.monotonic_ns()):
+                self._clock_offset = 0
+            else:
+                self._clock_offset = now_ns - time.monotonic_ns()
+        t = 1.e-9 * (tick + self._clock_offset)
+        with self._cond:
+            self.edges += 1
+            self.timestamp = t
+            self._edge_times.append(t)
+            self._cond.notify_all()
+
+    @property
+    def value(self):
+        """Level of the pin, 0 or 1"""
+        return lgpio.gpio_read(self._handle, self.gpio)
+
+    @property
+    def is_active(self):
+        return bool(self.value)
+
+    def wait_for_active(self, timeout=None):
+        """Wait until DATA_READY is high, or a rising edge.
+
+        Return True at once if the pin is high, else on the next edge;
+        False on timeout.
+        """
+        with self._cond:
+            edges = self.edges
+        if self.is_active:
+            return True
+        with self._cond:
+            woken = self._cond.wait_for(lambda: self.edges != edges, timeout)
+            if woken:
+                self._wake_latencies.append(time.time() - self.timestamp)
+        return woken
+
+    def stats(self):
+        """Return the number of edges, and interval and wake-up latency
+
+        Intervals of the last edges and wake-up latencies, the time from
+        an edge to wait_for_active() returning, are in milliseconds.
+        """
+        with self._cond:
+            times = np.array(self._edge_times)
+            latencies = 1.e3 * np.array(self._wake_latencies)
+        intervals = 1.e3 * np.diff(times)
+        stats = {'edges': self.edges}
+        if len(intervals):
+            stats.update(interval_mean=float(intervals.mean()),
+                         interval_jitter=float(intervals.std()),
+                         interval_min=float(intervals.min()),
+                         interval_max=float(intervals.max()))
+        if len(latencies):
+            stats.update(wake_latency_mean=float(latencies.mean()),
+                         wake_latency_max=float(latencies.max()))
+        return stats
+
+    def close(self):
+        """Cancel the edge alerts and release the pin"""
+        if self._handle is None:
+            return
+        self._callback.cancel()
+        lgpio.gpio_free(self._handle, self.gpio)
+        lgpio.gpiochip_close(self._handle)
+        self._handle = None
+        with self._cond:
+            self._cond.notify_all()
@@ -0,0 +1,337 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+import time
+import logging
+import threading
+from collections import deque
+import numpy as np
+
+from senxor.poller import StatusPoller
+
+logger = logging.getLogger(__name__)
+
+# Overflow policies of the frame ring, applied when the consumer
+# falls behind and all slots hold unread frames
+DROP_OLDEST = 'drop-oldest'   # overwrite the oldest unread frame
+DROP_NEWEST = 'drop-newest'   # read the new frame from the bus, but discard it
+BLOCK = 'block'               # wait for the consumer; may trip READOUT_TOO_SLOW
+OVERFLOW_POLICIES = [DROP_OLDEST, DROP_NEWEST, BLOCK]
+
+
+class FrameRing:
+    """Fixed-size ring of preallocated frame buffers.
+
+    A single producer writes raw frames into free slots, and a single
+    consumer takes them out in order of arrival.
+    The consumer owns the slot of the last frame it got until it asks
+    for the next one, so the producer never overwrites a frame that is
+    still being processed (double buffering).
+    """
+    def __init__(self, size_in_words, nslots=4, policy=DROP_OLDEST):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('Overflow policy must be one of {}'.
+                             format(OVERFLOW_POLICIES))
+        if nslots < 2:
+            raise ValueError('FrameRing needs at least 2 slots')
+        self.policy = policy
+        self.nslots = nslots
+        self.size_in_words = size_in_words
+        # one extra slot, to read into when dropping the newest frame
+        self.frames = np.zeros((nslots + 1, size_in_words), dtype=np.uint16)
+        self.headers = [None] * (nslots + 1)
+        self.timestamps = np.zeros(nslots + 1)
+        self.crc_errors = np.zeros(nslots + 1, dtype=bool)
+        self._scratch = nslots
+        self._free = deque(range(nslots))
+        self._filled = deque()
+        self._checked_out = None
+        self._closed = False
+        self._cond = threading.Condition()
+        # counters
+        self.frames_in = 0
+        self.frames_out = 0
+        self.drops = 0
+
+    def __len__(self):
+        """Number of unread frames"""
+        return len(self._filled)
+
+    def acquire(self, timeout=None):
+        """Return the index of a slot for the producer to write into.
+
+        Return None if the ring is closed, or if blocking for a free
+        slot timed out.
+        """
+        with self._cond:
+            if self._closed:
+                return None
+            if self._free:
+                return self._free.popleft()
+            if self.policy == DROP_OLDEST:
+                self.drops += 1
+                return self._filled.popleft()
+            if self.policy == DROP_NEWEST:
+                return self._scratch
+            # BLOCK
+            self._cond.wait_for(lambda: self._free or self._closed, timeout)
+            if self._closed or not self._free:
+                return None
+            return self._free.popleft()
+
+    def is_scratch(self, ix):
+        """Return True if slot `ix` is for a frame dropped as per policy"""
+        return ix == self._scratch
+
+    def commit(self, ix, header=None, timestamp=0., crc_error=False):
+        """Make the frame in slot `ix` available to the consumer"""
+        with self._cond:
+            if ix == self._scratch:
+                # newest frame dropped as per policy
+                self.drops += 1
+                return
+            self.headers[ix] = header
+            self.timestamps[ix] = timestamp
+            self.crc_errors[ix] = crc_error
+            self._filled.append(ix)
+            self.frames_in += 1
+            self._cond.notify_all()
+
+    def release(self, ix):
+        """Return slot `ix` to the producer without committing it"""
+        with self._cond:
+            if ix != self._scratch:
+                self._free.append(ix)
+                self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """Return the index of the oldest unread frame.
+
+        The slot of the previously returned frame is recycled.
+        Return None on timeout, or once the ring is closed and empty.
+        """
+        with self._cond:
+            if self._checked_out is not None:
+                self._free.append(self._checked_out)
+                self._checked_out = None
+                self._cond.notify_all()
+            self._cond.wait_for(lambda: self._filled or self._closed, timeout)
+            if not self._filled:
+                return None
+            ix = self._filled.popleft()
+            self._checked_out = ix
+            self.frames_out += 1
+            return ix
+
+    def close(self):
+        """Wake up producer and consumer; no more frames are accepted"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class FrameGrabber:
+    """
+    Acquire MI48 frames in a background thread.
+
+    The grabber owns the data interface of `mi48` (`mi48.interfaces[1]`)
+    while running: it waits for DATA_READY, reads the raw frame into a
+    FrameRing slot, and parses the header and checks the CRC. Conversion
+    to temperature is left to the consumer, in `read()`.
+
+    Usage:
+
+        mi48.start(stream=True, with_header=True)
+        grabber = FrameGrabber(mi48, nslots=4, policy='drop-oldest')
+        grabber.start()
+        while True:
+            data, header = grabber.read()
+            ...
+        grabber.stop()
+        mi48.stop()
+
+    `wait` selects how to wait for a new frame:
+
+        * 'pin' -- `mi48.data_ready.wait_for_active()`, e.g. gpiozero device
+        * 'status' -- poll STATUS register over the control interface,
+          around the expected frame times (see senxor.poller), backing
+          off to every `poll_interval` seconds
+        * None -- rely on the data interface read blocking (USB)
+
+    The default is 'pin' if `mi48` has a `data_ready` attribute, 'status'
+    if control and data interfaces differ, and None otherwise.
+
+    `chip_select` is an optional object with `on()` and `off()` methods,
+    that drives the SPI chip select of the MI48 around each frame read.
+
+    Frames are timestamped when DATA_READY is seen, or with the time of
+    its rising edge if the pin provides one in `timestamp`, e.g. a
+    senxor.gpio.DataReadyEdge, or with its estimate when polling STATUS.
+
+    `recorder` is an optional RecordingWriter (see senxor.recording),
+    to which every frame is appended as raw data, in the acquisition
+    thread, independently of the pace of the consumer.
+
+    Unless `close_ring`, the ring is left open when the grabber stops or
+    fails, so that it can be handed over to the grabber of a camera
+    that is attached again (see senxor.hotplug).
+    """
+    def __init__(self, mi48, nslots=4, policy=DROP_OLDEST, wait='auto',
+                 poll_interval=0.01, timeout=0.5,
+                 chip_select=None, cs_delay=0.0001, ring=None,
+                 recorder=None, close_ring=True):
+        self.mi48 = mi48
+        self.nslots = nslots
+        self.policy = policy
+        if wait == 'auto':
+            if hasattr(mi48, 'data_ready'):
+                wait = 'pin'
+            elif mi48.interfaces[0] is not mi48.interfaces[1]:
+                wait = 'status'
+            else:
+                wait = None
+        self.wait = wait
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.chip_select = chip_select
+        self.cs_delay = cs_delay
+        # the ring may be handed over from a previous grabber, so
+        # that the consumer keeps reading from the same ring
+        self.ring = ring
+        self.recorder = recorder
+        self.close_ring = close_ring
+        self.read_errors = 0
+        self.error = None
+        self.fps = 0.
+        # acquisition time of the frame last returned by read()
+        self.timestamp = None
+        self.poller = None
+        self._t_ready = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the acquisition thread; call after mi48.start()"""
+        size_in_words = self.mi48.get_frame_size()
+        if self.ring is None or self.ring.size_in_words != size_in_words:
+            self.ring = FrameRing(size_in_words, nslots=self.nslots,
+                                  policy=self.policy)
+        if self.wait == 'status':
+            # frame rate is set by now
+            self.poller = StatusPoller(self.mi48,
+                                       max_interval=self.poll_interval)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='{}-grabber'.format(self.mi48.name))
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        """Stop the acquisition thread and close the ring, if `close_ring`"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.warning('{}: acquisition thread did not stop in {} s'.
+                               format(self.mi48.name, timeout))
+            self._thread = None
+        if self.ring is not None and self.close_ring:
+            self.ring.close()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _wait_data_ready(self):
+        """Return True once a frame is ready, False on timeout or stop
+
+        The time the frame became ready, if known, is kept in `_t_ready`.
+        """
+        self._t_ready = None
+        if self.wait == 'pin':
+            data_ready = self.mi48.data_ready
+            if not data_ready.wait_for_active(timeout=self.timeout):
+                return False
+            # time of the edge of this frame, taken before the next one
+            self._t_ready = getattr(data_ready, 'timestamp', None)
+        elif self.wait == 'status':
+            if not self.poller.wait_for_active(timeout=self.timeout):
+                return False
+            self._t_ready = self.poller.timestamp
+        return True
+
+    def _run(self):
+        mi48 = self.mi48
+        ring = self.ring
+        t_last = None
+        try:
+            while not self._stop_event.is_set():
+                if not self._wait_data_ready():
+                    continue
+                ix = ring.acquire(timeout=self.timeout)
+                if ix is None:
+                    continue
+                timestamp = self._t_ready
+                if timestamp is None:
+                    timestamp = time.time()
+                if self.chip_select is not None:
+                    self.chip_select.on()
+                    time.sleep(self.cs_delay)
+                try:
+                    words = mi48.read_words(out=ring.frames[ix])
+                finally:
+                    if self.chip_select is not None:
+                        time.sleep(self.cs_delay)
+                        self.chip_select.off()
+                if words is None:
+                    self.read_errors += 1
+                    ring.release(ix)
+                    continue
+                if ring.is_scratch(ix):
+                    # the frame is dropped; no point in parsing it
+                    ring.commit(ix)
+                    continue
+                data, header = mi48.parse_frame(words)
+                if self.poller is not None:
+                    self.poller.update(header)
+                ring.commit(ix, header, timestamp, mi48.crc_error)
+                if self.recorder is not None:
+                    self.recorder.append(data, header, timestamp)
+                if t_last is not None and timestamp > t_last:
+                    # exponential moving average of the acquisition rate
+                    self.fps += 0.1 * (1. / (timestamp - t_last) - self.fps)
+                t_last = timestamp
+        except Exception as e:
+            logger.exception('{}: acquisition thread failed'.
+                             format(mi48.name))
+            self.error = e
+            if self.close_ring:
+                ring.close()
+
+    def read(self, timeout=None, out=None):
+        """Return (data, header) of the oldest unread frame.
+
+        Data is converted as per `mi48.read_raw`, same as MI48.read(),
+        into `out` if given.
+        Raw data is a view on the ring slot, valid until the next call.
+        Return (None, None) on timeout or after the grabber stopped.
+        The acquisition time of the frame is then in `self.timestamp`.
+        """
+        ix = self.ring.get(timeout)
+        if ix is None:
+            return None, None
+        self.timestamp = self.ring.timestamps[ix]
+        data_size = int(np.prod(self.mi48.fpa_shape))
+        data = self.ring.frames[ix, -data_size:]
+        return self.mi48.convert_data(data, out=out), self.ring.headers[ix]
+
+    def stats(self):
+        """Return a dictionary of acquisition counters"""
+        ring = self.ring
+        stats = {
+            'frames': ring.frames_in if ring is not None else 0,
+            'consumed': ring.frames_out if ring is not None else 0,
+            'drops': ring.drops if ring is not None else 0,
+            'read_errors': self.read_errors,
+            'fps': self.fps,
+        }
+        if self.poller is not None:
+            stats['status_polling'] = self.poller.stats()
+        return stats
@@ -0,0 +1,357 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# Hotplug-aware registry of USB cameras.
+#
+# SenXor serial devices are watched in /dev/serial/by-id, whose links
+# udev creates and removes as devices are plugged in and out, and are
+# identified by the USB vendor and product IDs in /sys. A directory
+# listing takes microseconds, so the directory is simply polled, at a
+# fraction of a frame period.
+#
+import os
+import time
+import logging
+import threading
+from serial import SerialException
+
+from senxor.mi48 import MI48, DEFAULT_CTRL_STAT_ADDR, regmap
+from senxor.interfaces import MI_VID, MI_PIDs, USB_Interface, open_serial
+from senxor.grabber import FrameGrabber, DROP_OLDEST
+from senxor.fleet import list_senxor_ports
+
+logger = logging.getLogger(__name__)
+
+SERIAL_BY_ID = '/dev/serial/by-id'
+SYS_CLASS_TTY = '/sys/class/tty'
+
+
+def usb_ids(device):
+    """Return (vid, pid) of the USB device of a serial `device`, or None
+
+    The IDs are read from /sys, in the first ancestor of the tty device
+    that has them, i.e. the USB device of the tty interface.
+    """
+    tty = os.path.basename(os.path.realpath(device))
+    path = os.path.realpath(os.path.join(SYS_CLASS_TTY, tty, 'device'))
+    while path.startswith('/sys/devices/'):
+        try:
+            with open(os.path.join(path, 'idVendor')) as f:
+                vid = int(f.read(), 16)
+            with open(os.path.join(path, 'idProduct')) as f:
+                pid = int(f.read(), 16)
+            return vid, pid
+        except (OSError, ValueError):
+            path = os.path.dirname(path)
+    return None
+
+def is_senxor_device(device):
+    """Return True if `device` is the serial port of a SenXor EVK/XPro"""
+    ids = usb_ids(device)
+    return ids is not None and ids[0] == MI_VID and ids[1] in MI_PIDs
+
+def scan_devices(by_id_dir=SERIAL_BY_ID, match=is_senxor_device):
+    """Return the set of serial devices in `by_id_dir` that `match`
+
+    With `by_id_dir` None, return the SenXor ports found by pyserial,
+    e.g. on systems without /dev/serial/by-id; this is much slower.
+    """
+    if by_id_dir is None:
+        return set(device for device, _ in list_senxor_ports())
+    try:
+        names = os.listdir(by_id_dir)
+    except FileNotFoundError:
+        # udev removes the directory with the last serial device
+        return set()
+    devices = (os.path.join(by_id_dir, name) for name in names)
+    return set(device for device in devices if match(device))
+
+
+class RegisteredCamera:
+    """A camera known to a CameraRegistry, by SENXOR_ID.
+
+    The frame `ring` is kept while the camera is detached, and fed by
+    the grabber of every re-attached MI48 in turn. `config` holds the
+    control registers {address: value} re-applied on re-attach.
+    """
+    def __init__(self, camera_id):
+        self.camera_id = camera_id
+        self.device = None
+        self.mi48 = None
+        self.grabber = None
+        self.ring = None
+        self.config = None
+        self.attached = False
+        self.attaches = 0
+        self.detaches = 0
+        # time from the device showing up to streaming, [s], per attach
+        self.attach_latencies = []
+        self.t_detached = None
+
+    @property
+    def attach_latency(self):
+        """Latency of the last attach [s], None if never attached"""
+        return self.attach_latencies[-1] if self.attach_latencies else None
+
+
+class CameraRegistry:
+    """
+    Registry of the USB cameras attached now or earlier, by SENXOR_ID.
+
+    A watcher thread scans for SenXor serial devices every
+    `poll_interval` seconds. A new device is attached in a thread of
+    its own: an MI48 is initialised on it, streaming is started, and
+    frames are acquired by a FrameGrabber into the frame ring of the
+    camera. When the device goes away, or its grabber fails, the
+    camera is detached, but its ring stays open; once the same camera
+    shows up again, possibly on another port, its control registers
+    are restored and streaming resumes into the same ring, so that the
+    consumer only sees a gap in the frames.
+
+    Usage:
+
+        def configure(mi48):
+            mi48.set_fps(9)
+            mi48.enable_filter(f1=True)
+
+        with CameraRegistry(configure=configure) as registry:
+            camera_id = registry.wait_attached(timeout=5.0)
+            while True:
+                data, header = registry.read(camera_id, timeout=1.0)
+                ...
+                logger.info(registry.stats())
+
+    `configure(mi48)` is called on the first attach of a camera only;
+    the control registers are then read back and re-applied on every
+    re-attach. With a `cache` (senxor.cache.CameraCache), the MI48
+    starts warm, keyed by the by-id link, which is stable across
+    re-enumeration. `raw`, `nslots` and `policy` are as of MI48 and
+    FrameGrabber; `by_id_dir` and `match` are as of scan_devices().
+    """
+    def __init__(self, configure=None, cache=None, raw=False,
+                 with_header=True, nslots=4, policy=DROP_OLDEST,
+                 by_id_dir=SERIAL_BY_ID, match=is_senxor_device,
+                 poll_interval=0.005):
+        self.configure = configure
+        self.cache = cache
+        self.raw = raw
+        self.with_header = with_header
+        self.nslots = nslots
+        self.policy = policy
+        self.by_id_dir = by_id_dir
+        self.match = match
+        self.poll_interval = poll_interval
+        self.cameras = {}       # camera_id -> RegisteredCamera
+        self.devices = {}       # device -> camera_id, of attached cameras
+        self.failed = {}        # device -> exception, until it goes away
+        self._attaching = set()
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start watching for cameras; return self"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._watch, daemon=True,
+                                        name='camera-registry')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop watching, and stop all attached cameras"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+        for camera in list(self.cameras.values()):
+            if camera.attached:
+                self._detach(camera, stop=True)
+            if camera.ring is not None:
+                camera.ring.close()
+
+    def _watch(self):
+        while not self._stop_event.is_set():
+            t_seen = time.monotonic()
+            try:
+                present = scan_devices(self.by_id_dir, self.match)
+            except OSError as e:
+                logger.warning('Device scan failed: {}'.format(e))
+                present = set()
+            with self._cond:
+                gone = [self.cameras[camera_id]
+                        for device, camera_id in self.devices.items()
+                        if device not in present or
+                        not self.cameras[camera_id].grabber.is_alive()]
+            for camera in gone:
+                self._detach(camera)
+            with self._cond:
+                for device in list(self.failed):
+                    if device not in present:
+                        del self.failed[device]
+                new = present - set(self.devices) - self._attaching -\
+                      set(self.failed)
+                self._attaching.update(new)
+            for device in sorted(new):
+                threading.Thread(target=self._attach, args=(device, t_seen),
+                                 daemon=True, name='attach').start()
+            self._stop_event.wait(self.poll_interval)
+
+    def _connect(self, device):
+        ser = open_serial(device)
+        try:
+            usb = USB_Interface(ser)
+            return MI48([usb, usb], name=os.path.basename(device),
+                        read_raw=self.raw, cache=self.cache,
+                        cache_key=device)
+        except Exception:
+            ser.close()
+            raise
+
+    def _attach(self, device, t_seen):
+        """Initialise the camera on `device` and start streaming"""
+        try:
+            mi48 = self._connect(device)
+        except Exception as e:
+            self._attach_failed(device, 'cannot connect', e)
+            return
+        camera_id = mi48.camera_id
+        with self._cond:
+            camera = self.cameras.get(camera_id)
+            if camera is not None and camera.attached:
+                logger.warning('{} on both {} and {}; using {}'.
+                               format(camera_id, camera.device, device,
+                                      camera.device))
+                self._attaching.discard(device)
+                self.failed[device] = RuntimeError('duplicate camera')
+                mi48.close_interfaces()
+                return
+        started = False
+        try:
+            if camera is None or camera.config is None:
+                camera = camera or RegisteredCamera(camera_id)
+                if self.configure is not None:
+                    self.configure(mi48)
+                camera.config = mi48.refresh(sorted(DEFAULT_CTRL_STAT_ADDR))
+                mi48.save_cache()
+            else:
+                self._restore(mi48, camera.config)
+            mi48.start(stream=True, with_header=self.with_header)
+            started = True
+            grabber = FrameGrabber(mi48, nslots=self.nslots,
+                                   policy=self.policy, ring=camera.ring,
+                                   close_ring=False)
+            grabber.start()
+        except Exception as e:
+            try:
+                if started:
+                    # also stops capture
+                    mi48.stop()
+                else:
+                    mi48.close_interfaces()
+            except Exception as e_close:
+                logger.debug('{}: cannot close: {}'.format(device, e_close))
+            self._attach_failed(device,
+                                'cannot start {}'.format(camera_id), e)
+            return
+        latency = time.monotonic() - t_seen
+        with self._cond:
+            camera.device = device
+            camera.mi48 = mi48
+            camera.grabber = grabber
+            camera.ring = grabber.ring
+            camera.attached = True
+            camera.attaches += 1
+            camera.attach_latencies.append(latency)
+            self.cameras[camera_id] = camera
+            self.devices[device] = camera_id
+            self._attaching.discard(device)
+            self._cond.notify_all()
+        logger.info('{} attached on {} in {:.1f} ms'.
+                    format(camera_id, device, 1.e3 * latency))
+
+    @staticmethod
+    def _restore(mi48, config):
+        """Re-apply the control registers `config` of a power cycled camera
+
+        FILTER_CTRL was read back with the init bit of filter 1 clear;
+        it is written last, once the filter settings are in place, and
+        filter 1 is initialised again by enable_filter().
+        """
+        config = dict(config)
+        fctrl = config.pop(regmap['FILTER_CTRL'], 0x00)
+        mi48.regwrite_many(sorted(config.items()))
+        mi48.regwrite('FILTER_CTRL', fctrl & ~0x03)
+        if fctrl & 0x01:
+            mi48.enable_filter(f1=True)
+
+    def _attach_failed(self, device, what, exc):
+        """Record `device` as failed, until it goes away"""
+        logger.error('{}: {}: {!r}'.format(device, what, exc),
+                     exc_info=not isinstance(
+                         exc, (SerialException, OSError, TimeoutError)))
+        with self._cond:
+            self._attaching.discard(device)
+            self.failed[device] = exc
+
+    def _detach(self, camera, stop=False):
+        """Stop the grabber of `camera` and close its port"""
+        camera.grabber.stop()
+        if stop:
+            try:
+                camera.mi48.stop()
+            except (SerialException, OSError, TimeoutError) as e:
+                logger.debug('{}: stop failed: {}'.format(camera.camera_id, e))
+        else:
+            try:
+                camera.mi48.close_interfaces()
+            except (SerialException, OSError):
+                pass
+        with self._cond:
+            self.devices.pop(camera.device, None)
+            camera.attached = False
+            camera.detaches += 1
+            camera.t_detached = time.monotonic()
+        logger.info('{} detached from {}'.format(camera.camera_id,
+                                                 camera.device))
+
+    def wait_attached(self, camera_id=None, timeout=None):
+        """Wait for a camera, or any if `camera_id` is None, to be attached
+
+        Return the camera_id, or None on timeout.
+        """
+        def attached():
+            if camera_id is not None:
+                camera = self.cameras.get(camera_id)
+                return camera_id if camera and camera.attached else None
+            for camera in self.cameras.values():
+                if camera.attached:
+                    return camera.camera_id
+            return None
+        with self._cond:
+            return self._cond.wait_for(attached, timeout)
+
+    def read(self, camera_id, timeout=None, out=None):
+        """Return (data, header) of the oldest unread frame of a camera
+
+        Frames keep coming from the same ring across re-attaches; while
+        the camera is detached, this waits up to `timeout`, see
+        FrameGrabber.read().
+        """
+        return self.cameras[camera_id].grabber.read(timeout=timeout, out=out)
+
+    def stats(self):
+        """Return per-camera attach and acquisition counters"""
+        stats = {}
+        for camera_id, camera in sorted(self.cameras.items()):
+            stats[camera_id] = dict(camera.grabber.stats(),
+                                    device=camera.device,
+                                    attached=camera.attached,
+                                    attaches=camera.attaches,
+                                    detaches=camera.detaches,
+                                    attach_latency=camera.attach_latency)
+        return stats
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
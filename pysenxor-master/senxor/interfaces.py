@@ -2,8 +2,12 @@
 import numpy as np
 import logging
 import time
+import select
+import threading
+from collections import deque
 from pprint import pformat
-from senxor.mi48 import get_reg_name
+from senxor.mi48 import get_reg_name, USER_FLASH_END, VOLATILE_REGS,\
+                        WRITE_INVALIDATE_REGS
 
 # the following dependency is only for get_serial
 import serial
@@ -14,18 +18,21 @@ logger = logging.getLogger(__name__)
 
 def cksum(data, sum=0):
     """Calculate simple sum over data, allowing for non-zero init"""
-    sum = sum
-    for byte in data:
-        sum += byte
-    #
-    return sum
+    # vectorised sum over the bytes; data is any bytes-like object
+    return sum + int(np.frombuffer(data, dtype=np.uint8).sum())
 
 
+# Maximum length of an SMBus block transfer
+I2C_BLOCK_MAX = 32
+
 class I2C_Interface:
     """I2C interface object to access a connected device"""
-    def __init__(self, i2c_bus, chip_addr):
+    def __init__(self, i2c_bus, chip_addr, block_transfers=True):
         self.device = i2c_bus
         self.chip_addr = chip_addr
+        # whether to access contiguous registers in one transaction,
+        # relying on the register address auto-increment of the MI48
+        self.block_transfers = block_transfers
 
     def open(self):
         self.device.open()
@@ -40,6 +47,45 @@ class I2C_Interface:
         self.device.write_byte_data(self.chip_addr, register_addr, byte)
         return None
 
+    def regread_block(self, register_addr, length, regname=""):
+        """Read `length` registers from `register_addr` onwards.
+
+        Return a list of ints. Use SMBus block reads of up to
+        I2C_BLOCK_MAX bytes, or byte reads if the bus does not
+        support block transfers.
+        """
+        if not self.block_transfers or length == 1:
+            return [self.regread(register_addr + i) for i in range(length)]
+        result = []
+        for i in range(0, length, I2C_BLOCK_MAX):
+            n = min(I2C_BLOCK_MAX, length - i)
+            try:
+                result.extend(self.device.read_i2c_block_data(
+                              self.chip_addr, register_addr + i, n))
+            except AttributeError:
+                self.block_transfers = False
+                result.extend(self.regread_block(register_addr + i,
+                                                 length - i))
+                break
+        return result
+
+    def regwrite_block(self, register_addr, values, regname=""):
+        """Write `values` to consecutive registers from `register_addr` on"""
+        values = list(values)
+        if not self.block_transfers or len(values) == 1:
+            for i, value in enumerate(values):
+                self.regwrite(register_addr + i, value)
+            return None
+        for i in range(0, len(values), I2C_BLOCK_MAX):
+            try:
+                self.device.write_i2c_block_data(self.chip_addr,
+                    register_addr + i, values[i: i + I2C_BLOCK_MAX])
+            except AttributeError:
+                self.block_transfers = False
+                self.regwrite_block(register_addr + i, values[i:])
+                break
+        return None
+
     def reset_input_buffer(self):
         try:
             self.device.reset_input_buffer()
@@ -63,50 +109,88 @@ class SPI_Interface:
     def __init__(self, spi_device, xfer_size):
         self.device = spi_device
         # host system would typically have a buffer that is
-        # smaller than the entire frame
+        # smaller than the entire frame; if xfer_size is None, the
+        # entire frame is read in one go, via xfer3 if available
         self.xfer_size = xfer_size
+        # dummy write bytes and the receive buffer are allocated once
+        # and reused by every read, so that streaming does not
+        # allocate per transfer; see _get_rx_buffer()
+        self._dummy_bytes = []
+        self._rx_buffer = bytearray()
+        self._rx_words = np.empty(0, dtype='>u2')
+        # bus statistics, updated by every read
+        self.bus_time = 0.
+        self.bytes_per_second = 0.
 
     def open(self):
         self.device.open()
 
-    def read(self, length_in_words):
+    def _get_rx_buffer(self, length_in_bytes):
+        """Return the receive buffer, growing it only if necessary"""
+        if len(self._rx_buffer) < length_in_bytes:
+            self._rx_buffer = bytearray(length_in_bytes)
+            # MI48 words are MSB first, i.e. big-endian uint16
+            self._rx_words = np.frombuffer(self._rx_buffer, dtype='>u2')
+        xfer_size = self.xfer_size or length_in_bytes
+        if len(self._dummy_bytes) != xfer_size:
+            self._dummy_bytes = [0,] * xfer_size
+        return self._rx_buffer
+
+    def read(self, length_in_words, out=None):
+        """Read `length_in_words` 16-bit words from the MI48.
+
+        The transfer goes into a preallocated receive buffer. The
+        big-endian words are then decoded into `out`, which must be
+        a uint16 array of `length_in_words` elements; if `out` is
+        None, a new array is returned.
+        Bus time and throughput of the read are stored in
+        `self.bus_time` [s] and `self.bytes_per_second`.
+        """
         # MI48 operates as a full duplex device and requires
         # a dummy write byte for every byte read back
         length_in_bytes = 2 * length_in_words
-        dummy_bytes = [0,] * self.xfer_size
-        xfer_size_words = int(self.xfer_size / 2)
-        length_in_words = int(length_in_bytes / 2)
-        # create a couple of buffers for storage of intermediate
-        # transfer and for the return buffer
-        data = np.zeros(length_in_words, dtype=np.uint16)
-        # make up a counter of how many words we have received
-        n_words = 0
-        # loop until we receive the required number of words
-        while n_words < length_in_words:
-            i0 = n_words
-            i1 = n_words + xfer_size_words
+        rx_buffer = self._get_rx_buffer(length_in_bytes)
+        dummy_bytes = self._dummy_bytes
+        xfer_size = len(dummy_bytes)
+        if self.xfer_size is not None:
             # Keep the CS asserted throughout the transfer
             # This should be a property of device.xfer.
             # If device is an instance of spidev on rpi, this seems to be
             # true for both xfer and xfer2 routines.
             # For the sake of generality, keep this as xfer
-            response = self.device.xfer(dummy_bytes)
-            # interpret the response as array of uint8
-            buffer = np.array(response).astype('u1')
-            n_words += int(len(buffer) / 2.)
-            # The MI48 assumes 16 bit word transfer with MSbit first.
-            # But we are reading with 8-bit word transfers on the RPI,
-            # and storing the MSB to lower location than the LSB.
-            # Hence we end up with big-endian data of unsigned 2-byte ints.
-            _data = np.ndarray(shape=(int(len(buffer) / 2),),
-                               buffer=buffer, dtype='>u2')
-            try:
-                data[i0: i1] = _data
-            except IndexError:
-                # depending on xfer_size, the last transfer may be shorter
-                # print(i0, 2*i0, length_in_words, len(_data), len(buffer))
-                data[i0:] = _data[:length_in_words - i0]
-        return data
+            xfer = self.device.xfer
+        else:
+            # single transfer of the entire frame; xfer3 lifts the
+            # spidev bufsiz limit
+            xfer = getattr(self.device, 'xfer3', self.device.xfer)
+        t0 = time.perf_counter()
+        # make up a counter of how many bytes we have received
+        n_bytes = 0
+        # loop until we receive the required number of bytes
+        while n_bytes < length_in_bytes:
+            remaining = length_in_bytes - n_bytes
+            if remaining < xfer_size:
+                # do not clock out bytes beyond the end of the frame
+                response = xfer(dummy_bytes[:remaining])
+            else:
+                response = xfer(dummy_bytes)
+            # copy into the receive buffer; same-size slice assignment
+            # does not reallocate the bytearray
+            rx_buffer[n_bytes: n_bytes + len(response)] = response
+            n_bytes += len(response)
+        self.bus_time = time.perf_counter() - t0
+        if self.bus_time > 0:
+            self.bytes_per_second = length_in_bytes / self.bus_time
+        # The MI48 assumes 16 bit word transfer with MSbit first.
+        # But we are reading with 8-bit word transfers on the RPI,
+        # and storing the MSB to lower location than the LSB.
+        # Hence we end up with big-endian data of unsigned 2-byte ints,
+        # which we swap into native order while copying to the output.
+        words = self._rx_words[:length_in_words]
+        if out is None:
+            return words.astype(np.uint16)
+        np.copyto(out, words)
+        return out
 
     def reset_input_buffer(self):
         try:
@@ -145,6 +229,342 @@ USB_CMD_LEN = 4
 USB_ACK_LEN = 4
 USB_CKS_LEN = 4  # check sum
 USB_HDR_LEN = 320
+USB_SYNC = b'   #'
+
+class USBAckFramer:
+    """
+    Incremental parser of the stream of USB acknowledges.
+
+    Bytes are read in bulk, whatever the port has waiting, into a
+    reusable receive buffer, in which acknowledges are located by their
+    sync marker and length, and verified by their check sum:
+
+    | '   #' | 4B length(LenCmdDat) | 4B command | data (lenth - 8B) | 4B CKS |
+
+    An ack with bad check sum or length is dropped, and parsing resumes
+    at the next sync marker; no bytes are flushed from the port.
+
+    Bytes may come from `port` (any object with read() and in_waiting),
+    or be pushed in by `feed()`.
+    """
+    def __init__(self, port=None, bufsize=1 << 17):
+        self.port = port
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0    # first byte not yet parsed
+        self._end = 0      # end of received bytes
+        self._needed = len(USB_SYNC)
+        # counters
+        self.acks = 0
+        self.checksum_errors = 0
+        self.bytes_dropped = 0
+
+    def reset(self):
+        """Discard all buffered bytes"""
+        self.bytes_dropped += self._end - self._start
+        self._start = self._end = 0
+        self._needed = len(USB_SYNC)
+
+    def feed(self, data):
+        """Append received bytes to the buffer.
+
+        Note that this may overwrite the data of acks returned earlier.
+        """
+        n = len(data)
+        if self._end + n > len(self._buf):
+            # move unparsed bytes to the front, growing the buffer if needed
+            pending = self._end - self._start
+            if pending + n > len(self._buf):
+                buf = bytearray(2 * (pending + n))
+                buf[:pending] = self._view[self._start: self._end]
+                self._buf = buf
+                self._view = memoryview(buf)
+            else:
+                # the ranges may overlap; copy the unparsed bytes out first
+                self._buf[:pending] = bytes(self._view[self._start: self._end])
+            self._start, self._end = 0, pending
+        self._buf[self._end: self._end + n] = data
+        self._end += n
+
+    def fill(self, timeout=None):
+        """Read what the port has waiting, or at least the missing bytes.
+
+        With `timeout`, and a port with a file descriptor, wait at most
+        `timeout` seconds for data by select(), then read only what has
+        arrived; otherwise, the read waits up to the timeout of the port.
+        Return False if no data came in time.
+        """
+        try:
+            waiting = self.port.in_waiting
+        except AttributeError:
+            waiting = 0
+        n = max(waiting, self._needed, 1)
+        if waiting < n and timeout is not None:
+            try:
+                fd = self.port.fileno()
+            except (AttributeError, OSError, ValueError):
+                fd = None
+            if fd is not None:
+                readable, _, _ = select.select([fd], [], [], max(timeout, 0))
+                if not readable:
+                    return False
+                n = max(self.port.in_waiting, 1)
+        data = self.port.read(n)
+        if not data:
+            return False
+        self.feed(data)
+        return True
+
+    def next_ack(self):
+        """Return the next complete (cmd, data) ack in the buffer, or None.
+
+        `cmd` is bytes, `data` is a memoryview on the receive buffer,
+        valid until the buffer is fed again.
+        """
+        buf = self._buf
+        while True:
+            i = buf.find(USB_SYNC, self._start, self._end)
+            if i < 0:
+                # keep what may be the beginning of a sync marker
+                start = max(self._start, self._end - len(USB_SYNC) + 1)
+                self.bytes_dropped += start - self._start
+                self._start = start
+                self._needed = len(USB_SYNC)
+                return None
+            self.bytes_dropped += i - self._start
+            self._start = i
+            available = self._end - i
+            if available < 8:
+                self._needed = 8 - available
+                return None
+            try:
+                ack_len = int(bytes(buf[i + 4: i + 8]), base=16)
+            except ValueError:
+                ack_len = 0
+            if ack_len < USB_CMD_LEN + USB_CKS_LEN:
+                # not a real sync marker or corrupted length
+                self._start = i + 1
+                continue
+            total = 8 + ack_len
+            if available < total:
+                self._needed = total - available
+                return None
+            # check sum covers length, command and data fields
+            cs = np.frombuffer(buf, dtype=np.uint8, count=total - 8,
+                               offset=i + 4).sum()
+            try:
+                cks = int(bytes(buf[i + total - 4: i + total]), base=16)
+            except ValueError:
+                cks = None
+            if cks != int(cs) & 0xFFFF:
+                logger.error('Check sum mismatch: calculated {}, received {}'.
+                             format(hex(int(cs) & 0xFFFF), cks))
+                self.checksum_errors += 1
+                # resume from the next sync marker, which may well be
+                # inside a truncated ack
+                self._start = i + 1
+                continue
+            cmd = bytes(buf[i + 8: i + 12])
+            data = self._view[i + 12: i + total - 4]
+            self._start = i + total
+            self._needed = len(USB_SYNC)
+            self.acks += 1
+            return cmd, data
+
+    def read_ack(self, timeout=None):
+        """Return the next (cmd, data) ack from the port, None on timeout
+
+        Wait at most `timeout` seconds, if given, else up to the timeout
+        of the port for every read.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ack = self.next_ack()
+        while ack is None:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+            if not self.fill(remaining):
+                return None
+            ack = self.next_ack()
+        return ack
+
+
+class _PendingCommand:
+    """A host command waiting for its acknowledge"""
+    __slots__ = ('cmd', 'result', 'done')
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.result = None
+        self.done = False
+
+
+class USBDemux:
+    """
+    Single reader of the USB port, routing acks to their consumers.
+
+    Control and data share one serial port. Whichever thread needs an
+    ack (a command waiting for RREG/WREG, or `get_frame()` waiting for
+    GFRA) takes the role of the reader, while others wait on a
+    condition. Each ack read is routed:
+
+    * 'GFRA' -- the frame is copied into a small queue of reusable
+      buffers; if the queue is full, the oldest frame is dropped
+    * 'RREG', 'WREG' -- to the oldest pending command of the same type
+    * 'SERR' -- to the oldest pending command, which is then resent
+
+    Hence register access does not disturb streaming, and the input
+    buffer is never flushed. A command with no ack within `ack_timeout`
+    seconds is resent, up to `retries` times; the timeout should exceed
+    the worst ack latency, lest a late ack be taken for that of the
+    next command of the same type.
+    """
+    def __init__(self, port, framer=None, nframes=8, ack_timeout=0.25,
+                 retries=10):
+        self.port = port
+        self.framer = framer if framer is not None else USBAckFramer(port)
+        self.nframes = nframes
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._reading = False
+        self._pending = deque()
+        self._frames = deque()
+        self._spare = []
+        # counters
+        self.frames_in = 0
+        self.frames_dropped = 0
+        self.resends = 0
+        self.batch_failures = 0
+        self.unmatched = 0
+
+    def reset(self):
+        """Discard buffered bytes and queued frames"""
+        with self._cond:
+            self.framer.reset()
+            while self._frames:
+                self._spare.append(self._frames.popleft())
+
+    def _route(self, ack):
+        cmd, data = ack
+        if cmd == b'GFRA':
+            n = len(data) // 2
+            if len(self._frames) >= self.nframes:
+                self._spare.append(self._frames.popleft())
+                self.frames_dropped += 1
+            frame = self._spare.pop() if self._spare else None
+            if frame is None or len(frame) != n:
+                frame = np.empty(n, dtype=np.uint16)
+            # copy out of the framer buffer, which is reused
+            np.copyto(frame, np.frombuffer(data, dtype='u2'))
+            self._frames.append(frame)
+            self.frames_in += 1
+            return
+        cmd, data = usb_parse_ack(cmd, data)
+        for pending in self._pending:
+            if pending.cmd == cmd or cmd == 'SERR':
+                pending.result = (cmd, data)
+                pending.done = True
+                self._pending.remove(pending)
+                return
+        # e.g. the late ack to a command that was resent
+        logger.debug('Unexpected {} ACK: {}'.format(cmd, data))
+        self.unmatched += 1
+
+    def _wait(self, predicate, timeout=None):
+        """Read and route acks until predicate() holds; call with _cond held
+
+        Return the value of predicate() on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not predicate():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return predicate()
+            if self._reading:
+                self._cond.wait(remaining)
+                continue
+            self._reading = True
+            self._cond.release()
+            try:
+                ack = self.framer.read_ack(remaining)
+            finally:
+                self._cond.acquire()
+                self._reading = False
+            if ack is not None:
+                self._route(ack)
+            # wake up waiters, one of which must take over reading
+            self._cond.notify_all()
+        return True
+
+    def command(self, cmd: str):
+        """Send a host command and return the (cmd, data) of its ack"""
+        for _ in range(self.retries + 1):
+            pending = _PendingCommand(cmd[8:12])
+            with self._cond:
+                self._pending.append(pending)
+            with self._write_lock:
+                self.port.write(cmd.encode())
+            with self._cond:
+                self._wait(lambda: pending.done, self.ack_timeout)
+                if not pending.done:
+                    self._pending.remove(pending)
+            if pending.done and pending.result[0] != 'SERR':
+                return pending.result
+            logger.debug('No ACK to {}: {}; resending'.
+                         format(cmd[8:12], pending.result))
+            self.resends += 1
+        raise TimeoutError('No ACK to {} after {} attempts'.
+                           format(cmd[8:12], self.retries + 1))
+
+    def command_batch(self, cmds):
+        """Send host commands back to back, then wait for all their acks.
+
+        Return a list of (cmd, data) acks in the order of `cmds`, or None
+        if any ack is missing or SERR. Acks carry no register address,
+        and are matched to commands by order, so if one is missing, the
+        rest cannot be attributed either; it is up to the caller to
+        find out which commands took effect.
+        """
+        pendings = [_PendingCommand(cmd[8:12]) for cmd in cmds]
+        with self._cond:
+            self._pending.extend(pendings)
+        with self._write_lock:
+            self.port.write(''.join(cmds).encode())
+        with self._cond:
+            self._wait(lambda: all(p.done for p in pendings),
+                       self.ack_timeout)
+            for p in pendings:
+                if not p.done:
+                    self._pending.remove(p)
+        if all(p.done and p.result[0] != 'SERR' for p in pendings):
+            return [p.result for p in pendings]
+        logger.debug('{} of {} ACKs to batch received'.
+                     format(sum(p.done for p in pendings), len(pendings)))
+        self.batch_failures += 1
+        return None
+
+    def get_frame(self, timeout=None):
+        """Return the oldest queued frame (a 1-D uint16 array), or None
+
+        Hand the frame back by `recycle()` once done with it.
+        """
+        with self._cond:
+            if not self._wait(lambda: self._frames, timeout):
+                return None
+            return self._frames.popleft()
+
+    def recycle(self, frame):
+        """Return a frame buffer obtained from get_frame() for reuse"""
+        with self._cond:
+            if len(self._spare) < self.nframes:
+                self._spare.append(frame)
+
 
 class USB_Interface:
     """USB interface object to access a connected device"""
@@ -152,6 +572,10 @@ class USB_Interface:
     def __init__(self, port):
         self.port = port
         self.log = logger
+        self.framer = USBAckFramer(port)
+        # all reads of the port go through the demultiplexer, so that
+        # register access does not interfere with frame streaming
+        self.demux = USBDemux(port, self.framer)
 
     def open(self):
         self.port.open()
@@ -162,69 +586,173 @@ class USB_Interface:
 
     def reset_input_buffer(self):
         self.port.reset_input_buffer()
+        self.demux.reset()
 
     def reset_output_buffer(self):
         self.port.reset_output_buffer()
 
     def regread(self, reg, regname=""):
         """Read a control/status register via USB protocol"""
-        result = None
-        while result is None:
-            cmd = 'RREG{:02X}XXXXXX'.format(reg)
-            cmd = '   #{:04X}{}'.format(len(cmd), cmd)
-            cmd_name = 'GET_{}'.format(regname)
-            result = usb_command(self.port, cmd, cmd_name)
-            if result is None: return
-            if not isinstance(result, int):
-                # a non int would be a GFRA coming back before the RREG
-                result = None
+        cmd = usb_rreg_cmd(reg)
+        _, result = self.demux.command(cmd)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('{}'.format(fmt_usb_cmd(cmd, result)))
         return result
 
     def regwrite(self, reg, value, regname=""):
         """Write to a control register via USB protocol"""
-        cmd = 'WREG{:02X}{:02X}XXXX'.format(reg, value)
-        cmd = '   #{:04X}{}'.format(len(cmd), cmd)
-        cmd_name = 'SET_{}'.format(regname)
-        usb_command(self.port, cmd, cmd_name)
+        cmd = usb_wreg_cmd(reg, value)
+        self.demux.command(cmd)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('{}'.format(fmt_usb_cmd(cmd, None)))
         return None
 
-    def read(self, size_in_words):
+    def regread_batch(self, regs):
+        """Read a list of registers with pipelined RREG commands.
+
+        Return a list of values. Fall back to one command at a time if
+        not all acks arrive.
+        """
+        cmds = [usb_rreg_cmd(reg) for reg in regs]
+        acks = self.demux.command_batch(cmds)
+        if acks is None:
+            return [self.regread(reg) for reg in regs]
+        if self.log.isEnabledFor(logging.DEBUG):
+            for cmd, (_, value) in zip(cmds, acks):
+                self.log.debug('{}'.format(fmt_usb_cmd(cmd, value)))
+        return [value for _, value in acks]
+
+    def regwrite_batch(self, regs_values):
+        """Write a list of (reg, value) with pipelined WREG commands.
+
+        All commands are sent back to back, and the acks are collected
+        afterwards, which takes one round trip instead of one per write.
+        If acks are missing, the registers are read back, and only the
+        writes that did not take effect are sent again, along with those
+        that cannot be verified (see is_verifiable_write()).
+        """
+        pending = list(regs_values)
+        for _ in range(self.demux.retries + 1):
+            cmds = [usb_wreg_cmd(reg, value) for reg, value in pending]
+            if self.demux.command_batch(cmds) is not None:
+                if self.log.isEnabledFor(logging.DEBUG):
+                    for cmd in cmds:
+                        self.log.debug('{}'.format(fmt_usb_cmd(cmd, None)))
+                return None
+            regs = sorted(set(reg for reg, _ in pending
+                              if is_verifiable_write(reg)))
+            readback = dict(zip(regs, self.regread_batch(regs))) if regs\
+                       else {}
+            pending = unconfirmed_writes(pending, readback)
+            if not pending:
+                return None
+            self.log.debug('Resending {} of the batched writes'.
+                           format(len(pending)))
+        raise TimeoutError('Batched register writes failed: {}'.
+                           format(pending))
+
+    def read(self, size_in_words, out=None):
         """Read a GFRA acknowledge, remove USB header, and return data frame.
 
         The returned data frame is a 1-D numpy array of unsigned int16.
+        If `out` is given, the frame is copied into it and `out` returned.
+        Frames that arrived while registers were being accessed are
+        queued by the demultiplexer, and returned in order.
         """
-        cmd, data = usb_acknowledge(self.port)
-        if cmd == 'GFRA':
-            # data is a sequence (1-d array) of 16-bit unsigned ints
-            # here we drop the USB header 
-            return data[-size_in_words:]
-        else:
-            self.log.warning('read returned {} acknowledge.'.format(cmd))
-            return None
+        frame = None
+        while frame is None:
+            # a timeout is not an error; frame period may exceed it
+            frame = self.demux.get_frame(timeout=self.demux.ack_timeout)
+        # drop the USB header
+        if out is None:
+            return frame[-size_in_words:]
+        np.copyto(out, frame[-size_in_words:])
+        self.demux.recycle(frame)
+        return out
+
+
+def usb_rreg_cmd(reg):
+    """Return the host command to read register `reg`"""
+    cmd = 'RREG{:02X}XXXXXX'.format(reg)
+    return '   #{:04X}{}'.format(len(cmd), cmd)
+
+def usb_wreg_cmd(reg, value):
+    """Return the host command to write `value` to register `reg`"""
+    cmd = 'WREG{:02X}{:02X}XXXX'.format(reg, value)
+    return '   #{:04X}{}'.format(len(cmd), cmd)
+
+def is_verifiable_write(reg):
+    """Return True if a write to `reg` can be verified by reading it back
+
+    Not so for registers that the MI48 changes itself, e.g. the init
+    bit of filter 1 in FILTER_CTRL, nor for the user flash, which may
+    still be programming.
+    """
+    return reg >= USER_FLASH_END and reg not in VOLATILE_REGS and\
+           reg not in WRITE_INVALIDATE_REGS
 
+def unconfirmed_writes(regs_values, readback):
+    """Return the writes of a batch with missing acks to send again
 
-def usb_command(port, cmd: str, cmd_name='', verbose=True):
-    """send command to MI48 via USB and return its acknowledge"""
+    `readback` maps the verifiable registers of `regs_values` (see
+    is_verifiable_write()) to their values read back; a write to any
+    of them is confirmed if the value matches. Writes that cannot be
+    verified are sent again as they are, in their order.
+    """
+    # only the last write to each register matters now, in its place
+    seen = set()
+    resend = []
+    for reg, value in reversed(regs_values):
+        if reg in seen:
+            continue
+        seen.add(reg)
+        if reg not in readback or readback[reg] != value:
+            resend.append((reg, value))
+    resend.reverse()
+    return resend
+
+def usb_command(port, cmd: str, cmd_name='', verbose=True, framer=None):
+    """send command to MI48 via USB and return its acknowledge
+
+    Acks other than the expected one are flushed along with the input
+    buffer; USB_Interface uses a USBDemux instead, which keeps them.
+    """
     _cmd = ''
     while _cmd != cmd[8:12]:
         # host command
         port.write(cmd.encode())
         # device ack
-        _cmd, data = usb_acknowledge(port)
+        _cmd, data = usb_acknowledge(port, framer)
+        if _cmd is None:
+            # ack lost or truncated; send the command again
+            if verbose:
+                logger.debug('No ACK to {}; resending'.format(cmd[8:12]))
+            continue
         if _cmd != cmd[8:12]:
             if verbose:
                 logger.debug('Expected ACK: {}, rcvd: {}'.
                              format(cmd[8:12], _cmd))
                 logger.debug('Resetting input buffer')
             port.reset_input_buffer()
+            if framer is not None:
+                framer.reset()
     if _cmd == 'RREG':
         assert isinstance(data, int)
     # report
     if verbose: logger.debug('{}'.format(fmt_usb_cmd(cmd, data)))
     return data
 
-def usb_acknowledge(port):
-    """Receive the EVK acknowledge and parse it"""
+def usb_acknowledge(port, framer=None):
+    """Receive the EVK acknowledge and parse it
+
+    If a USBAckFramer is given, read the ack through it, and return
+    (None, None) if the port times out before a complete ack arrives.
+    """
+    if framer is not None:
+        ack = framer.read_ack()
+        if ack is None:
+            return None, None
+        return usb_parse_ack(*ack)
     ack = None
     # this loop will make the program hang if ser.read()
     # has no timeout configured!
@@ -238,7 +766,7 @@ def usb_acknowledge(port):
     parsed = usb_parse_ack(*ack)
     return parsed
 
-def usb_parse_ack(cmd:str, data:bytes):
+def usb_parse_ack(cmd:bytes, data:bytes):
     """
     Parse command and return the command string and a data item.
 
@@ -249,20 +777,22 @@ def usb_parse_ack(cmd:str, data:bytes):
     * 'WREG' -- a None value
     * 'SERR' -- decoded data field
     """
-    cmd = cmd.decode()
+    cmd = cmd.decode(errors='replace')
     if cmd == 'WREG':
         # An acknowledge to a register-write contains no data
         return cmd, None
     if cmd == 'RREG':
         # read command returns only a register value
-        return cmd, int(data.decode(), base=16)
+        return cmd, int(bytes(data).decode(), base=16)
     if cmd == 'SERR':
         # I have no info on what SERR contains... undocumented
-        return cmd, data.decode()
+        return cmd, bytes(data).decode(errors='replace')
     if cmd == 'GFRA':
         # Frame acknowledge contains unencoded unsigned 16-bit ints
         data = np.frombuffer(data, dtype='u2')
         return cmd, data
+    # unknown acknowledge; pass the data on as is
+    return cmd, data
 
 def usb_get_ack(port):
     """
@@ -339,11 +869,29 @@ def fmt_usb_cmd(cmd, data):
 
     return ' '+' '.join(s)
 
-def get_serial(open_ports=None, comport=None, verbose=True):
+def open_serial(device):
+    """Open and set up the serial port `device` for access to an MI48"""
+    ser = serial.Serial(device)
+    ser.baudrate = 115200
+    ser.rtscts = True
+    ser.dsrdtr = True
+    ser.timeout = 0.5
+    ser.write_timeout = 0.5
+    return ser
+
+def get_serial(open_ports=None, comport=None, verbose=True, device=None):
     """Open a serial port to which the MI48 is attached.
 
+    If `device` is given, e.g. '/dev/ttyACM0' or the pty of the
+    emulator.USBEmulator, open it directly instead of searching the
+    USB ports for Meridian's VID/PID.
+
     Raise UnboundLocalError if no serial port is successfully open
     """
+    if device is not None:
+        ser = open_serial(device)
+        logger.info('Opened port:\n{}\n'.format(pformat(ser)))
+        return ser
     for p in list(serial.tools.list_ports.comports()):
         if p.vid == MI_VID and p.pid in MI_PIDs:
             # check it is the comport we want and skip if not
@@ -353,21 +901,15 @@ def get_serial(open_ports=None, comport=None, verbose=True):
             if comport is not None and comport not in p.description:
                 continue
             try:
-                ser = serial.Serial(p.device)
+                # here we get a serial device and set it up
+                ser = open_serial(p.device)
             except serial.SerialException:
                 # assume it is open
                 logger.info('Failed opening port:\n{}'.format(p))
                 # do not raise, but check the next port in the list
                 continue
-            # here we already have gotten a serial device; set it up
-            ser.baudrate = 115200
-            ser.rtscts = True
-            ser.dsrdtr = True
-            ser.timeout = 0.5
-            ser.write_timeout = 0.5
             logger.info('Opened USB port:\n{}\n'.format(pformat(ser)))
             break
     # the following return statement will generate UnboundLocalError
     # if no serial was successfully opened
     return ser
-
@@ -0,0 +1,212 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# Conversion of legacy text recordings to the binary recording format
+# of senxor.recording:
+#
+#   * .dat files of write_frame() of older stream_spi.py versions: one
+#     frame per line, space-separated, in degrees C with two decimals
+#     or raw deci-Kelvin; no header and no time
+#   * SenXorViewer CSV files: one frame per line, comma-separated, an
+#     ISO 8601 time, header columns, and the frame, see TestData
+#
+# Files are parsed a block of lines at a time, so memory use is bounded
+# by the block size; the numbers of a block are parsed by np.loadtxt,
+# and its times by numpy's ISO 8601 parser, instead of line by line.
+#
+import os
+import time
+import logging
+import itertools
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from senxor.mi48 import KELVIN_0
+from senxor.crc import crc16_frames
+from senxor.recording import RecordingWriter, HEADER_DTYPE_LE
+
+logger = logging.getLogger(__name__)
+
+FORMAT_DAT = 'dat'
+FORMAT_CSV = 'csv'
+
+# Columns of a SenXorViewer CSV line before the frame; the time must be
+# the first column, if any. Vdd [V] and Tsx [C] may also be raw words.
+VIEWER_CSV_COLUMNS = {
+    'time': 0,
+    'frame_counter': 1,
+    'senxor_vdd': 2,
+    'senxor_temperature': 3,
+}
+
+
+def parse_iso_times(strings):
+    """
+    Return the ISO 8601 time `strings` as float seconds since the epoch.
+
+    Times may carry a time zone suffix (Z, +HH, +HHMM or +HH:MM), as
+    written by datetime.isoformat() or strftime('%z'); times without
+    are taken as UTC. The date and time are parsed by numpy at once;
+    only the suffix is split off per string.
+    """
+    naive, offsets = [], []
+    for s in strings:
+        s = s.strip()
+        if s.endswith('Z'):
+            naive.append(s[:-1])
+            offsets.append('')
+            continue
+        # a sign after the 'T' separator starts the time zone
+        i = max(s.rfind('+'), s.rfind('-'))
+        if i > 10:
+            naive.append(s[:i])
+            offsets.append(s[i:])
+        else:
+            naive.append(s)
+            offsets.append('')
+    seconds = np.array(naive, dtype='datetime64[us]').astype(np.int64) * 1.e-6
+    zones = {}
+    for tz in set(offsets):
+        if not tz:
+            zones[tz] = 0.
+            continue
+        digits = tz[1:].replace(':', '')
+        minutes = 60 * int(digits[:2]) + int(digits[2:4] or 0)
+        zones[tz] = (60. if tz[0] == '+' else -60.) * minutes
+    if len(zones) > 1 or '' not in zones:
+        seconds -= np.array([zones[tz] for tz in offsets])
+    return seconds
+
+def guess_format(path):
+    """Return FORMAT_CSV for a .csv file, else FORMAT_DAT"""
+    if os.path.splitext(path)[1].lower() == '.csv':
+        return FORMAT_CSV
+    return FORMAT_DAT
+
+def to_deci_kelvin(values):
+    """Return uint16 deci-Kelvin of frame `values` in degrees C or dK.
+
+    Values above 1000 (-173 C) are taken as raw deci-Kelvin already.
+    """
+    if values.size and values.min() > 1000:
+        return np.clip(np.rint(values), 0, 0xFFFF).astype(np.uint16)
+    return np.clip(np.rint((values - KELVIN_0) * 10),
+                   0, 0xFFFF).astype(np.uint16)
+
+def _is_data_line(line):
+    """Return False for blank, comment and column-name lines"""
+    line = line.lstrip()
+    return bool(line) and line[0] not in '#"' and not line[0].isalpha()
+
+
+def iter_text_frames(path, fpa_shape=(80, 62), fmt=None, block_lines=256,
+                     columns=VIEWER_CSV_COLUMNS, fps=None):
+    """
+    Yield blocks of (data, headers, host_times) of a legacy text file.
+
+    `data` is (N, pixels) uint16 deci-Kelvin, `headers` are N
+    HEADER_DTYPE_LE records, with the header columns of a CSV file,
+    the frame statistics and the CRC of the data filled in, and
+    `host_times` the CSV times (0 for .dat files).
+
+    The timestamp of a header is the time since the first frame [ms],
+    or, for .dat files, derived from `fps` if given.
+    """
+    fmt = fmt or guess_format(path)
+    data_size = int(np.prod(fpa_shape))
+    delimiter = ',' if fmt == FORMAT_CSV else None
+    has_time = fmt == FORMAT_CSV and columns.get('time') is not None
+    first, t_first = 0, None
+    with open(path, 'r') as f:
+        while True:
+            lines = list(itertools.islice(f, block_lines))
+            if not lines:
+                break
+            lines = [line for line in lines if _is_data_line(line)]
+            if not lines:
+                continue
+            times = None
+            if has_time:
+                fields = [line.partition(',') for line in lines]
+                times = parse_iso_times([t for t, _, _ in fields])
+                lines = [rest for _, _, rest in fields]
+            values = np.loadtxt(lines, delimiter=delimiter, ndmin=2)
+            n = len(values)
+            data = to_deci_kelvin(values[:, -data_size:])
+            headers = np.zeros(n, dtype=HEADER_DTYPE_LE)
+            host_times = np.zeros(n)
+            if fmt == FORMAT_CSV:
+                shift = 1 if has_time else 0
+                for name, col in columns.items():
+                    if name == 'time' or col is None:
+                        continue
+                    headers[name] = values[:, col - shift]
+                if headers['senxor_vdd'].max() > 100:
+                    # raw Vdd word
+                    headers['senxor_vdd'] *= 1.e-4
+                if headers['senxor_temperature'].max() > 1000:
+                    # raw Tsx word
+                    headers['senxor_temperature'] /= 100.
+                    headers['senxor_temperature'] += KELVIN_0
+            if 'frame_counter' not in columns or fmt == FORMAT_DAT:
+                headers['frame_counter'] = np.arange(first, first + n) & 0xFFFF
+            if times is not None:
+                if t_first is None:
+                    t_first = times[0]
+                host_times[:] = times
+                headers['timestamp'] = np.rint(1.e3 * (times - t_first))
+            elif fps:
+                headers['timestamp'] = np.rint(
+                    1.e3 * np.arange(first, first + n) / fps)
+            headers['pixel_max'] = data.max(axis=1) / 10. + KELVIN_0
+            headers['pixel_min'] = data.min(axis=1) / 10. + KELVIN_0
+            headers['crc'] = crc16_frames(data)
+            first += n
+            yield data, headers, host_times
+
+
+def convert_text(src, dst=None, fpa_shape=(80, 62), fmt=None,
+                 block_lines=256, columns=VIEWER_CSV_COLUMNS, fps=None):
+    """
+    Convert the legacy text file `src` to a recording at `dst`.
+
+    `dst` defaults to `src` with a .sxr extension. Other arguments are
+    as of iter_text_frames(). Return (dst, number of frames, seconds).
+    """
+    t0 = time.perf_counter()
+    fmt = fmt or guess_format(src)
+    if dst is None:
+        dst = os.path.splitext(src)[0] + '.sxr'
+    metadata = {'source': os.path.basename(src), 'source_format': fmt}
+    if fps:
+        metadata['fps'] = fps
+    with RecordingWriter(dst, fpa_shape, metadata=metadata,
+                         batch=block_lines) as rec:
+        for data, headers, host_times in iter_text_frames(
+                src, fpa_shape, fmt, block_lines, columns, fps):
+            rec.extend(data, headers, host_times)
+    elapsed = time.perf_counter() - t0
+    logger.debug('{}: {} frames in {:.2f} s'.format(src, rec.nframes, elapsed))
+    return dst, rec.nframes, elapsed
+
+def convert_files(paths, outdir=None, processes=None, **kwargs):
+    """
+    Convert legacy text files to recordings, in a pool of processes.
+
+    Recordings are written next to the files, or into `outdir`.
+    `processes` is the size of the pool, os.cpu_count() if None;
+    with 1, files are converted in this process.
+    Other arguments are passed on to convert_text().
+    Return a list of (dst, number of frames, seconds) per file.
+    """
+    dsts = []
+    for path in paths:
+        dst = os.path.splitext(path)[0] + '.sxr'
+        if outdir is not None:
+            dst = os.path.join(outdir, os.path.basename(dst))
+        dsts.append(dst)
+    convert = functools.partial(convert_text, **kwargs)
+    if processes == 1 or len(paths) < 2:
+        return list(map(convert, paths, dsts))
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(convert, paths, dsts))
@@ -3,6 +3,8 @@
 import sys
 import logging
 import functools
+import contextlib
+import operator
 import time
 import struct
 import array
@@ -12,7 +14,8 @@ import numpy as np
 # The MI48 implements the CRC-16/CCITT-FALSE
 # polynomial = 0x11021, init=0xFFFF, reversed=False, xor-out=0x0000,
 # check=0x29B1 (for input of b'123456789)
-import crcmod.predefined
+# see senxor.crc; crc16 is kept here for backward compatibility
+from senxor.crc import crc16, CRCVerifier
 
 def logger_wrapper(name, level, msg, exc_info=None, logger=None):
     _msg = '{:12s} {}'.format(name, msg)
@@ -37,6 +40,17 @@ SPIHDR_MAXV  = 5
 SPIHDR_MINV  = 6
 SPIHDR_CRC   = 7
 
+# Decoded frame header; see decode_frame_headers()
+FRAME_HEADER_DTYPE = np.dtype([
+    ('frame_counter', np.uint16),
+    ('senxor_vdd', np.float32),             # [V]
+    ('senxor_temperature', np.float32),     # [C]
+    ('timestamp', np.uint32),               # [ms]
+    ('pixel_max', np.float32),              # [C]
+    ('pixel_min', np.float32),              # [C]
+    ('crc', np.uint16),
+])
+
 DEFAULT_CTRL_STAT = {
     'FRAME_MODE': 0x20,
     'STATUS':     0x00,
@@ -85,6 +99,11 @@ regmap = {
     "SENXOR_ID_5"   : 0xE5,  # R  Serial number of the attached camera module
 }
 
+# addresses of the writable registers above, excluding volatile ones
+DEFAULT_CTRL_STAT_ADDR = frozenset(
+    regmap[reg] for reg in DEFAULT_CTRL_STAT
+    if reg not in ('FRAME_MODE', 'STATUS'))
+
 MI48_FRAME_MODE    = 0xB1  # RW Control the capture and readout of thermal data 
 MI48_FW_VERSION_1  = 0xB2  # R  Firmware Version (Major, Minor)
 MI48_FW_VERSION_2  = 0xB3  # R  Firmware Version (Build)
@@ -110,6 +129,36 @@ MI48_SENXOR_ID_4   = 0xE4  # R  Serial number of the attached camera module
 MI48_SENXOR_ID_5   = 0xE5  # R  Serial number of the attached camera module
 MI48_SENXOR_ID_LEN = 6     # number of bytes of the SENXOR_ID
 
+# Classification of registers for the shadow cache of the MI48 object.
+# Volatile registers are changed by the MI48 itself, hence always read
+# from the bus; so is the user flash, at addresses below USER_FLASH_END
+USER_FLASH_END = 0xA0
+VOLATILE_REGS = frozenset([
+    regmap['EVK_TEST'],         # overlaps user flash
+    regmap['SENXOR_POWERUP'],
+    regmap['FRAME_MODE'],       # capture bits clear on completion
+    regmap['STATUS'],           # flags clear on read
+])
+# Writable registers that the MI48 may modify after a write, e.g. the
+# initialisation bit of filter 1; a write invalidates their shadow
+WRITE_INVALIDATE_REGS = frozenset([
+    regmap['FILTER_CTRL'],
+])
+
+# registers read by MI48.get_camera_info()
+CAMERA_INFO_REGS = ['SENXOR_TYPE', 'MODULE_TYPE', 'EVK_ID', 'FRAME_RATE',
+                    'FW_VERSION_1', 'FW_VERSION_2'] +\
+                   ['SENXOR_ID_{}'.format(i) for i in range(MI48_SENXOR_ID_LEN)]
+
+# registers read along with the SENXOR_ID on a warm start, and compared
+# with the cache, to tell if the MI48 was reset or power cycled since
+WARM_START_CHECK_REGS = ['FRAME_RATE', 'FILTER_CTRL']
+
+# Polling intervals [s] while waiting for the MI48 to settle, e.g. to
+# complete boot-up or stop capture; intervals double from min to max
+POLL_MIN_INTERVAL = 0.0005
+POLL_MAX_INTERVAL = 0.025
+
 # STATUS Register Flags Masks
 READOUT_TOO_SLOW = 0x02
 SENXOR_IF_ERROR = 0x04
@@ -131,6 +180,7 @@ SENXOR_NAME = {
     2: 'MI0301',
     3: 'MI0802',
     4: 'MI0802',
+    8: 'panther',
 }
 
 FPA_SHAPE = {
@@ -152,7 +202,28 @@ FPA_SHAPE = {
 }
 
 
-crc16 = crcmod.predefined.mkCrcFun('crc-ccitt-false')
+
+# deci-Kelvin to Celsius conversion tables, per dtype; see dK_to_C_table
+_DK_TO_C_TABLES = {}
+
+def dK_to_C_table(dtype=np.float16):
+    """
+    Return a table mapping each uint16 deci-Kelvin value to Celsius.
+
+    The table has 65536 entries of `dtype` and is computed once per
+    dtype. Index it by a frame, e.g. np.take(table, data), to convert
+    in a single pass, without float64 intermediates.
+    """
+    dtype = np.dtype(dtype)
+    try:
+        return _DK_TO_C_TABLES[dtype]
+    except KeyError:
+        pass
+    table = np.arange(65536, dtype=np.float64) / 10. + KELVIN_0
+    table = table.astype(dtype)
+    table.flags.writeable = False
+    _DK_TO_C_TABLES[dtype] = table
+    return table
 
 
 class MI48:
@@ -160,13 +231,57 @@ class MI48:
     MI48xx abstraction
     """
     def __init__(self, interfaces:list, fps=None, name="MI48",
-                reset_handler=None, data_ready=None, read_raw=False):
-        """Initialise with a serial port"""
+                reset_handler=None, data_ready=None, read_raw=False,
+                shadow=True, cache=None, cache_key=None, dtype=np.float16,
+                crc='every'):
+        """Initialise with a serial port
+
+        Temperature frames are returned as `dtype` (np.float16 or
+        np.float32), unless `read_raw`.
+
+        `crc` is a senxor.crc.CRCVerifier, or its policy: 'every',
+        'every-n', 'deferred' or 'none'. With other than 'every', a
+        frame not verified on reading has `self.crc_error` False.
+
+        `cache` is an optional senxor.cache.CameraCache. If it has an
+        entry for the camera on the control port (`cache_key`, by default
+        the name of the serial port), the camera identity is verified
+        by reading SENXOR_ID, and camera info and the last applied
+        control registers are taken from the cache (warm start), unless
+        the MI48 was reset since, see load_cache().
+        The time spent in each phase of the start-up is stored in
+        `self.startup_timing`.
+        """
+        t_start = time.monotonic()
+        self.startup_timing = {}
+        self._t_phase = t_start
+        # time taken by the MI48 to settle, per phase, see _poll()
+        self.settle_times = {}
         # logging stuff
         self.name = name
         self.log = functools.partial(logger_wrapper, self.name, logger=None)
+        # shadow copy of the non-volatile registers, {address: value},
+        # so that getters do not need a bus round trip; see regread()
+        self.shadow = shadow
+        self._shadow = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # register writes deferred within a batch(), [(address, value)]
+        self._batch = None
+        # set the format of the returned data; note that error handling
+        # during initialisation may need to read a frame
+        self.read_raw = read_raw
+        self.dtype = np.dtype(dtype)
+        # raw frame buffer, reused by read(out=...)
+        self._raw_frame = None
+        if isinstance(crc, str):
+            crc = CRCVerifier(crc)
+        self.crc_verifier = crc
         # interface handles
         self.interfaces = interfaces
+        self.cache = cache
+        self.cache_key = cache_key or self._get_cache_key()
+        self.warm_start = False
         # note that this will potentially clear only the host
         # interface buffers; meanwhile, the MI48 buffers would
         # require different handling, if the MI48 was left in
@@ -178,10 +293,13 @@ class MI48:
             self.data_ready = data_ready
         # this should be read from the camera module
         self.fpa_shape = None
-        # check if EVK without bridge or if Jig board
+        self._startup_phase('interfaces')
+        # check if EVK without bridge or if Jig board;
+        # do not parse frame header if MI48 is not on the core dev board
         self.parse_header = self.has_evk_bridge()
         if not self.parse_header:
             self.powerup()
+        self._startup_phase('evk_bridge')
         # At this stage check that MI48 is not streaming already,
         # which may happen if termination of last stream was not handled 
         # cleanly. If we do not stop the MI48 here, the status handling
@@ -189,14 +307,24 @@ class MI48:
         mode = self.get_mode()
         if mode & (GET_SINGLE_FRAME | CONTINUOUS_STREAM):
 #            # if the MI48 is streaming, it's obviously booted up before
-            self.stop_capture()
+            mode = self.stop_capture()
+        self._startup_phase('stop_capture')
         #
         # check what camera we have
-        self.camera_info = self.get_camera_info()
-        # do not parse frame header if MI48 is not on the core dev board
-        self.parse_header = self.has_evk_bridge()
-        # check status register and raise relevant flags
-        status, mode = self.bootup(verbose=True)
+        if self.cache is not None:
+            self.warm_start = self.load_cache(seed_regs=self.parse_header)
+        if self.warm_start:
+            self._startup_phase('identity')
+            # the MI48 was up and running before; only check status
+            status = self.get_status(verbose=True)
+            if status & BOOTING_UP:
+                status, mode = self.bootup(verbose=True)
+        else:
+            self.camera_info = self.get_camera_info()
+            self._startup_phase('camera_info')
+            # check status register and raise relevant flags
+            status, mode = self.bootup(verbose=True)
+        self._startup_phase('bootup')
         # may need to handle ValueError from above call:
             # happens if USB is still streaming when we restart
             # and instead of RREG (int) we get GFRA acknowledge (array)
@@ -210,16 +338,98 @@ class MI48:
             status, mode = self.error_handler(status, mode, verbose=True)
             self.log(logging.DEBUG, 'Status: {}'.format(hex(status)))
             self.log(logging.DEBUG, 'Mode  : {}'.format(hex(mode)))
+            self._startup_phase('error_handler')
         self.capture_no_header = mode & NO_HEADER
         # reset crc.error
         self.crc_error = False
         # set FPS
         if fps is not None:
             self.set_fps(fps)
-        # set the format of the returned data
-        self.read_raw = read_raw
+        if self.cache is not None:
+            self.save_cache()
+        self.startup_timing['total'] = time.monotonic() - t_start
+        self.log(logging.DEBUG, '{} start-up in {:.1f} ms: {}'.format(
+                 'Warm' if self.warm_start else 'Cold',
+                 1.e3 * self.startup_timing['total'],
+                 ', '.join('{} {:.1f}'.format(k, 1.e3 * v)
+                           for k, v in self.startup_timing.items())))
+
+    def _startup_phase(self, phase):
+        """Record the time since the previous start-up phase"""
+        t = time.monotonic()
+        self.startup_timing[phase] = t - self._t_phase
+        self._t_phase = t
+
+    def _get_cache_key(self):
+        """Return a name of the control port, to key the camera cache"""
+        intface = self.interfaces[0]
+        port = getattr(intface, 'port', None)
+        if port is not None:
+            return str(getattr(port, 'port', None) or port)
+        try:
+            return 'i2c-0x{:02X}'.format(intface.chip_addr)
+        except AttributeError:
+            return self.name
+
+    def load_cache(self, seed_regs=True):
+        """Take camera info from the cache, after verifying the SENXOR_ID.
+
+        The registers of WARM_START_CHECK_REGS are read along with the
+        SENXOR_ID, and must match the cache entry, else the MI48 was
+        reset or power cycled since, and the shadow is invalidated.
+        If `seed_regs`, the control registers stored in the cache then
+        seed the shadow.
+        Return True if a matching entry was found.
+        """
+        check = [regmap[reg] for reg in WARM_START_CHECK_REGS]
+        # one pipelined read with the SENXOR_ID, now in the shadow
+        values = self.regread_many(check +
+                                   ['SENXOR_ID_{}'.format(i)
+                                    for i in range(MI48_SENXOR_ID_LEN)])
+        _, uid_hex, _ = self.get_camera_id()
+        entry = self.cache.get(self.cache_key, uid_hex)
+        try:
+            info = dict(entry['camera_info'])
+            regs = {int(k, 16): v for k, v in entry.get('regs', {}).items()}
+        except (TypeError, KeyError, ValueError, AttributeError):
+            self.log(logging.DEBUG, 'No usable cache entry for {} on {}'.
+                     format(uid_hex, self.cache_key))
+            return False
+        stale = [get_reg_name(reg) for reg, value in zip(check, values)
+                 if reg in regs and regs[reg] != value]
+        if stale:
+            self.log(logging.DEBUG, 'Cache entry for {} on {} is stale ({});'
+                     ' MI48 was reset'.format(uid_hex, self.cache_key,
+                                              ', '.join(stale)))
+            self.invalidate()
+            return False
+        info['NAME'] = self.name
+        self._set_camera_info(info)
+        if seed_regs and self.shadow:
+            for reg, value in regs.items():
+                if self.is_cacheable(reg):
+                    self._shadow.setdefault(reg, value)
+        info['Current FPS'] = self.get_fps()
+        self.camera_info = info
+        self.log(logging.DEBUG, 'Camera info of {} taken from cache'.
+                 format(uid_hex))
+        return True
+
+    def save_cache(self):
+        """Store camera info and the last applied control registers"""
+        if self.cache is None:
+            return
+        regs = {'0x{:02X}'.format(reg): self._shadow[reg]
+                for reg in sorted(DEFAULT_CTRL_STAT_ADDR)
+                if reg in self._shadow}
+        entry = {'camera_info': self.camera_info, 'regs': regs}
+        try:
+            self.cache.put(self.cache_key, self.camera_id, entry)
+        except OSError as e:
+            self.log(logging.WARNING, 'Failed to save camera cache: {}'.
+                     format(e))
 
-    def bootup(self, verbose=False, powerup=False):
+    def bootup(self, verbose=False, powerup=False, boot_timeout=2.0):
         """Ensure bootup of the mi48 is complete, returning MODE and STATUS.
 
         Return all flags raised at any one point while looping and waiting for
@@ -227,33 +437,67 @@ class MI48:
         boot-up. Exception is boot_in_progress flag, as we're handling it here.
         This is necessary because error handling will likely require register
         write, which is allowed only once that bootup is comlete.
+        STATUS is polled with exponential backoff, for up to `boot_timeout`
+        seconds; the time taken is stored in `self.settle_times['bootup']`.
         """
-        # NOTE on the timeout (in seconds) below:
-        # On WINDOWS the clock has poor resolution, which probably
-        # depends on CPU frequency too.
-        timeout = max(0.025, time.get_clock_info('monotonic').resolution)
         if powerup: self.powerup()
         self.check_ctrl_stat_regs()
-        t0 = time.monotonic()
         status = self.get_status(verbose=verbose)
+        if status & BOOTING_UP:
+            # registers read so far may not have been initialised yet
+            self.invalidate()
+            # STATUS flags clear on read; accumulate the ones raised
+            flags = [status]
+            def read_status():
+                flags.append(self.get_status())
+                return flags[-1]
+            last, booted = self._poll('bootup', read_status,
+                lambda st: not st & BOOTING_UP, boot_timeout)
+            if not booted:
+                self.log(logging.ERROR, 'Bootup not complete in {:.0f} ms'.
+                         format(1.e3 * boot_timeout))
+            status = functools.reduce(operator.or_, flags)
+            if verbose and status & ~BOOTING_UP:
+                self.log(logging.WARNING, ', '.join(self.parse_status(status)))
+        else:
+            self.settle_times['bootup'] = 0.
         mode = self.get_mode(verbose=verbose)
-        boot_in_progress = status & BOOTING_UP
-#        no_header = mode & NO_HEADER
-        while boot_in_progress:
-            status = self.get_status(verbose=True)
-            mode = self.get_mode(verbose=True)
-            boot_in_progress = status & BOOTING_UP
-            time.sleep(timeout)
-        t1 = time.monotonic()
-        self.log(logging.DEBUG, 'Bootup complete in {:.0f} ms'.
-                format(1.e3 * (t1-t0)))
+        self.log(logging.DEBUG, 'Bootup complete in {:.1f} ms'.
+                format(1.e3 * self.settle_times['bootup']))
         # clear boot in progress flag as we're done with it
         status = status & (~BOOTING_UP & 0xFF)
         self.log(logging.DEBUG, 'Status: {}'.format(hex(status)))
         self.log(logging.DEBUG, 'Mode  : {}'.format(hex(mode)))
-#        mode = mode & no_header
         return status, mode
 
+    def _poll(self, phase, read, done, timeout, max_interval=POLL_MAX_INTERVAL,
+              pin=None):
+        """Call `read()` until `done(value)` or `timeout` seconds elapse.
+
+        Polling intervals start at POLL_MIN_INTERVAL and double up to
+        `max_interval`. If a `pin` (e.g. DATA_READY) is given, it is waited
+        for instead of sleeping, so that an edge cuts the wait short.
+        Return the last value read and whether done; the time taken is
+        stored in `self.settle_times[phase]`.
+        """
+        t0 = time.monotonic()
+        deadline = t0 + timeout
+        interval = POLL_MIN_INTERVAL
+        value = read()
+        while value is not None and not done(value):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait = min(interval, remaining)
+            if pin is not None and not pin.is_active:
+                pin.wait_for_active(timeout=wait)
+            else:
+                time.sleep(wait)
+            interval = min(2 * interval, max_interval)
+            value = read()
+        self.settle_times[phase] = time.monotonic() - t0
+        return value, value is not None and bool(done(value))
+
     def error_handler(self, status, mode, verbose=False):
         """Attempt to bring the MI48 to a clean state.
 
@@ -298,6 +542,7 @@ class MI48:
                 self.log(logging.ERROR,
                     'SenXor Interface ERROR: Attempting SW reset of MI48')
                 self.reset()
+                self.invalidate()
             except TypeError:
                 # no reset handle provided
                 self.log(logging.ERROR,
@@ -308,6 +553,15 @@ class MI48:
         status = self.get_status(verbose=True)
         return status, mode
 
+    def _reg_addr(self, reg):
+        """Return the address of `reg`, given by name or address"""
+        if isinstance(reg, str):
+            try:
+                return regmap[reg]
+            except KeyError:
+                return int(reg)
+        return reg
+
     def regread(self, reg):
         """Read a control/status register; Allow hex or str for reg"""
         if isinstance(reg, str):
@@ -323,7 +577,65 @@ class MI48:
         else:
             # assume integer; make up the hex representation for logging
             regname = f'0x{reg:02X}'
-        return self.interfaces[0].regread(reg, regname)
+        if self._batch:
+            # read back own deferred writes; flush before reading a
+            # register that the MI48 itself may change
+            for _reg, value in reversed(self._batch):
+                if _reg == reg:
+                    return value
+            if not self.is_cacheable(reg):
+                self.flush()
+        try:
+            value = self._shadow[reg]
+            self.cache_hits += 1
+            return value
+        except KeyError:
+            pass
+        self.cache_misses += 1
+        value = self.interfaces[0].regread(reg, regname)
+        if self.shadow and value is not None and self.is_cacheable(reg):
+            self._shadow[reg] = value
+        return value
+
+    def regread_many(self, regs):
+        """Read a list of registers, given by name or address.
+
+        Return a list of values, in the order of `regs`. Registers not
+        in the shadow are read in sorted order, contiguous addresses
+        in one block transfer if the control interface supports it
+        (I2C), or pipelined if it supports that (USB).
+        """
+        addrs = [self._reg_addr(reg) for reg in regs]
+        pending = dict(self._batch) if self._batch else {}
+        values = {}
+        missing = set()
+        for addr in addrs:
+            if addr in pending or addr in self._shadow:
+                values[addr] = self.regread(addr)
+            else:
+                missing.add(addr)
+        if not missing:
+            return [values[addr] for addr in addrs]
+        if self._batch:
+            self.flush()
+        missing = sorted(missing)
+        intface = self.interfaces[0]
+        self.cache_misses += len(missing)
+        if hasattr(intface, 'regread_block'):
+            for start, length in contiguous_runs(missing):
+                block = intface.regread_block(start, length,
+                                              get_reg_name(start))
+                values.update(zip(range(start, start + length), block))
+        elif hasattr(intface, 'regread_batch'):
+            values.update(zip(missing, intface.regread_batch(missing)))
+        else:
+            for addr in missing:
+                values[addr] = intface.regread(addr, get_reg_name(addr))
+        for addr in missing:
+            value = values[addr]
+            if self.shadow and value is not None and self.is_cacheable(addr):
+                self._shadow[addr] = value
+        return [values[addr] for addr in addrs]
 
     def regwrite(self, reg, value):
         """Write to a control register"""
@@ -332,38 +644,166 @@ class MI48:
             reg = regmap[regname]
         else:
             regname = ""
-        return self.interfaces[0].regwrite(reg, value, regname)
+        if self._batch is not None:
+            self._batch.append((reg, value))
+            return None
+        result = self.interfaces[0].regwrite(reg, value, regname)
+        self._update_shadow(reg, value)
+        return result
+
+    def _update_shadow(self, reg, value):
+        """Update the shadow after writing `value` to address `reg`"""
+        if reg == regmap['SENXOR_POWERUP']:
+            # registers are reloaded from flash
+            self.invalidate()
+        elif reg in WRITE_INVALIDATE_REGS:
+            self._shadow.pop(reg, None)
+        elif self.shadow and self.is_cacheable(reg):
+            # write-through; writes to read-only registers are ignored
+            # by the MI48, so a later read would tell the truth
+            if reg in self._shadow or reg in DEFAULT_CTRL_STAT_ADDR:
+                self._shadow[reg] = value
+
+    def regwrite_many(self, regs_values):
+        """Write a list of (reg, value), reg being a name or an address.
+
+        If the control interface supports it (USB), the writes are
+        pipelined, i.e. sent back to back before collecting the acks.
+        """
+        regs_values = [(regmap[reg] if isinstance(reg, str) else reg, value)
+                       for reg, value in regs_values]
+        if self._batch is not None:
+            self._batch.extend(regs_values)
+            return None
+        if not regs_values:
+            return None
+        intface = self.interfaces[0]
+        if hasattr(intface, 'regwrite_batch'):
+            intface.regwrite_batch(regs_values)
+        elif hasattr(intface, 'regwrite_block'):
+            # coalesce writes to ascending consecutive addresses,
+            # without changing the order of the writes
+            start, block = regs_values[0][0], []
+            for reg, value in regs_values:
+                if reg != start + len(block):
+                    intface.regwrite_block(start, block, get_reg_name(start))
+                    start, block = reg, []
+                block.append(value)
+            intface.regwrite_block(start, block, get_reg_name(start))
+        else:
+            for reg, value in regs_values:
+                intface.regwrite(reg, value, get_reg_name(reg))
+        for reg, value in regs_values:
+            self._update_shadow(reg, value)
+        return None
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Defer register writes until the end of the with-block.
 
-    def read(self):
-        """Read a data frame
+        Usage:
 
-        Return the temperature data or (data, header), where the
-        header is a dictionary.
-        The returned data is a 2D array of np.float16 representing the
-        temperature in Celsius.
-        Header values if requested are also decoded from bytes.
+            with mi48.batch():
+                mi48.set_fps(15)
+                mi48.set_emissivity(95)
+                mi48.set_offset_corr(0.0)
+
+        All deferred writes are then sent in order by regwrite_many().
+        Reading a register that is written within the block returns the
+        value written; reading a volatile register sends the writes
+        deferred so far, and so does enable_filter(), which then waits
+        for the filters to settle. Writes are discarded if the block
+        raises.
+        """
+        if self._batch is not None:
+            # nested; the outermost batch sends the writes
+            yield self
+            return
+        self._batch = []
+        try:
+            yield self
+        except BaseException:
+            self._batch = None
+            raise
+        self.flush()
+        self._batch = None
+
+    def flush(self):
+        """Send the register writes deferred by batch() so far"""
+        if self._batch:
+            regs_values, self._batch = self._batch, None
+            try:
+                self.regwrite_many(regs_values)
+            finally:
+                self._batch = []
+
+    def is_cacheable(self, reg):
+        """Return True if register address `reg` may be served from the shadow"""
+        return reg >= USER_FLASH_END and reg not in VOLATILE_REGS
+
+    def invalidate(self, regs=None):
+        """Drop `regs` (names or addresses; default all) from the shadow"""
+        if regs is None:
+            self._shadow.clear()
+            return
+        for reg in regs:
+            if isinstance(reg, str):
+                reg = regmap[reg]
+            self._shadow.pop(reg, None)
+
+    def refresh(self, regs=None):
+        """Re-read registers from the bus into the shadow.
+
+        `regs` is a list of register names or addresses; by default,
+        the registers currently in the shadow, plus the RW registers
+        in DEFAULT_CTRL_STAT.
+        Return a dictionary {address: value}.
         """
+        if regs is None:
+            regs = set(self._shadow) | DEFAULT_CTRL_STAT_ADDR
+        regs = sorted(regmap[reg] if isinstance(reg, str) else reg
+                      for reg in regs)
+        self.invalidate(regs)
+        return dict(zip(regs, self.regread_many(regs)))
+
+
+    def get_frame_size(self):
+        """Return the number of 16-bit words in a frame, incl. header"""
         # figure out how many words to get; recall 2 bytes per pixel
-        data_size = np.prod(self.fpa_shape)
-        size_in_words = data_size
+        size_in_words = int(np.prod(self.fpa_shape))
         if not self.capture_no_header:
             size_in_words += self.cols
+        return size_in_words
+
+    def read_words(self, out=None):
+        """Read a raw frame from the data interface.
+
+        Return a 1-D array of uint16, with the optional header followed
+        by the data frame, or None if the interface failed to deliver.
+        If `out` is given, the frame is stored in it and `out` returned.
+        """
+        size_in_words = self.get_frame_size()
         # print('Reading {} words'.format(size_in_words))
 
         # The spi device must provide read(number-of-bytes) function
-        response = self.interfaces[1].read(size_in_words)
+        if out is None:
+            return self.interfaces[1].read(size_in_words)
+        return self.interfaces[1].read(size_in_words, out=out)
 
+    def parse_frame(self, response):
+        """Split a raw frame into data and header, and check the CRC.
+
+        Return (data, header), where data is the raw uint16 frame
+        and header is None if not parsed.
+        Raise TypeError if `response` is None.
+        """
+        data_size = int(np.prod(self.fpa_shape))
         # Obtain the data but do NOT convert to degrees C yet,
         # because we have to calculate CRC on it first.
         # Assume the interfaces[1].read() returns 16-bit integers
         # Recall that the temperature data frame is after the
         # optional header
-        try:
-            data = response[-data_size:]
-        except TypeError:
-            # if interface.read() yields None we've got an error
-            return None, None
+        data = response[-data_size:]
 
         # Parse the optional header; else return the data
         # If the MI48 is not on the core-development board, do not parse
@@ -372,24 +812,66 @@ class MI48:
         else:
             _header = response[:-data_size]
             header = self.parse_frame_header(_header)
-            self.crc_error = False
             # check crc
             # note that MI48 implements CRC-16/CCITT-FALSE which
             # must be initialised with 0xFFFF
-            _crc = crc16(data)
-            if not header['crc'] == hex(_crc):
-                self.crc_error = True
+            self.crc_error = bool(self.crc_verifier.check(data,
+                header['crc'], tag=int(header['frame_counter'])))
+            if self.crc_error:
                 self.log(logging.ERROR, 'Frame CRC error. '+
                     'Header CRC: {}, Data CRC: {}'.\
-                    format(header['crc'], hex(_crc)))
+                    format(hex(header['crc']), hex(crc16(data))))
+        return data, header
+
+    def read(self, out=None):
+        """Read a data frame
+
+        Return the temperature data or (data, header), where the
+        header is a dictionary.
+        The returned data is a 1D array of self.dtype (np.float16 by
+        default) representing the temperature in Celsius.
+        Header values if requested are also decoded from bytes.
+
+        If `out` is given (an array of the FPA size, np.float16 or
+        np.float32, or np.uint16 if `read_raw`), the data is written
+        into it, and the raw frame is read into a buffer reused by
+        every call, so that no memory is allocated per frame.
+        """
+        if out is not None:
+            size = self.get_frame_size()
+            if self._raw_frame is None or len(self._raw_frame) != size:
+                self._raw_frame = np.empty(size, dtype=np.uint16)
+            response = self.read_words(out=self._raw_frame)
+        else:
+            response = self.read_words()
+        try:
+            data, header = self.parse_frame(response)
+        except TypeError:
+            # if interface.read() yields None we've got an error
+            return None, None
 
         # Once we have done the CRC check, convert to degrees C
         # unless raw numbers are requested
+        return self.convert_data(data, out=out), header
+
+    def convert_data(self, data, out=None):
+        """Convert raw data to degrees C, unless raw data is requested
+
+        Conversion is a look-up in a table of all 65536 possible
+        deci-Kelvin values, see dK_to_C_table(). The result is written
+        into `out` if given, else into a new array of self.dtype.
+        """
         if self.read_raw:
-            return data, header
-        else:
-            data = data / 10. + KELVIN_0
-            return data.astype(np.float16), header
+            if out is None:
+                return data
+            np.copyto(out.reshape(-1), data)
+            return out
+        if out is None:
+            table = dK_to_C_table(self.dtype)
+            return np.take(table, data, mode='clip')
+        table = dK_to_C_table(out.dtype)
+        np.take(table, data, out=out.reshape(-1), mode='clip')
+        return out
 
     def has_evk_bridge(self):
         """
@@ -498,7 +980,10 @@ class MI48:
         except AttributeError:
             # if we haven't yet read the info from camera module
             pass
-        # read camera module info
+        # read camera module info; fetch all registers involved at once,
+        # so that the getters below are served from the shadow
+        if self.shadow:
+            self.regread_many(CAMERA_INFO_REGS)
         res = {}
         self.camera_info = res
         res['NAME'] = self.name
@@ -510,6 +995,14 @@ class MI48:
         res['CAMERA_MFG'] = uid_hexsn
         res['SN'] = 'SN'+uid_hex
         res['FW_VERSION'] = self.get_fw_version()
+        self._set_camera_info(res)
+        # note that current FPS requires self.maxfps, 
+        # becuase we can only read the divisor
+        res['Current FPS'] = self.get_fps()
+        return res
+
+    def _set_camera_info(self, res):
+        """Set camera attributes from the camera info dictionary `res`"""
         self.camera_type = res['CAMERA_TYPE']
         self.module_type = res['MODULE_TYPE']
         self.camera_name = SENXOR_NAME[self.camera_type]
@@ -520,20 +1013,15 @@ class MI48:
         self.camera_id_hexsn = res['CAMERA_MFG']
         self.sn = res['SN'].upper()
         self.fw_version = res['FW_VERSION']
-        res['MAX_FPS'] = self.get_max_fps()
+        if 'MAX_FPS' not in res:
+            res['MAX_FPS'] = self.get_max_fps()
         self.maxfps = res['MAX_FPS']
-        # note that current FPS requires self.maxfps, 
-        # becuase we can only read the divisor
-        res['Current FPS'] = self.get_fps()
-        return res
 
     def get_ctrl_stat_regs(self):
         """Read all registers, return a dictionary {'RegName': 0xValue}"""
-        res = {}
         self.log(logging.DEBUG, 'Reading Control and Status Regs:')
-        for reg in list(DEFAULT_CTRL_STAT.keys()):
-            res[reg] = self.regread(reg)
-        return res
+        regs = list(DEFAULT_CTRL_STAT.keys())
+        return dict(zip(regs, self.regread_many(regs)))
 
     def check_ctrl_stat_regs(self, expect=None):
         """Check control and statuts registers as expected"""
@@ -640,6 +1128,8 @@ class MI48:
             msg += ' Filter 3 ({})'.format(hex(fctrl & 0x20))
         self.log(logging.DEBUG, msg)
         self.regwrite('FILTER_CTRL', fctrl)
+        # the filters need time to settle, also within batch()
+        self.flush()
         time.sleep(40.e-3)
         self.log(logging.DEBUG, 'FILTER_CONTROL {}'.format(
                  hex(self.get_filter_ctrl())))
@@ -671,8 +1161,7 @@ class MI48:
         return None
 
     def get_filter_1(self):
-        lsb = self.regread('FILTER_1_LSB')
-        msb = self.regread('FILTER_1_MSB')
+        lsb, msb = self.regread_many(['FILTER_1_LSB', 'FILTER_1_MSB'])
         res = (msb << 8) + lsb
         return res
 
@@ -682,8 +1171,7 @@ class MI48:
             msb = DEFAULT_CTRL_STAT['FILTER_1_MSB']
         lsb = setting & 0xFF
         msb = (setting & 0xFF00) >> 8
-        self.regwrite('FILTER_1_LSB', lsb)
-        self.regwrite('FILTER_1_MSB', msb)
+        self.regwrite_many([('FILTER_1_LSB', lsb), ('FILTER_1_MSB', msb)])
         return None
 
     def set_filter_2(self, setting=DEFAULT_CTRL_STAT['FILTER_2']):
@@ -731,9 +1219,8 @@ class MI48:
     def get_camera_id(self):
         """Read SenXor_ID register; Return string Year.Week.Fab.SerNum
         """
-        uid = []
-        for i in range(0, MI48_SENXOR_ID_LEN):
-            uid.append(self.regread('SENXOR_ID_{}'.format(i)))
+        uid = self.regread_many(['SENXOR_ID_{}'.format(i)
+                                 for i in range(0, MI48_SENXOR_ID_LEN)])
         uid_hex = bytearray(uid).hex()
         year = 2000 + uid[0]
         week = uid[1]
@@ -746,8 +1233,7 @@ class MI48:
 
     def get_fw_version(self):
         """Get maj.min.build of EVK FW; return as a string"""
-        fwv = self.regread('FW_VERSION_1')
-        fwb = self.regread('FW_VERSION_2')
+        fwv, fwb = self.regread_many(['FW_VERSION_1', 'FW_VERSION_2'])
         fwv_major = (fwv >> 4) & 0xF
         fwv_minor = fwv & 0xF
         fwv_build = fwb
@@ -768,23 +1254,16 @@ class MI48:
         The parameters are stored at `base_addr` in the user
         flash space, using little-endian order, i.e.  LSB to 0x00 etc.,
         in the form of 4--byte IEEE-754 numbers.
+        User flash must be enabled, see enable_user_flash().
         """
-        params = []
-        for i in range(npar):
-            # Parameters are stored as IEEE-754 floats, i.e. 4-bytes,
-            # little endian.
-            # When we read the MI48 we get back unsigned int for each
-            # byte.
-            int_list = []
-            for j in range(4):
-                flash_addr = base_addr + 4 * i + j
-                int_list.append(self.regread(flash_addr))
-                time.sleep(1)
-            byte_array = array.array('B', int_list)
-            params.append(struct.unpack('<f', byte_array)[0])
-        return params
-
-    def store_compensation_params(self, params, base_addr=0, timeout=0.5):
+        # all bytes are read in one go; in blocks over I2C,
+        # pipelined over USB
+        int_list = self.regread_many(range(base_addr, base_addr + 4 * npar))
+        byte_array = array.array('B', int_list)
+        return list(struct.unpack('<{}f'.format(npar), byte_array))
+
+    def store_compensation_params(self, params, base_addr=0, timeout=0.5,
+                                  retries=1):
         """
         Write compensation parameters to user space of MI48 flash.
 
@@ -792,33 +1271,46 @@ class MI48:
         a 4-byte IEEE-754 representation and stored in sequence,
         starting from `base_addr` in the user flash space, using
         little-endian order, i.e.  LSB to `base_addr`
+
+        Rather than waiting a fixed time per byte, the flash is read
+        back, with increasing intervals, until it holds the parameters,
+        or `timeout` seconds elapse; bytes still not matching are then
+        written again, up to `retries` times.
+        Return True if the parameters are verified, False otherwise.
         """
-        for i, p in enumerate(params):
-            byte_array = struct.pack('<f', p)
-            int_list = list(byte_array)
-            assert len(list(byte_array)) == 4
-            for j, uint8 in enumerate(int_list):
-                flash_addr = base_addr + 4 * i + j
-                self.regwrite(flash_addr, uint8)
-                # writing to a flash memory; not sure of the speed
-                time.sleep(timeout)
+        int_list = list(struct.pack('<{}f'.format(len(params)), *params))
+        addrs = range(base_addr, base_addr + len(int_list))
+        to_write = list(zip(addrs, int_list))
+        for attempt in range(retries + 1):
+            self.regwrite_many(to_write)
+            t0 = time.monotonic()
+            delay = 0.001
+            while True:
+                readback = self.regread_many(addrs)
+                to_write = [(addr, value) for addr, value, rb
+                            in zip(addrs, int_list, readback) if rb != value]
+                if not to_write:
+                    self.log(logging.DEBUG, 'Flash verified in {:.0f} ms'.
+                             format(1.e3 * (time.monotonic() - t0)))
+                    return True
+                if time.monotonic() - t0 > timeout:
+                    break
+                time.sleep(delay)
+                delay = min(2 * delay, 0.05)
+            self.log(logging.WARNING, '{} flash bytes not verified in {} s'.
+                     format(len(to_write), timeout))
+        self.log(logging.ERROR, 'Failed to store compensation parameters')
+        return False
 
     def parse_frame_header(self, header: list):
         """
-        Return a dictionary with parsed head items in appropriate type.
+        Return a FRAME_HEADER_DTYPE record with parsed header items.
 
-        Assume header is already a list of 16 bit unsigned int or similar
+        Items are accessed by key, as in a dictionary, e.g.
+        header['frame_counter']. Assume header is already a list
+        of 16 bit unsigned int or similar
         """
-        result = {}
-        result['frame_counter']         = header[SPIHDR_FRCNT]
-        result['senxor_vdd']            = header[SPIHDR_SXVDD] / 1.0e4
-        result['senxor_temperature']    = header[SPIHDR_SXTA] / 100. + KELVIN_0
-        result['timestamp']             = (header[SPIHDR_TIME + 1] << 16) +\
-                                          header[SPIHDR_TIME]
-        result['pixel_max']             = header[SPIHDR_MAXV] / 10. + KELVIN_0
-        result['pixel_min']             = header[SPIHDR_MINV] / 10. + KELVIN_0
-        result['crc']                   = hex(header[SPIHDR_CRC])
-        return result
+        return decode_frame_headers(header)
 
     def start(self, stream=True, with_header=True):
         """
@@ -843,7 +1335,14 @@ class MI48:
 
     def stop_capture(self, verbose=True, poll_timeout=0.1,
                      stop_timeout=0.3):
-        """Stop capture; currently clears the FRAME_MODE register."""
+        """Stop capture; currently clears the FRAME_MODE register.
+
+        FRAME_MODE is then polled with exponential backoff, up to
+        `poll_timeout` seconds apart, until capture stops or `stop_timeout`
+        seconds elapse. With a DATA_READY pin, the completion of the last
+        frame ends the wait early. The time taken is stored in
+        `self.settle_times['stop_capture']`.
+        """
         # Attempt to stop capture; do not tamper with other bits except
         # the ones for initiating/stopping data acquisition
         mode = self.get_mode()
@@ -853,22 +1352,22 @@ class MI48:
         _mode = mode & (~(GET_SINGLE_FRAME | CONTINUOUS_STREAM) & 0xFF)
         # self.log(logging.DEBUG, 'Writing 0x{:02X}'.format(_mode))
         self.regwrite('FRAME_MODE', _mode)
-        t0 = time.time()
-        delay = 0
-        while mode & (GET_SINGLE_FRAME | CONTINUOUS_STREAM) != 0x00:
-            mode = self.get_mode(verbose)
-            if mode is None:
-                self.log(logging.DEBUG, 'Lost access to camera interface.')
-                return None
-            time.sleep(poll_timeout)  # in ms
-            delay = time.time() - t0
-            if delay > stop_timeout:  # in ms
-                self.log(logging.DEBUG,
-                         'Camera module failed to stop in {:.0f} ms'.\
-                         format(1.e3 * stop_timeout))
-                return mode
-        self.log(logging.DEBUG, 'Camera module stopped in {:.0f} ms.'.
-            format(1.e3 * delay))
+        mode, stopped = self._poll('stop_capture',
+            self.get_mode,
+            lambda m: not m & (GET_SINGLE_FRAME | CONTINUOUS_STREAM),
+            stop_timeout, max_interval=poll_timeout,
+            pin=getattr(self, 'data_ready', None))
+        if mode is None:
+            self.log(logging.DEBUG, 'Lost access to camera interface.')
+            return None
+        if not stopped:
+            self.log(logging.DEBUG,
+                     'Camera module failed to stop in {:.0f} ms'.\
+                     format(1.e3 * stop_timeout))
+            self.get_mode(verbose)
+            return mode
+        self.log(logging.DEBUG, 'Camera module stopped in {:.1f} ms.'.
+            format(1.e3 * self.settle_times['stop_capture']))
         return mode
 
     def clear_interface_buffers(self):
@@ -886,6 +1385,7 @@ class MI48:
         """Stop capture and close ports to device"""
         # stop external device first
         self.log(logging.DEBUG, 'Stopping camera module')
+        self.save_cache()
         self.stop_capture(poll_timeout=poll_timeout,
                           stop_timeout=stop_timeout)
         # close the interfaces
@@ -894,6 +1394,7 @@ class MI48:
         self.log(logging.DEBUG, 'Closing host interfaces')
         self.clear_interface_buffers()
         self.close_interfaces()
+        self.crc_verifier.close()
         return None
 
     def __repr__(self):
@@ -905,12 +1406,80 @@ class MI48:
         _s.append('SenXor ID {}'.format(self.camera_id))
         return '\n'.join(_s)
 
+def contiguous_runs(addrs):
+    """Return [(start, length)] of runs of consecutive sorted `addrs`"""
+    runs = []
+    for addr in addrs:
+        if runs and addr == runs[-1][0] + runs[-1][1]:
+            runs[-1][1] += 1
+        else:
+            runs.append([addr, 1])
+    return [tuple(run) for run in runs]
+
 def get_reg_name(addr):
     """Given a register address, return its name"""
     for key, val in regmap.items():
         if val == addr: return key
     return 'Unknown reg: 0x{:02X}'.format(addr)
 
+def decode_frame_headers(words, out=None):
+    """
+    Decode raw frame header words into FRAME_HEADER_DTYPE records.
+
+    `words` is a 1-D header of uint16, or an (N, cols) block of headers,
+    e.g. from a recording. Return a single record (np.void) for a 1-D
+    header, else an array of N records, written into `out` if given.
+    """
+    words = np.asarray(words)
+    if words.ndim == 1 and out is None:
+        # a single header is decoded faster by scalar arithmetic
+        w = words[:SPIHDR_CRC + 1].tolist()
+        return np.array((w[SPIHDR_FRCNT],
+                         w[SPIHDR_SXVDD] / 1.0e4,
+                         w[SPIHDR_SXTA] / 100. + KELVIN_0,
+                         (w[SPIHDR_TIME + 1] << 16) + w[SPIHDR_TIME],
+                         w[SPIHDR_MAXV] / 10. + KELVIN_0,
+                         w[SPIHDR_MINV] / 10. + KELVIN_0,
+                         w[SPIHDR_CRC]), dtype=FRAME_HEADER_DTYPE)[()]
+    single = words.ndim == 1
+    words = np.atleast_2d(words)
+    if out is None:
+        out = np.empty(len(words), dtype=FRAME_HEADER_DTYPE)
+    out['frame_counter'] = words[:, SPIHDR_FRCNT]
+    out['senxor_vdd'] = words[:, SPIHDR_SXVDD] / 1.0e4
+    out['senxor_temperature'] = words[:, SPIHDR_SXTA] / 100. + KELVIN_0
+    out['timestamp'] = words[:, SPIHDR_TIME + 1].astype(np.uint32) << 16
+    out['timestamp'] |= words[:, SPIHDR_TIME]
+    out['pixel_max'] = words[:, SPIHDR_MAXV] / 10. + KELVIN_0
+    out['pixel_min'] = words[:, SPIHDR_MINV] / 10. + KELVIN_0
+    out['crc'] = words[:, SPIHDR_CRC]
+    return out[0] if single else out
+
+def encode_frame_headers(headers, ncols):
+    """
+    Encode FRAME_HEADER_DTYPE records into raw header words.
+
+    Inverse of decode_frame_headers(): return an (N, ncols) uint16
+    array for N records, or an `ncols` array for a single record;
+    header words that are not decoded are zero.
+    """
+    headers = np.asarray(headers)
+    single = headers.ndim == 0
+    headers = np.atleast_1d(headers)
+    words = np.zeros((len(headers), ncols), dtype=np.uint16)
+    words[:, SPIHDR_FRCNT] = headers['frame_counter']
+    words[:, SPIHDR_SXVDD] = np.rint(headers['senxor_vdd'] * 1.0e4)
+    words[:, SPIHDR_SXTA] = np.rint((headers['senxor_temperature'].
+                                     astype(np.float64) - KELVIN_0) * 100)
+    words[:, SPIHDR_TIME] = headers['timestamp'] & 0xFFFF
+    words[:, SPIHDR_TIME + 1] = headers['timestamp'] >> 16
+    words[:, SPIHDR_MAXV] = np.rint((headers['pixel_max'].
+                                     astype(np.float64) - KELVIN_0) * 10)
+    words[:, SPIHDR_MINV] = np.rint((headers['pixel_min'].
+                                     astype(np.float64) - KELVIN_0) * 10)
+    words[:, SPIHDR_CRC] = headers['crc']
+    return words[0] if single else words
+
 def format_header(hdr):
     """Format frame header to represent in log messages"""
     s = "FID{:6d}  time{:8d}  V_dd {:5.3f}  T_SX {:5.2f}".\
@@ -0,0 +1,185 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# Predictive polling of STATUS.DATA_READY, for boards without a
+# DATA_READY pin.
+#
+# Frames come at a steady period, set by the FRAME_RATE divisor, so
+# there is no point in polling STATUS long before the next frame is
+# due. The poller sleeps until shortly before the expected time, then
+# polls tightly, and corrects its prediction with every frame seen.
+#
+import time
+import logging
+from collections import deque
+import numpy as np
+
+from senxor.mi48 import DATA_READY, POLL_MIN_INTERVAL, POLL_MAX_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class StatusPoller:
+    """
+    Wait for DATA_READY by polling STATUS, at the expected frame times.
+
+    A stand-in for the DATA_READY pin, for the reader of the frames:
+
+        poller = StatusPoller(mi48)
+        mi48.start(stream=True, with_header=True)
+        while True:
+            poller.wait_for_active()
+            data, header = mi48.read()
+            poller.update(header)
+
+    The frame period starts from the frame rate of `mi48` (FRAME_RATE
+    divisor), and is learned from the `timestamp` and `frame_counter`
+    of the headers passed to update(), or else from the times at which
+    DATA_READY is seen. The next frame is expected a period after the
+    last one became ready; the poller sleeps until `guard` seconds
+    before, then polls every `poll_interval` seconds. The guard adapts
+    to the error of the prediction, so drift is tracked. When no frame
+    comes as expected, e.g. as capture stops, polling backs off to
+    every `max_interval` seconds.
+
+    `timestamp` is the estimated time, as time.time(), at which the
+    last frame became ready: halfway between the last poll without and
+    the poll with DATA_READY. Call reset() after changing the frame rate.
+    """
+    def __init__(self, mi48, poll_interval=POLL_MIN_INTERVAL,
+                 max_interval=POLL_MAX_INTERVAL, guard=0.002,
+                 min_guard=0.0005, history=256):
+        self.mi48 = mi48
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.min_guard = min_guard
+        self.guard = guard
+        self.timestamp = None
+        self.status = 0
+        self.frames = 0
+        self.polls = 0
+        self.early = 0
+        self._guard0 = guard
+        self._polls = deque(maxlen=history)
+        self._latencies = deque(maxlen=history)
+        self.reset()
+
+    def reset(self):
+        """Forget the prediction, e.g. after a change of frame rate"""
+        self.period = 1. / self.mi48.get_fps()
+        self.jitter = 0.
+        self.guard = self._guard0
+        self._t_ready = None        # monotonic time the last frame was ready
+        self._t_next = None         # monotonic time the next one is due
+        self._last_header = None    # (frame_counter, timestamp [ms])
+
+    def _read_status(self):
+        """Read STATUS; return the status and the monotonic time of sampling"""
+        t0 = time.monotonic()
+        self.status = self.mi48.get_status()
+        self.polls += 1
+        return self.status, 0.5 * (t0 + time.monotonic())
+
+    @property
+    def is_active(self):
+        return bool(self._read_status()[0] & DATA_READY)
+
+    def wait_for_active(self, timeout=None):
+        """Wait until DATA_READY is set; return False on timeout"""
+        t0 = time.monotonic()
+        deadline = None if timeout is None else t0 + timeout
+        slept = False
+        if self._t_next is not None:
+            wake = self._t_next - self.guard
+            if deadline is not None:
+                wake = min(wake, deadline)
+            if wake > t0:
+                time.sleep(wake - t0)
+                slept = True
+        polls = 0
+        interval = self.poll_interval
+        t_miss = None       # sampling time of the last poll without data
+        while True:
+            status, t_sample = self._read_status()
+            polls += 1
+            if status & DATA_READY:
+                break
+            t_miss = t_sample
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                self._polls.append(polls)
+                return False
+            if self._t_next is None or now > self._t_next + self.period:
+                # no frame where expected; stop polling tightly
+                interval = min(2 * interval, self.max_interval)
+            wait = interval
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            time.sleep(wait)
+        t_seen = time.monotonic()
+        if t_miss is None:
+            # ready before the first poll; the time is not known, so
+            # keep to the predicted schedule, rather than anchoring
+            # the next prediction on a late sample
+            t_ready = t_sample
+            if self._t_next is not None:
+                t_ready = min(t_sample, self._t_next)
+            if slept:
+                # woken up too late
+                self.early += 1
+                self.guard = min(1.5 * self.guard, 0.5 * self.period)
+        else:
+            t_ready = 0.5 * (t_miss + t_sample)
+            self._learn(t_ready)
+        self._polls.append(polls)
+        self._latencies.append(t_seen - t_ready)
+        self.frames += 1
+        self._t_ready = t_ready
+        self._t_next = t_ready + self.period
+        self.timestamp = time.time() - (t_seen - t_ready)
+        return True
+
+    def _learn(self, t_ready):
+        """Update guard and, without headers, period from a ready time"""
+        if self._t_next is not None:
+            error = t_ready - self._t_next
+            self.jitter += 0.1 * (abs(error) - self.jitter)
+            target = 3 * self.jitter + self.poll_interval
+            self.guard += 0.2 * (target - self.guard)
+            self.guard = min(max(self.guard, self.min_guard),
+                             0.5 * self.period)
+        if self._last_header is None and self._t_ready is not None:
+            interval = t_ready - self._t_ready
+            n = max(int(round(interval / self.period)), 1)
+            self.period += 0.05 * (interval / n - self.period)
+
+    def update(self, header):
+        """Learn the frame period from the header of the frame just read"""
+        if header is None:
+            return
+        counter, timestamp = int(header['frame_counter']),\
+                             int(header['timestamp'])
+        if self._last_header is not None:
+            frames = (counter - self._last_header[0]) & 0xFFFF
+            elapsed = (timestamp - self._last_header[1]) & 0xFFFFFFFF
+            if frames and elapsed:
+                period = 1.e-3 * elapsed / frames
+                if abs(period - self.period) > 0.25 * self.period:
+                    # frame rate changed
+                    self.period = period
+                else:
+                    self.period += 0.2 * (period - self.period)
+        self._last_header = (counter, timestamp)
+
+    def stats(self):
+        """Return polls per frame and the latency added by polling [ms]"""
+        stats = {'frames': self.frames, 'polls': self.polls,
+                 'early': self.early,
+                 'period': 1.e3 * self.period,
+                 'guard': 1.e3 * self.guard}
+        if self._polls:
+            stats['polls_per_frame'] = float(np.mean(self._polls))
+        if self._latencies:
+            latencies = 1.e3 * np.array(self._latencies)
+            stats['added_latency_mean'] = float(latencies.mean())
+            stats['added_latency_max'] = float(latencies.max())
+        return stats
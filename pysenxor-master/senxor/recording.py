@@ -0,0 +1,301 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# Binary recording of MI48 frames.
+#
+# File layout:
+#   magic (8 bytes) | JSON length (uint32 LE) | JSON metadata | zero padding
+#   to a multiple of RECORD_ALIGN | records
+#
+# All records have the same size, so the records part of the file is
+# a plain array that is memory-mapped by the reader. Each record is
+#   host_time (float64), frame header (FRAME_HEADER_DTYPE),
+#   data (raw uint16 deci-Kelvin, FPA size)
+# all little endian. Records are only ever appended, so a file that is
+# still being written, or was cut short, can be read up to its last
+# complete record.
+#
+import json
+import time
+import struct
+import logging
+import numpy as np
+
+from senxor.mi48 import FRAME_HEADER_DTYPE, dK_to_C_table
+from senxor.crc import verify_frames
+
+logger = logging.getLogger(__name__)
+
+RECORDING_MAGIC = b'SXRECv1\x00'
+RECORDING_VERSION = 1
+RECORD_ALIGN = 64
+
+HEADER_DTYPE_LE = FRAME_HEADER_DTYPE.newbyteorder('<')
+
+def record_dtype(data_size):
+    """Return the dtype of a recorded frame of `data_size` pixels"""
+    return np.dtype([('host_time', '<f8'),
+                     ('header', HEADER_DTYPE_LE),
+                     ('data', '<u2', (data_size,))])
+
+def write_preamble(f, magic, metadata):
+    """Write `magic` and JSON `metadata` to file `f`, padded to RECORD_ALIGN"""
+    meta = json.dumps(metadata).encode('utf-8')
+    preamble = magic + struct.pack('<I', len(meta)) + meta
+    preamble += bytes(-len(preamble) % RECORD_ALIGN)
+    f.write(preamble)
+    return len(preamble)
+
+def read_preamble(f, magic):
+    """Return (metadata, size of preamble) read from file `f`.
+
+    Raise ValueError if the file does not start with `magic`.
+    """
+    if f.read(len(magic)) != magic:
+        raise ValueError('{} is not a SenXor recording'.format(f.name))
+    size, = struct.unpack('<I', f.read(4))
+    metadata = json.loads(f.read(size).decode('utf-8'))
+    preamble = len(magic) + 4 + size
+    return metadata, preamble + (-preamble % RECORD_ALIGN)
+
+def camera_metadata(mi48):
+    """Return recording metadata describing the camera of `mi48`"""
+    return {
+        'name': mi48.name,
+        'camera_info': mi48.camera_info,
+        'fps': mi48.get_fps(),
+    }
+
+
+class RecordingWriter:
+    """
+    Append raw MI48 frames to a binary recording.
+
+    Frames are copied into a preallocated batch of `batch` records,
+    which is written to the file in one go when full, so that
+    recording a frame costs a memory copy. Call flush() to write
+    a partial batch, and close() when done; frames of a partial batch
+    are lost if the process dies before that.
+
+    Usage:
+
+        with RecordingWriter('frames.sxr', mi48.fpa_shape,
+                             metadata=camera_metadata(mi48)) as rec:
+            while ...:
+                data, header = mi48.read()  # with mi48.read_raw = True
+                rec.append(data, header)
+    """
+    def __init__(self, path, fpa_shape, metadata=None, batch=25):
+        self.path = path
+        self.fpa_shape = tuple(int(n) for n in fpa_shape)
+        self.data_size = int(np.prod(self.fpa_shape))
+        self.dtype = record_dtype(self.data_size)
+        self._buffer = np.zeros(batch, dtype=self.dtype)
+        # field views, to avoid looking up fields per frame
+        self._times = self._buffer['host_time']
+        self._headers = self._buffer['header']
+        self._data = self._buffer['data']
+        self._n = 0
+        self.nframes = 0
+        meta = dict(metadata or {})
+        meta.update({
+            'version': RECORDING_VERSION,
+            'fpa_shape': list(self.fpa_shape),
+            'record_size': self.dtype.itemsize,
+            'created': time.time(),
+        })
+        self._file = open(path, 'wb')
+        write_preamble(self._file, RECORDING_MAGIC, meta)
+        self._file.flush()
+
+    def append(self, data, header=None, host_time=None):
+        """Record a raw uint16 frame, its header and reception time.
+
+        `header` is a FRAME_HEADER_DTYPE record, e.g. from MI48.read(),
+        or None, for frames captured without a header.
+        `host_time` defaults to the current time.time().
+        """
+        if data.dtype != np.uint16:
+            raise TypeError('Only raw uint16 frames can be recorded, not {}'.
+                            format(data.dtype))
+        n = self._n
+        self._data[n] = data.reshape(-1)
+        if header is None:
+            self._headers[n] = 0
+        else:
+            self._headers[n] = header
+        self._times[n] = time.time() if host_time is None else host_time
+        self._n = n + 1
+        self.nframes += 1
+        if self._n == len(self._buffer):
+            self.flush()
+
+    def extend(self, data, headers, host_times):
+        """Record a block of frames, e.g. of a converted file.
+
+        `data` is an (N, pixels) uint16 array, `headers` N header
+        records, and `host_times` N reception times.
+        """
+        i = 0
+        while i < len(data):
+            n = self._n
+            m = min(len(self._buffer) - n, len(data) - i)
+            self._data[n: n + m] = data[i: i + m]
+            self._headers[n: n + m] = headers[i: i + m]
+            self._times[n: n + m] = host_times[i: i + m]
+            self._n = n + m
+            self.nframes += m
+            i += m
+            if self._n == len(self._buffer):
+                self.flush()
+
+    def flush(self):
+        """Write the frames of the current batch to the file"""
+        if self._n:
+            self._file.write(memoryview(self._buffer[:self._n]).cast('B'))
+            self._n = 0
+        self._file.flush()
+
+    def close(self):
+        """Write pending frames and close the file"""
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+        logger.debug('{}: {} frames recorded'.format(self.path, self.nframes))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RecordingReader:
+    """
+    Memory-mapped read access to a recording of RecordingWriter.
+
+    Records are accessed without reading the file: `data` is an
+    (N, pixels) uint16 array, `headers` the N frame header records,
+    and `host_times` the N reception times.
+
+    Frames can be looked up by frame counter in constant time, and by
+    device timestamp or host time by binary search. The frame counter
+    of the MI48 wraps at 65536; counters are unwrapped, so that they
+    keep increasing over a long recording.
+
+    Usage:
+
+        rec = RecordingReader('frames.sxr')
+        i = rec.find_frame(1234)
+        data, header = rec.frame(i)
+        errors = rec.verify()
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.metadata, self.offset = read_preamble(f, RECORDING_MAGIC)
+        if self.metadata.get('version') != RECORDING_VERSION:
+            raise ValueError('{}: unsupported recording version {}'.
+                             format(path, self.metadata.get('version')))
+        self.fpa_shape = tuple(self.metadata['fpa_shape'])
+        self.dtype = record_dtype(int(np.prod(self.fpa_shape)))
+        self._index = None
+        self.refresh()
+
+    def refresh(self):
+        """Map the file again, e.g. to see frames appended meanwhile"""
+        with open(self.path, 'rb') as f:
+            f.seek(0, 2)
+            nbytes = f.tell() - self.offset
+        n = max(0, nbytes) // self.dtype.itemsize
+        if n:
+            self.records = np.memmap(self.path, dtype=self.dtype, mode='r',
+                                     offset=self.offset, shape=(n,))
+        else:
+            self.records = np.zeros(0, dtype=self.dtype)
+        self.data = self.records['data']
+        self.headers = self.records['header']
+        self.host_times = self.records['host_time']
+        self._index = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        return self.frame(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.frame(i)
+
+    def frame(self, i, raw=False, dtype=np.float32):
+        """Return (data, header) of record `i`.
+
+        Data is converted to degrees C, of `dtype`, unless `raw`;
+        raw data is a read-only view on the file.
+        """
+        data = self.data[i]
+        if not raw:
+            data = np.take(dK_to_C_table(dtype), data, mode='clip')
+        return data, self.headers[i]
+
+    def host_time(self, i):
+        """Return the time.time() of reception of record `i`"""
+        return float(self.host_times[i])
+
+    @property
+    def frame_counters(self):
+        """Unwrapped frame counters of all records"""
+        self._build_index()
+        return self._counters
+
+    def _build_index(self):
+        if self._index is not None:
+            return
+        fc = self.headers['frame_counter'].astype(np.int64)
+        steps = np.diff(fc) % 65536
+        counters = np.empty_like(fc)
+        counters[:1] = fc[:1]
+        np.cumsum(steps, out=counters[1:])
+        counters[1:] += fc[:1]
+        self._counters = counters
+        # position of every counter value in the recording, -1 if missed;
+        # the first of repeated counters (e.g. of a restart) wins
+        first = int(counters[0]) if len(counters) else 0
+        span = int(counters[-1]) - first + 1 if len(counters) else 0
+        index = np.full(span, -1, dtype=np.int64)
+        index[counters[::-1] - first] = np.arange(len(counters))[::-1]
+        self._first = first
+        self._index = index
+
+    def find_frame(self, frame_counter):
+        """Return the record of the (unwrapped) `frame_counter`, or None"""
+        self._build_index()
+        i = int(frame_counter) - self._first
+        if 0 <= i < len(self._index) and self._index[i] >= 0:
+            return int(self._index[i])
+        return None
+
+    def find_time(self, t, host=False):
+        """Return the first record at or after time `t`.
+
+        `t` is a device timestamp [ms], or a time.time() of reception
+        if `host`. Return len(self) if all frames are earlier.
+        """
+        times = self.host_times if host else self.headers['timestamp']
+        return int(np.searchsorted(times, t))
+
+    def verify(self):
+        """Return a boolean array, True where the frame CRC is wrong"""
+        return verify_frames(self.data, self.headers['crc'])
+
+    def close(self):
+        """Release the file mapping"""
+        self.records = self.data = self.headers = self.host_times = None
+        self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,228 @@
+# Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+#
+# Replay recorded frames through an unmodified MI48, e.g. to profile
+# or regression-test image processing offline on production data.
+#
+import time
+import logging
+import numpy as np
+
+from senxor.mi48 import regmap, FPA_SHAPE, KELVIN_0, DATA_READY,\
+                        READOUT_TOO_SLOW, encode_frame_headers
+from senxor.crc import crc16
+from senxor.emulator import MI48Emulator
+from senxor.recording import RecordingReader, RECORDING_MAGIC,\
+                             HEADER_DTYPE_LE
+from senxor.archive import ArchiveReader
+
+logger = logging.getLogger(__name__)
+
+# Pacing of replayed frames
+PACE_REALTIME = 'realtime'  # as recorded, by header timestamp
+PACE_FPS = 'fps'            # at a fixed frame rate
+PACE_NONE = 'none'          # as fast as frames are read
+PACING = [PACE_REALTIME, PACE_FPS, PACE_NONE]
+
+
+def open_recording(path):
+    """Return a RecordingReader or ArchiveReader, as per the file content"""
+    with open(path, 'rb') as f:
+        magic = f.read(len(RECORDING_MAGIC))
+    if magic == RECORDING_MAGIC:
+        return RecordingReader(path)
+    return ArchiveReader(path)
+
+def _camera_type(fpa_shape):
+    """Return the lowest camera type of the given FPA shape"""
+    for key, shape in sorted((k, v) for k, v in FPA_SHAPE.items()
+                             if isinstance(k, int)):
+        if tuple(shape) == tuple(fpa_shape):
+            return key
+    raise ValueError('No camera type of FPA shape {}'.format(fpa_shape))
+
+def _with_header(reader):
+    """Return True if the frames of `reader` were recorded with headers
+
+    Frames recorded without header have it all zero; decided once per
+    recording, as a header of a frame may have a zero timestamp, e.g.
+    the first after power-up. Archives are judged by the first frame
+    of every chunk and all frames of the first chunk.
+    """
+    headers = getattr(reader, 'headers', None)
+    if headers is not None:
+        samples = [headers]
+    elif len(reader):
+        samples = [reader.index, reader.chunk(0)[1]]
+    else:
+        return False
+    return any(np.any(h['frame_counter']) or np.any(h['timestamp'])
+               for h in samples)
+
+
+class ReplayInterface:
+    """
+    Control and data interface of MI48, serving recorded frames.
+
+    Use the same instance as both interfaces, same as USB_Interface:
+
+        replay = ReplayInterface('frames.sxr', pacing='realtime')
+        mi48 = MI48([replay, replay])
+        mi48.start(stream=True, with_header=True)
+        data, header = mi48.read()
+
+    `source` is the path of a recording (see senxor.recording) or
+    archive (see senxor.archive), or a RecordingReader/ArchiveReader.
+    Registers are modelled by an MI48Emulator, with the camera info of
+    the recording metadata, so that MI48 initialises, configures and
+    stops as with a camera.
+
+    `pacing` is one of:
+
+        * 'realtime' -- frames are served with the intervals of their
+          device timestamps (host times for recordings without headers),
+          scaled by 1 / `speed`
+        * 'fps' -- frames are served at `fps`, or at the frame rate set
+          in FRAME_RATE if `fps` is None
+        * 'none' -- frames are served as fast as read
+
+    At the end of the recording, read() returns None, unless `loop`.
+    """
+    def __init__(self, source, pacing=PACE_REALTIME, fps=None, speed=1.0,
+                 loop=False, start=0):
+        if pacing not in PACING:
+            raise ValueError('Pacing must be one of {}'.format(PACING))
+        if isinstance(source, (RecordingReader, ArchiveReader)):
+            self.reader = source
+        else:
+            self.reader = open_recording(source)
+        self.pacing = pacing
+        self.fps = fps
+        self.speed = speed
+        self.loop = loop
+        self.start = start
+        self.fpa_shape = tuple(self.reader.fpa_shape)
+        self.data_size = int(np.prod(self.fpa_shape))
+        self.registers = self._make_registers(self.reader.metadata)
+        self.with_header = _with_header(self.reader)
+        self.frames_served = 0
+        self._next = start
+        self._t0 = None         # host time of the first paced frame
+        self._ref = None        # recorded time of the first paced frame
+        self._t_last = None     # host time of the last frame served
+
+    def _make_registers(self, metadata):
+        info = metadata.get('camera_info') or {}
+        kwargs = {'camera_type': info.get('CAMERA_TYPE',
+                                          _camera_type(self.fpa_shape))}
+        if 'MODULE_TYPE' in info:
+            kwargs['module_type'] = info['MODULE_TYPE']
+        if 'FW_VERSION' in info:
+            kwargs['fw_version'] = tuple(int(v) for v in
+                                         info['FW_VERSION'].split('.'))
+        if 'CAMERA_ID' in info:
+            kwargs['senxor_id'] = tuple(bytes.fromhex(info['CAMERA_ID']))
+        if 'EVK_ID' in info:
+            kwargs['evk_id'] = info['EVK_ID']
+        return MI48Emulator(**kwargs)
+
+    # ------------------------------------------------------------------
+    # control interface
+    # ------------------------------------------------------------------
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    def regread(self, reg, regname=""):
+        value = self.registers.regread(reg)
+        if reg == regmap['STATUS']:
+            # DATA_READY reflects the replayed frames, not the emulator's
+            value &= ~(DATA_READY | READOUT_TOO_SLOW) & 0xFF
+            if self.data_ready():
+                value |= DATA_READY
+        return value
+
+    def regwrite(self, reg, value, regname=""):
+        self.registers.regwrite(reg, value)
+        if reg == regmap['FRAME_MODE']:
+            # pacing restarts with the capture
+            self._t0 = None
+
+    # ------------------------------------------------------------------
+    # data interface
+    # ------------------------------------------------------------------
+    def _due_time(self, i):
+        """Return the host time at which frame `i` is to be served"""
+        if self.pacing == PACE_NONE:
+            return 0.
+        if self.pacing == PACE_FPS:
+            if self._t_last is None:
+                return 0.
+            if self.fps:
+                return self._t_last + 1. / self.fps
+            return self._t_last + self.registers.frame_period()
+        if self.with_header:
+            _, header = self.reader.frame(i, raw=True)
+            ref = 1.e-3 * int(header['timestamp'])
+        else:
+            ref = self.reader.host_time(i)
+        if self._t0 is None or ref < self._ref:
+            # first frame, or timestamps restarted
+            self._t0, self._ref = time.monotonic(), ref
+        return self._t0 + (ref - self._ref) / self.speed
+
+    def data_ready(self):
+        """Return True if the next frame is due, while capturing"""
+        if not self.registers.capture_mode():
+            return False
+        if self._next >= len(self.reader) and not self.loop:
+            return False
+        return time.monotonic() >= self._due_time(self._next %
+                                                  len(self.reader))
+
+    def read(self, size_in_words, out=None):
+        """Return the next recorded frame, as read from the MI48.
+
+        The frame is 1-D uint16, incl. header if `size_in_words`
+        exceeds the FPA size. Return None at the end of the recording.
+        """
+        if self._next >= len(self.reader):
+            if not self.loop or not len(self.reader):
+                return None
+            self._next = 0
+            self._t0 = None
+        i = self._next
+        delay = self._due_time(i) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        data, header = self.reader.frame(i, raw=True)
+        if out is None:
+            out = np.empty(size_in_words, dtype=np.uint16)
+        header_size = size_in_words - self.data_size
+        if header_size > 0:
+            if not self.with_header:
+                # recorded without header; make one up
+                header = self._make_header(i, data)
+            out[:header_size] = encode_frame_headers(header, header_size)
+        out[-self.data_size:] = data
+        self._next = i + 1
+        self._t_last = time.monotonic()
+        self.frames_served += 1
+        return out
+
+    def _make_header(self, i, data):
+        header = np.zeros((), dtype=HEADER_DTYPE_LE)
+        header['frame_counter'] = i & 0xFFFF
+        header['senxor_vdd'] = 3.3
+        header['senxor_temperature'] = 30.
+        header['pixel_max'] = data.max() / 10. + KELVIN_0
+        header['pixel_min'] = data.min() / 10. + KELVIN_0
+        header['crc'] = crc16(np.ascontiguousarray(data))
+        return header
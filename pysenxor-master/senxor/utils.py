@@ -1,7 +1,9 @@
 # Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
 
 import time
+import datetime
 import os
+import json
 import logging
 import math
 import itertools
@@ -15,8 +17,10 @@ sys.path.append('/home/pi/env/lib/python3.11/site-packages/')
 import cmapy
 from serial.tools import list_ports
 from serial import Serial, SerialException
-from senxor.mi48 import MI48
-from senxor.interfaces import MI_VID, MI_PIDs, USB_Interface
+from senxor.mi48 import MI48, dK_to_C_table
+from senxor.interfaces import MI_VID, MI_PIDs, USB_Interface, open_serial
+from senxor.recording import RecordingWriter, RecordingReader, HEADER_DTYPE_LE
+from senxor.legacy import to_deci_kelvin
 
 list_ironbow_b = [0,6,12,18,27,38,49,59,64,68,73,78,82,86,90,94,98,102,105,109,112,115,119,122,124,127,129,132,134,136,138,140,142,145,147,148,150,151,152,153,154,155,157,158,159,160,161,163,163,164,165,166,166,167,167,167,167,167,166,166,166,165,165,165,165,164,164,164,163,162,161,160,160,160,158,157,156,155,153,152,151,150,148,147,146,145,143,142,141,140,138,136,134,132,130,127,125,123,121,119,118,116,114,112,110,108,106,104,102,100,98,96,94,92,90,88,86,84,82,80,78,75,73,71,69,67,65,63,61,59,57,55,53,51,49,48,46,44,42,40,38,36,34,32,31,29,27,25,24,22,21,20,18,17,16,15,13,12,11,9,8,7,6,4,3,2,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1,2,3,5,6,7,9,10,12,13,14,16,17,20,23,26,28,31,34,37,39,42,45,48,50,53,56,59,62,66,70,74,78,82,86,91,96,101,106,111,115,120,125,130,135,140,146,152,158,164,171,178,185,192,201,210,219,229,237,243,248,251,254]
 list_ironbow_g = [0,0,0,0,0,0,0,0,0,1,2,3,4,3,3,2,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1,1,1,2,2,2,2,3,3,3,4,5,6,7,8,9,10,11,12,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,30,31,32,33,34,35,36,37,39,40,42,43,45,47,48,50,51,53,54,56,58,59,61,62,64,65,67,69,70,72,73,75,76,78,80,81,83,84,86,88,89,91,93,95,96,98,100,102,103,105,107,109,110,112,114,116,117,119,121,122,124,126,128,129,131,133,134,136,138,139,141,143,145,146,148,150,151,153,155,156,158,160,161,163,165,167,168,170,172,173,175,177,178,180,182,184,185,187,188,190,191,193,194,196,197,199,200,202,203,205,206,208,209,211,212,214,215,216,217,219,220,221,223,224,225,227,228,229,231,232,233,235,235,236,236,237,238,239,240,241,242,243,244,245,246,247,248,249,249,250,251,252,253,254,255,255,255,255,255,254,254,254,254,254]
@@ -59,18 +63,31 @@ colormaps = {
     'ironbow': lut_ironbow[-256:],
 }
 
-def connect_senxor(src=None, name=None):
+def connect_senxor(src=None, name=None, cache=None):
     """
     Return an MI48 instance corresponding to the SenXor module connected to `src`
 
     `src` can be either the name of a virtual comport, e.g. COM6, or a sequential
-    number, e.g. 0, 1, etc.
+    number, e.g. 0, 1, etc., or the path of a serial device, e.g. the pty of
+    the emulator.USBEmulator, which is then opened directly.
     if `name` (stirng) is not None, it will be assigned to mi48.name instance, else
     the name of the virtual comport will be assigned to the mi48.name.
+    `cache` is an optional senxor.cache.CameraCache, for warm starts.
 
     Return None, if no connection to SenXor can be established.
     """
     cam_index, port_name = None, None
+    if isinstance(src, (str, Path)) and os.path.exists(src):
+        try:
+            ser = open_serial(src)
+        except SerialException:
+            logging.warning(f'{src} seems already open')
+            return None, None, []
+        usb = USB_Interface(ser)
+        if name is None: name = str(src)
+        mi48 = MI48([usb,usb], name=name, read_raw=False,
+                    cache=cache)
+        return mi48, str(src), [str(src)]
     try:
         src = int(src)
         cam_index = src
@@ -100,7 +117,8 @@ def connect_senxor(src=None, name=None):
             usb = USB_Interface(ser)
             connected_port = port
             if name is None: name = connected_port
-            mi48 = MI48([usb,usb], name=name, read_raw=False)
+            mi48 = MI48([usb,usb], name=name, read_raw=False,
+                    cache=cache)
     return mi48, connected_port, port_names
 
 def data_to_frame(data, array_shape, hflip=False):
@@ -488,6 +506,184 @@ class TestData:
         return self.data[key]
 
 
+class MappedFrames:
+    """
+    Frames of a recording, converted to degrees C upon indexing.
+
+    Only the indexed frames or pixels are read from the file, e.g.
+    frames[:100] or frames[:, ipx]; np.asarray(frames) converts all.
+    """
+    def __init__(self, data, dtype=np.float32):
+        self.data = data
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, ix):
+        return np.take(dK_to_C_table(self.dtype), self.data[ix], mode='clip')
+
+    def __array__(self, dtype=None, copy=None):
+        frames = self[:]
+        return frames if dtype is None else frames.astype(dtype)
+
+    def blocks(self, size=256):
+        """Yield the frames in blocks of `size`"""
+        for i in range(0, len(self), size):
+            yield self[i: i + size]
+
+
+def _json_key(key):
+    """Return a key as loaded from JSON, with its tuples restored"""
+    if isinstance(key, list):
+        return tuple(_json_key(k) for k in key)
+    return key
+
+
+class MappedTestData(TestData):
+    """
+    TestData backed by binary recordings in `directory`.
+
+    Every key is stored as a recording (see senxor.recording) of raw
+    deci-Kelvin frames, with Vdd and Tsx in the frame headers, and
+    listed in an index file of the directory, so that a dataset is
+    reopened by MappedTestData(directory). Recordings are opened upon
+    first access of a key, and memory-mapped, so datasets may be
+    larger than memory. Vdd and Tsx of a key are decoded once.
+
+    get() returns (Vdd, Tsx, frames), same as TestData, where frames
+    is a MappedFrames, converted to degrees C upon indexing.
+    """
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, directory, fpa_shape=None, dtype=np.float32):
+        super().__init__()
+        self.directory = directory
+        self.fpa_shape = fpa_shape or (self.nc, self.nr)
+        self.dtype = dtype
+        self._readers = {}
+        self._columns = {}
+        os.makedirs(directory, exist_ok=True)
+        # key -> recording path, relative to directory
+        self._paths = {}
+        try:
+            with open(os.path.join(directory, self.INDEX_FILE), 'r') as f:
+                for key, path in json.load(f):
+                    self._paths[_json_key(key)] = path
+        except FileNotFoundError:
+            pass
+
+    def _save_index(self):
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(list(self._paths.items()), f, indent=1)
+        os.replace(tmp, path)
+
+    def keys(self):
+        return list(self._paths)
+
+    def __contains__(self, key):
+        return key in self._paths
+
+    def update(self, key, data):
+        """Add data as a tupple (Vdd, Tsx, Frames) or a 2D array from np.loadtxt
+
+        Frames are in degrees C, or raw deci-Kelvin, and are stored as
+        deci-Kelvin.
+        """
+        try:
+            Vdd, Tsx, frames = data
+        except ValueError:
+            frames = data[:, -self.nc * self.nr:]
+            Vdd = data[:, 2]   # * 1.e-4
+            Tsx = data[:, 3]   # 100 + KELVIN0
+        frames = np.asarray(frames)
+        headers = np.zeros(len(frames), dtype=HEADER_DTYPE_LE)
+        headers['frame_counter'] = np.arange(len(frames)) & 0xFFFF
+        headers['senxor_vdd'] = Vdd
+        headers['senxor_temperature'] = Tsx
+        path = self._paths.get(key, 'key-{}.sxr'.format(len(self._paths)))
+        self._close_key(key)
+        with RecordingWriter(os.path.join(self.directory, path),
+                             self.fpa_shape, metadata={'key': key}) as rec:
+            if frames.dtype != np.uint16:
+                frames = to_deci_kelvin(frames)
+            rec.extend(frames, headers, np.zeros(len(frames)))
+        self._paths[key] = path
+        self._save_index()
+
+    def add_recording(self, key, path):
+        """Add an existing recording as `key`, without copying it"""
+        self._close_key(key)
+        self._paths[key] = os.path.relpath(path, self.directory)
+        self._save_index()
+
+    def _close_key(self, key):
+        reader = self._readers.pop(key, None)
+        if reader is not None:
+            reader.close()
+        self._columns.pop(key, None)
+
+    def reader(self, key):
+        """Return the RecordingReader of `key`, opening it if needed"""
+        try:
+            return self._readers[key]
+        except KeyError:
+            pass
+        path = os.path.join(self.directory, self._paths[key])
+        reader = self._readers[key] = RecordingReader(path)
+        return reader
+
+    def get(self, key):
+        """Retrieve data for a given key"""
+        reader = self.reader(key)
+        try:
+            Vdd, Tsx = self._columns[key]
+        except KeyError:
+            Vdd = reader.headers['senxor_vdd'].astype(np.float64)
+            Tsx = reader.headers['senxor_temperature'].astype(np.float64)
+            self._columns[key] = Vdd, Tsx
+        return Vdd, Tsx, MappedFrames(reader.data, self.dtype)
+
+    def stack(self, keys=None, pixels=None):
+        """
+        Return (Vdd, Tsx, frames, key_index) of `keys` stacked.
+
+        `keys` default to all keys. `pixels` selects pixel indices
+        (e.g. of get_spot_in_frame via get_ipx_1D), so that only those
+        columns are read and converted. `key_index` holds the index
+        in `keys` of every frame.
+        """
+        keys = self.keys() if keys is None else list(keys)
+        table = dK_to_C_table(self.dtype)
+        parts = ([], [], [], [])
+        for i, key in enumerate(keys):
+            Vdd, Tsx, frames = self.get(key)
+            data = frames.data if pixels is None else frames.data[:, pixels]
+            parts[0].append(Vdd)
+            parts[1].append(Tsx)
+            parts[2].append(np.take(table, data, mode='clip'))
+            parts[3].append(np.full(len(Vdd), i))
+        if not keys:
+            return (np.zeros(0), np.zeros(0),
+                    np.zeros((0, 0), dtype=self.dtype), np.zeros(0, int))
+        return tuple(np.concatenate(part) for part in parts)
+
+    def iter_frames(self, keys=None, block=256):
+        """Yield (key, Vdd, Tsx, frames) in blocks of `block` frames"""
+        keys = self.keys() if keys is None else keys
+        for key in keys:
+            Vdd, Tsx, frames = self.get(key)
+            for i in range(0, len(frames), block):
+                yield (key, Vdd[i: i + block], Tsx[i: i + block],
+                       frames[i: i + block])
+
+
 def quick_segment(data, param=None):
     """
     Perform a quick hot-on-cold segmentation and return the contour lines,
@@ -653,6 +849,8 @@ def stptime2float(x, fmt="%Y-%m-%dT%H:%M:%S.%f%z"):
         data = np.loadtext(filename, usecols=range(n, n+4960), delimiter=',')
     and construct a pandas dataframe for the n columns of header related stuff
     plus select pixels as necessary.
+    To convert whole files, see senxor.legacy.convert_text(), which
+    parses the times of a block of lines at once.
     """
     dt = datetime.datetime.strptime(x, fmt)
     return np.datetime64(dt).astype(float)